@@ -38,11 +38,9 @@ class AuthorizationError(Exception):
 class Authorize():
 
     def __init__(self, cdb_host, cdb_user, cdb_pwd):
-        cfg.clean()
-        cfg.put("couchdb.host", cdb_host)
-        cfg.put("couchdb.admin.user", cdb_user)
-        cfg.put("couchdb.admin.password", cdb_pwd)
-        self._db = cu.CouchDB()
+        # a private snapshot, leaving alone the configuration of the other requests
+        with cfg.scope({"couchdb": {"host": cdb_host, "admin": {"user": cdb_user, "password": cdb_pwd}}}):
+            self._db = cu.CouchDB()
 
     def encode(self,username, password):
         """Returns an HTTP basic authentication encrypted string given a valid
@@ -89,35 +89,13 @@ def action_should_trigger(currentDate, executionInterval, actionCronExpression):
     return result
 
 #
-# query the dbn database using the specified selecto
+# query the dbn database using the specified selector,
+# streaming the documents a page at a time
 #
-def find_docs(db, dbn, selector, username, password):
-    documents = []
+def find_docs(db, dbn, selector, username, password, page_size=cu.FIND_PAGE_SIZE):
     query = json.loads(selector)
-    logging.info(f"Querying couchdb {dbn} for documents")
-
-    #CouchDB returns no more than 25 records. We iterate to get all the cron enabled actions.
-    while(True):
-        logging.info(f"select query param {json.dumps(query)}")
-        res = db.find_doc(dbn, json.dumps(query), username, password)
-
-        if(res == None):
-            break
-
-        if(res['docs']):
-            docs = list(res['docs'])
-            if(len(docs) > 0):
-                documents.extend(docs)
-                if(res['bookmark']):
-                    query['bookmark']=res['bookmark']                
-            else:
-                logging.info('docs item is an emtpy list. No more documents found')
-                break 
-        else:
-            logging.info('docs items not present. no more documents found')
-            break 
-       
-    return list(documents)
+    logging.info(f"Querying couchdb {dbn} for documents with {selector}")
+    return db.find_iter(dbn, query['selector'], page_size=page_size, fields=query.get('fields'), user=username, password=password)
 
 #
 # Get subject from nuvolaris_subjects db
@@ -137,7 +115,8 @@ def get_subjects(db, username, password):
 
 #
 # get actions from the nuvolaris_whisks db
-# having an annotation with key=cron or key=autoexec and value=true
+# having an annotation with key=cron or key=autoexec and value=true,
+# as an iterator over the pages of the query
 #
 def get_cron_aware_actions(db, username, password):
     selector = '{"selector":{"entityType":"action", "$or":[{"annotations": {"$elemMatch": {"key": "cron"}}},{"annotations": {"$elemMatch": {"$and":[{"key":"autoexec"},{"value":true}]}}}] }, "fields": ["_id", "annotations", "name", "_rev","namespace","parameters","entityType"]}'
@@ -386,11 +365,14 @@ def start():
         baseurl = f"{ow_protocol}://{ow_host}:{ow_port}/api/v1/namespaces/"                
         actions = get_cron_aware_actions(db, config['couchdb.controller.user'],config['couchdb.controller.password'])
 
-        if(len(actions) > 0):
-            subjects = get_subjects(db, config['couchdb.controller.user'],config['couchdb.controller.password'])
-            for action in actions:
-                handle_action(baseurl, currentDate, interval, action, subjects)
-        else:
+        # the subjects are read when the first action comes
+        subjects = None
+        for action in actions:
+            if subjects is None:
+                subjects = get_subjects(db, config['couchdb.controller.user'],config['couchdb.controller.password'])
+            handle_action(baseurl, currentDate, interval, action, subjects)
+
+        if subjects is None:
             logging.info('No cron aware action extracted. Exiting....')
     else:
         logging.warn("CouchDB it is not available. Exiting....")
\ No newline at end of file
@@ -15,10 +15,137 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import flatdict, json, os
-import logging
+import flatdict, json, os, copy
+import logging, threading, contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
 
-_config = {}
+# an immutable configuration: a spec, flattened lazily one top level key at a time
+# when it is read, and the values put over it (None marks the deleted keys)
+class Snapshot:
+    """
+    >>> snap = Snapshot({"a": {"b": 1, "c": {"d": 2, "e": 3}, "f": 4}, "g": 5})
+    >>> snap.get("a.c.d"), snap.exists("a"), list(snap._flat)
+    (2, False, ['a'])
+    >>> snap.getall("a.c")
+    {'a.c.d': 2, 'a.c.e': 3}
+    >>> snap2 = snap.with_values({"a.c.d": 7, "g": None, "h": 1})
+    >>> snap2.getall("a.c"), snap2.keys(), snap.get("a.c.d")
+    ({'a.c.d': 7, 'a.c.e': 3}, ['a.b', 'a.c.d', 'a.c.e', 'a.f', 'h'], 2)
+    >>> spec = {"a": {"b": 1}}; snap = Snapshot(spec); spec["a"]["b"] = 2; snap.get("a.b")
+    1
+    """
+    def __init__(self, spec=None, values=None, flat=None):
+        # a new spec is copied, as the caller may change it later; the derived snapshots share it
+        self._spec = (spec if flat is not None else copy.deepcopy(spec)) or {}
+        self._values = values or {}
+        # flattened top level keys, shared with the snapshots derived from this one
+        self._flat = flat if flat is not None else {}
+        self._lock = threading.Lock()
+
+    # the flattened subtree of a top level key, as its sorted keys and its values
+    def _subtree(self, top):
+        res = self._flat.get(top)
+        if res is None:
+            with self._lock:
+                res = self._flat.get(top)
+                if res is None:
+                    values = dict(flatdict.FlatDict({top: self._spec[top]}, delimiter="."))
+                    res = (sorted(values), values)
+                    self._flat[top] = res
+        return res
+
+    def get(self, key, defval=None):
+        if key in self._values:
+            value = self._values[key]
+            return defval if value is None else value
+        top = key.split(".", 1)[0]
+        if top not in self._spec:
+            return defval
+        return self._subtree(top)[1].get(key, defval)
+
+    def exists(self, key):
+        return self.get(key, self) is not self
+
+    # values of the keys starting with prefix, only the subtrees that can match it are flattened
+    def getall(self, prefix=""):
+        res = {}
+        for top in self._spec:
+            if top.startswith(prefix) or prefix.startswith(top):
+                keys, values = self._subtree(top)
+                for i in range(bisect_left(keys, prefix), len(keys)):
+                    if not keys[i].startswith(prefix):
+                        break
+                    res[keys[i]] = values[keys[i]]
+        for key, value in self._values.items():
+            if key.startswith(prefix):
+                res[key] = value
+        return {k: v for k, v in sorted(res.items()) if v is not None}
+
+    def keys(self, prefix=""):
+        return list(self.getall(prefix))
+
+    # a new snapshot with the values put over this one
+    def with_values(self, values):
+        return Snapshot(self._spec, {**self._values, **values}, self._flat)
+
+class _Holder:
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+# the configuration of the operator, the one of the scope of the current handler if any
+_published = _Holder(Snapshot())
+_scope = contextvars.ContextVar("config", default=None)
+_lock = threading.Lock()
+
+def snapshot():
+    return (_scope.get() or _published).snapshot
+
+def _update(fn):
+    holder = _scope.get()
+    with _lock:
+        if holder is not None:
+            holder.snapshot = fn(holder.snapshot)
+        else:
+            _published.snapshot = fn(_published.snapshot)
+
+# run the block with its own configuration, so that concurrent handlers do not clobber each other
+# it starts from the published configuration, or from spec if given; publish() makes the configuration
+# of the scope the one of the scopes starting later, as the whisk handlers do for the user handlers
+@contextmanager
+def scope(spec=None):
+    """
+    >>> clean(); _ = put("a", 1)
+    >>> with scope():
+    ...     _ = put("a", 2); get("a")
+    2
+    >>> get("a")
+    1
+    >>> with scope({"couchdb": {"host": "couchdb"}}):
+    ...     get("couchdb.host"), get("a")
+    ('couchdb', None)
+    >>> with scope():
+    ...     _ = configure({"a": 3}); _ = put("b", 4)
+    >>> get("a"), get("b")
+    (1, None)
+    >>> with scope():
+    ...     _ = configure({"a": 3}); publish(); _ = put("b", 4)
+    >>> get("a"), get("b")
+    (3, None)
+    """
+    holder = _Holder(Snapshot(spec) if spec is not None else _published.snapshot)
+    token = _scope.set(holder)
+    try:
+        yield holder
+    finally:
+        _scope.reset(token)
+
+# publish the configuration of the current scope for the scopes starting later
+def publish():
+    holder = _scope.get()
+    if holder is not None:
+        with _lock:
+            _published.snapshot = holder.snapshot
 
 # define a configuration 
 # the configuration is a map, followed by a list of labels 
@@ -26,8 +153,7 @@ _config = {}
 # you can have only a configuration active at a time
 # if you want to set a new configuration you have to clean it
 def configure(spec: dict):
-    global _config
-    _config = dict(flatdict.FlatDict(spec, delimiter="."))
+    _update(lambda snap: Snapshot(spec))
 
     #forces autodetect of kube if not provided
     if not exists('nuvolaris.kube'):
@@ -36,14 +162,13 @@ def configure(spec: dict):
     return True
 
 def clean():
-    global _config
-    _config = {}
+    _update(lambda snap: Snapshot())
 
 def exists(key):
-    return key in _config
+    return snapshot().exists(key)
 
 def get(key, envvar=None, defval=None):
-    val = _config.get(key)
+    val = snapshot().get(key)
 
     if envvar and envvar in os.environ:
         val = os.environ[envvar]
@@ -54,31 +179,22 @@ def get(key, envvar=None, defval=None):
     return defval
 
 def put(key, value):
-    _config[key] = value
+    _update(lambda snap: snap.with_values({key: value}))
     return True
 
 def delete(key):
-    if key in _config:
-        del _config[key]
+    if exists(key):
+        _update(lambda snap: snap.with_values({key: None}))
         return True
 
 def getall(prefix=""):
-    res = {}
-    for key in _config.keys():
-        if key.startswith(prefix):
-            res[key] = _config[key]
-    return res
+    return snapshot().getall(prefix)
 
 def keys(prefix=""):
-    res = []
-    if _config:
-        for key in _config.keys():
-            if key.startswith(prefix):
-                res.append(key)
-    return res
+    return snapshot().keys(prefix)
 
 def detect_labels(labels=None):    
-    # skip autodetection of nuvolaris.kube if already available in _config
+    # skip autodetection of nuvolaris.kube if already available in the configuration
     if exists('nuvolaris.kube') and get('nuvolaris.kube') != 'auto':
         logging.info(f"*** configuration provided already a nuvolaris.kube={get('nuvolaris.kube')}")
         return {}
@@ -95,7 +211,7 @@ def detect_labels(labels=None):
             if j.startswith("nuvolaris.io/"):
                 key = f"nuvolaris.{j[13:]}"
                 res[key] = i[j]
-                _config[key] = i[j]
+                put(key, i[j])
 
     for i in labels:
         for j in list(i.keys()):
@@ -128,66 +244,81 @@ def detect_labels(labels=None):
         
     if kube:
         res["nuvolaris.kube"] = kube 
-        _config["nuvolaris.kube"] = kube
+        put("nuvolaris.kube", kube)
         return res
 
     # defaults to generic if it is not yet detected
     if exists('nuvolaris.kube') and get('nuvolaris.kube') == 'auto':
-        _config["nuvolaris.kube"] = "generic"
+        put("nuvolaris.kube", "generic")
         res["nuvolaris.kube"] = "generic"
 
     return res
 
+# storages, when given, are the default storage classes as {"name", "provisioner"}, the preferred first
 def detect_storage(storages=None):
+    """
+    >>> clean(); detect_storage([{"name": "standard", "provisioner": "rancher.io/local-path"}])
+    {'nuvolaris.storageclass': 'standard', 'nuvolaris.provisioner': 'rancher.io/local-path'}
+    >>> clean(); _ = put("nuvolaris.storageclass", "gp2"); detect_storage([{"name": "standard", "provisioner": "ebs"}])
+    {'nuvolaris.provisioner': 'ebs'}
+    >>> get("nuvolaris.storageclass")
+    'gp2'
+    """
     res = {}
-    if not storages:
-        import nuvolaris.util as util
+    try:
+        detect_storageclass = True
+        detect_provisioner = True
 
-        try:
-            detect_storageclass = True
-            detect_provisioner = True
+        # skips autodetection if already provided
+        if exists('nuvolaris.storageclass') and get('nuvolaris.storageclass') != 'auto':
+            logging.info(f"*** configuration provided already a nuvolaris.storageclass={get('nuvolaris.storageclass')}")
+            detect_storageclass = False
 
-            # skips autodetection if already provided
-            if exists('nuvolaris.storageclass') and get('nuvolaris.storageclass') != 'auto':
-                logging.info(f"*** configuration provided already a nuvolaris.storageclass={get('nuvolaris.storageclass')}")
-                detect_storageclass = False
+        if exists('nuvolaris.provisioner') and get('nuvolaris.provisioner') != 'auto':
+            logging.info(f"*** configuration provided already a nuvolaris.provisioner={get('nuvolaris.provisioner')}")
+            detect_provisioner = False
 
-            if exists('nuvolaris.provisioner') and get('nuvolaris.provisioner') != 'auto':
-                logging.info(f"*** configuration provided already a nuvolaris.provisioner={get('nuvolaris.provisioner')}")
-                detect_provisioner = False
+        if not detect_storageclass and not detect_provisioner:
+            return res    
 
-            if not detect_storageclass and not detect_provisioner:
-                return res    
-
-            if detect_storageclass:
+        default = storages[0] if storages else {}
+        if detect_storageclass:
+            if storages is None:
+                import nuvolaris.util as util
                 storage_class = util.get_default_storage_class()
-                if storage_class:
-                    res['nuvolaris.storageclass'] = storage_class
-                    _config['nuvolaris.storageclass'] = storage_class
-            
-            if detect_provisioner:
+            else:
+                storage_class = default.get("name")
+            if storage_class:
+                res['nuvolaris.storageclass'] = storage_class
+                put('nuvolaris.storageclass', storage_class)
+        
+        if detect_provisioner:
+            if storages is None:
+                import nuvolaris.util as util
                 provisioner = util.get_default_storage_provisioner()
-                if(provisioner):
-                    res['nuvolaris.provisioner'] = provisioner
-                    _config['nuvolaris.provisioner'] = provisioner
-        except:
-            pass
+            else:
+                provisioner = default.get("provisioner")
+            if(provisioner):
+                res['nuvolaris.provisioner'] = provisioner
+                put('nuvolaris.provisioner', provisioner)
+    except:
+        pass
     return res
 
 def detect_env():
-    _config['operator.image'] = os.environ.get("OPERATOR_IMAGE", "missing-OPERATOR_IMAGE")
-    _config['operator.tag'] = os.environ.get("OPERATOR_TAG", "missing-OPERATOR_TAG")
+    put('operator.image', os.environ.get("OPERATOR_IMAGE", "missing-OPERATOR_IMAGE"))
+    put('operator.tag', os.environ.get("OPERATOR_TAG", "missing-OPERATOR_TAG"))
 
     # skip autodetection of controller.image if already configure into whisk.yaml
     if not exists('controller.image'):
-        _config['controller.image'] = os.environ.get("CONTROLLER_IMAGE", "missing-CONTROLLER_IMAGE")
-        _config['controller.tag'] = os.environ.get("CONTROLLER_TAG", "missing-CONTROLLER_TAG")
+        put('controller.image', os.environ.get("CONTROLLER_IMAGE", "missing-CONTROLLER_IMAGE"))
+        put('controller.tag', os.environ.get("CONTROLLER_TAG", "missing-CONTROLLER_TAG"))
     else:
         logging.warn(f"OW controller image detection skipped. Using {get('controller.image')}")
 
     if not exists('invoker.image'):
-        _config['invoker.image'] = os.environ.get("INVOKER_IMAGE", "missing-INVOKER_IMAGE")
-        _config['invoker.tag'] = os.environ.get("INVOKER_TAG", "missing-INVOKER_TAG")
+        put('invoker.image', os.environ.get("INVOKER_IMAGE", "missing-INVOKER_IMAGE"))
+        put('invoker.tag', os.environ.get("INVOKER_TAG", "missing-INVOKER_TAG"))
     else:
         logging.warn(f"OW invoker image detection skipped. Using {get('invoker.image')}")
 
@@ -0,0 +1,62 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+import logging
+import nuvolaris.kube as kube
+import nuvolaris.informer as informer
+import nuvolaris.jsonpath_util as jp
+
+# read a configmap once, from the informer cache if available
+def fetch(name="config", namespace="nuvolaris"):
+    res = informer.query("cm", "{@}", namespace=namespace, name=name)
+    if res:
+        return res[0]
+    return kube.get(f"cm/{name}", namespace)
+
+class ConfigMapSnapshot:
+    """
+    A configmap read once and then queried in memory, by default cm/config
+
+    >>> snap = ConfigMapSnapshot(obj={"metadata": {"annotations": {"apihost": "https://localhost"}}})
+    >>> snap.get('{.metadata.annotations.apihost}')
+    'https://localhost'
+    >>> snap.annotation("apihost"), snap.annotation("missing", "none")
+    ('https://localhost', 'none')
+    >>> snap.get('{.metadata.annotations.missing}') is None
+    True
+    """
+    def __init__(self, name="config", namespace="nuvolaris", obj=None):
+        self.name = name
+        self.namespace = namespace
+        if obj is None:
+            obj = fetch(name, namespace)
+            if obj is None:
+                logging.warning(f"cm/{name} not found in {namespace}")
+        self.obj = obj or {}
+
+    def get(self, jsonpath):
+        """
+        return the first value matching the jsonpath, None if not found
+        """
+        res = jp.query(self.obj, jsonpath)
+        return res[0] if res else None
+
+    def annotations(self):
+        return self.obj.get("metadata", {}).get("annotations") or {}
+
+    def annotation(self, key, default=None):
+        return self.annotations().get(key, default)
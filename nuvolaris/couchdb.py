@@ -30,11 +30,23 @@ from jinja2 import Environment, FileSystemLoader
 loader = FileSystemLoader(["./nuvolaris/templates", "./nuvolaris/files"])
 env = Environment(loader=loader)
 
-def update_templated_doc(db, database, template, data):
+def render_doc(template, data):
     tpl = env.get_template(template)
-    doc = json.loads(tpl.render(data))
+    return json.loads(tpl.render(data))
+
+def update_templated_doc(db, database, template, data):
+    doc = render_doc(template, data)
     return db.update_doc(database, doc)
 
+# create or update the documents in a single bulk request, returning true if all are ok
+def update_docs(db, database, docs):
+    status = db.bulk_update(database, docs)
+    failed = {id: err for id, err in status.items() if err != "ok"}
+    if failed or len(status) < len(docs):
+        logging.warning(f"ERR: update of {database} documents: {failed or status}")
+        return False
+    return True
+
 def create(owner=None):
     logging.info("create couchdb")
     runtime = cfg.get('nuvolaris.kube')
@@ -128,9 +140,8 @@ def init_subjects(db):
     res = check(db.create_db(dbn), "create_db: subjects", res)
     members = [cfg.get('couchdb.controller.user'), cfg.get('couchdb.invoker.user')]
     res = check(db.add_role(dbn, members), "add_role: subjects", res)
-    for i in subjects_design_docs:
-        res = check(update_templated_doc(db, dbn, i, {}), f"add {i}", res)
-    return res
+    docs = [render_doc(i, {}) for i in subjects_design_docs]
+    return check(update_docs(db, dbn, docs), f"add {subjects_design_docs}", res)
 
 def init_activations(db):
     activations_design_docs = [
@@ -145,9 +156,8 @@ def init_activations(db):
     res = check(db.create_db(dbn), "create_db: activations", res)
     members = [cfg.get('couchdb.controller.user'), cfg.get('couchdb.invoker.user')]
     res = check(db.add_role(dbn, members), "add_role: activations", res)
-    for i in activations_design_docs:
-        res = check(update_templated_doc(db, dbn, i, {}), f"add {i}", res)
-    return res
+    docs = [render_doc(i, {}) for i in activations_design_docs]
+    return check(update_docs(db, dbn, docs), f"add {activations_design_docs}", res)
 
 def init_actions(db):
     whisks_design_docs = [
@@ -159,19 +169,20 @@ def init_actions(db):
     res = check(db.create_db(dbn), "create_db: whisks", res)
     members = [cfg.get('couchdb.controller.user'), cfg.get('couchdb.invoker.user')]
     res = check(db.add_role(dbn, members), "add_role: actions", res)
-    for i in whisks_design_docs:
-        res = check(update_templated_doc(db, dbn, i, {}), f"add {i}", res)
-    return res
+    docs = [render_doc(i, {}) for i in whisks_design_docs]
+    return check(update_docs(db, dbn, docs), f"add {whisks_design_docs}", res)
 
 def add_initial_subjects(db):
     res = check(db.wait_db_ready(60), "wait_db_ready", True)
     dbn = "subjects"
+    docs = []
     for _, (name, value) in enumerate(cfg.getall("openwhisk.namespaces").items()):
         [uuid, key] = value.split(":")
         basename = name.split(".")[-1]
         data = { "name": basename, "key": key, "uuid": uuid}
-        res = check(update_templated_doc(db, dbn, "subject.json", data), f"add {name}", res)
-    return res
+        docs.append(render_doc("subject.json", data))
+    names = [d.get("subject") for d in docs]
+    return check(update_docs(db, dbn, docs), f"add {names}", res)
 
 def init():
     # load nuvolaris config from the named crd
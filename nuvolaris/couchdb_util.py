@@ -15,9 +15,68 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import os, json, time, sys, logging
+import os, json, time, sys, logging, threading
 import requests as req
 import nuvolaris.config as cfg
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+
+# connections kept open to each couchdb host, and sessions kept, one per host and credentials
+POOL_SIZE = int(os.environ.get("COUCHDB_POOL_SIZE", "10"))
+POOL_SESSIONS = int(os.environ.get("COUCHDB_POOL_SESSIONS", "32"))
+# seconds a database found ready is not checked again
+READY_SECONDS = 10
+# times the conflicting documents of a bulk update are retried
+BULK_RETRIES = 3
+# documents asked to _find for each page
+FIND_PAGE_SIZE = int(os.environ.get("COUCHDB_FIND_PAGE_SIZE", "500"))
+# connections are reused unless COUCHDB_KEEPALIVE is false
+KEEPALIVE = os.environ.get("COUCHDB_KEEPALIVE", "true").lower() != "false"
+# seconds to connect and to wait for a response, when the call does not give its own timeout
+TIMEOUT = (float(os.environ.get("COUCHDB_CONNECT_TIMEOUT", "5")), float(os.environ.get("COUCHDB_READ_TIMEOUT", "60")))
+
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
+class _Session(req.Session):
+  def request(self, method, url, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    return super().request(method, url, **kwargs)
+
+# the session of the process for the host and credentials, so that the CouchDB instances
+# share its pool of connections; the least recently used one is closed when there are too many
+def session(url, user=None, password=""):
+  """
+  >>> s = session("http://couchdb:5984", "whisk_admin", "pwd")
+  >>> s is session("http://couchdb:5984", "whisk_admin", "pwd"), s is session("http://couchdb:5984", "cron", "pwd")
+  (True, False)
+  >>> s.auth.username, session("http://couchdb:5984").auth
+  ('whisk_admin', None)
+  >>> s.get_adapter("http://couchdb:5984")._pool_maxsize == POOL_SIZE
+  True
+  >>> for i in range(POOL_SESSIONS): _ = session("http://couchdb:5984", f"user{i}", "pwd")
+  >>> s is session("http://couchdb:5984", "whisk_admin", "pwd")
+  False
+  """
+  key = (url, user, password)
+  with _sessions_lock:
+    s = _sessions.get(key)
+    if s is not None:
+      _sessions.move_to_end(key)
+      return s
+    s = _Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    if user is not None:
+      s.auth = req.auth.HTTPBasicAuth(user, password)
+    if not KEEPALIVE:
+      s.headers["Connection"] = "close"
+    _sessions[key] = s
+    while len(_sessions) > POOL_SESSIONS:
+      _, old = _sessions.popitem(last=False)
+      old.close()
+    return s
 
 class CouchDB:
   def __init__(self):
@@ -30,19 +89,31 @@ class CouchDB:
     self.db_auth = req.auth.HTTPBasicAuth(self.db_username,self.db_password)
     self.db_url = f"{self.db_protocol}://{self.db_host}:{self.db_port}"
     self.db_base = f"{self.db_url}/{self.db_prefix}"
-    self.db_session = req.Session()
-    self.db_session.auth = self.db_auth
+    self.db_session = session(self.db_url, self.db_username, self.db_password)
+    self.db_ready = 0
+
+  # the session for the credentials of a call: none, the given user or the admin
+  def _session(self, user=None, password="", no_auth=False):
+    if no_auth:
+      return session(self.db_url)
+    if user:
+      return session(self.db_url, user, password)
+    return self.db_session
 
+  # wait until the database answers, it is not asked again if it answered in the last READY_SECONDS
   def wait_db_ready(self, max_seconds):
+      if time.time() - self.db_ready < READY_SECONDS:
+        return True
       logging.info("entering CouchDB.wait_db_ready()")
       start = time.time()
       delta = 0
-      session = req.Session()
+      s = session(self.db_url)
       while delta < max_seconds:
         try:
-          r = session.get(f"{self.db_url}/_utils", timeout=5)
+          r = s.get(f"{self.db_url}/_utils", timeout=5)
           logging.info(f"CouchDB.wait_db_ready() got response code = {r.status_code}")          
           if r.status_code == 200:
+            self.db_ready = time.time()
             return True
         except Exception as e:
           logging.info(f"waiting since: {delta} seconds")
@@ -82,15 +153,7 @@ class CouchDB:
 
   def get_doc(self, database, id, user=None, password="", no_auth=False):
     url = f"{self.db_base}{database}/{id}"
-    session = req.Session()
-    if no_auth:
-      db_auth=None
-    elif user:
-      db_auth=req.auth.HTTPBasicAuth(user, password)
-    else:
-      db_auth = self.db_auth
-    session.auth =  db_auth 
-    r = session.get(url) 
+    r = self._session(user, password, no_auth).get(url)
     if r.status_code == 200:
       return json.loads(r.text)
     return None
@@ -107,6 +170,77 @@ class CouchDB:
       return r.status_code in [200,201]
     return False
 
+  # the current revisions of the documents with the given ids, leaving out the missing and deleted ones;
+  # None if the request failed
+  def get_revs(self, database, ids):
+    url = f"{self.db_base}{database}/_all_docs"
+    r = self.db_session.post(url, json={"keys": list(ids)})
+    if r.status_code != 200:
+      logging.warning(f"query to {url} failed with {r.status_code}. Body {r.text}")
+      return None
+    return {row["id"]: row["value"]["rev"] for row in r.json().get("rows", [])
+            if "value" in row and not row["value"].get("deleted")}
+
+  # create or update the documents with _id in one request, with their current revisions;
+  # the documents in conflict, changed in the meantime, are retried with their new revisions
+  # returns the status of each document by id: ok, or the error of couchdb
+  def bulk_update(self, database, docs, retries=BULK_RETRIES):
+    """
+    >>> class Response:
+    ...     def __init__(self, status_code, body): self.status_code, self.body, self.text = status_code, body, json.dumps(body)
+    ...     def json(self): return self.body
+    >>> class Couch:
+    ...     revs, calls = {"a": "1-x", "b": "1-x"}, []
+    ...     def post(self, url, json):
+    ...         self.calls.append(url.split("/")[-1])
+    ...         if url.endswith("_all_docs"):
+    ...             return Response(200, {"rows": [{"id": k, "value": {"rev": self.revs[k]}} if k in self.revs else {"key": k, "error": "not_found"} for k in json["keys"]]})
+    ...         res = []
+    ...         for doc in json["docs"]:
+    ...             if doc["_id"] == "b" and self.revs["b"] == "1-x": self.revs["b"] = "2-y"; res.append({"id": "b", "error": "conflict"})
+    ...             elif doc.get("_rev") != self.revs.get(doc["_id"]): res.append({"id": doc["_id"], "error": "conflict"})
+    ...             else: self.revs[doc["_id"]] = "3-z"; res.append({"id": doc["_id"], "rev": "3-z"})
+    ...         return Response(201, res)
+    >>> db = CouchDB(); db.db_session = Couch()
+    >>> db.bulk_update("subjects", [{"_id": "a"}, {"_id": "b"}, {"_id": "c"}, {"name": "no id"}])
+    {'a': 'ok', 'c': 'ok', 'b': 'ok'}
+    >>> db.db_session.calls
+    ['_all_docs', '_bulk_docs', '_all_docs', '_bulk_docs']
+    >>> db.bulk_update("subjects", [{"_id": "b"}], retries=0)
+    {'b': 'ok'}
+    """
+    status = {}
+    pending = [dict(doc) for doc in docs if '_id' in doc]
+    url = f"{self.db_base}{database}/_bulk_docs"
+    if not pending:
+      return status
+    for attempt in range(retries + 1):
+      revs = self.get_revs(database, [doc['_id'] for doc in pending])
+      if revs is None:
+        break
+      for doc in pending:
+        doc.pop('_rev', None)
+        if doc['_id'] in revs:
+          doc['_rev'] = revs[doc['_id']]
+      r = self.db_session.post(url, json={"docs": pending})
+      if r.status_code not in [201, 202]:
+        logging.warning(f"query to {url} failed with {r.status_code}. Body {r.text}")
+        break
+      by_id = {doc['_id']: doc for doc in pending}
+      pending = []
+      for row in r.json():
+        if "error" not in row:
+          status[row["id"]] = "ok"
+        elif row["error"] == "conflict" and attempt < retries:
+          pending.append(by_id[row["id"]])
+        else:
+          status[row["id"]] = row["error"]
+      if not pending:
+        return status
+    for doc in pending:
+      status[doc['_id']] = "failed"
+    return status
+
   def delete_doc(self, database, id):
     cur = self.get_doc(database, id)
     if cur and '_rev' in cur:
@@ -146,19 +280,59 @@ class CouchDB:
   def find_doc(self, database, selector, user=None, password="", no_auth=False):
     url = f"{self.db_base}{database}/_find"
     headers = {'Content-Type': 'application/json'}
-    session = req.Session()
-
-    if no_auth:
-      db_auth=None
-    elif user:
-      db_auth=req.auth.HTTPBasicAuth(user, password)
-    else:
-      db_auth = self.db_auth
-
-    session.auth=db_auth  
-    r = session.post(url, headers=headers, data=selector)
+    r = self._session(user, password, no_auth).post(url, headers=headers, data=selector)
     if r.status_code == 200:
       return json.loads(r.text)
     
     logging.warn(f"query to {url} failed with {r.status_code}. Body {r.text}")
-    return None    
\ No newline at end of file
+    return None    
+
+  # iterate over the documents matching the selector, asking them to _find a page at a time
+  # following the bookmarks, until a page comes back short; nothing is returned when the first
+  # page fails, as find_doc does, while a failure after it raises, so the results are never truncated
+  def find_iter(self, database, selector, page_size=FIND_PAGE_SIZE, fields=None, user=None, password="", no_auth=False):
+    """
+    >>> class Response:
+    ...     def __init__(self, body, status=200): self.status_code, self.text = status, json.dumps(body)
+    >>> class Couch:
+    ...     docs, queries, failing = [{"_id": str(i), "name": f"a{i}"} for i in range(5)], [], None
+    ...     def post(self, url, headers, data):
+    ...         query = json.loads(data); self.queries.append(query)
+    ...         start = int(query.get("bookmark", "0"))
+    ...         if start == self.failing: return Response({"error": "timeout"}, 500)
+    ...         page = [{k: d[k] for k in query.get("fields", d)} for d in self.docs[start:start + query["limit"]]]
+    ...         return Response({"docs": page, "bookmark": str(start + len(page))})
+    >>> db = CouchDB(); db.db_session = Couch()
+    >>> [d["name"] for d in db.find_iter("whisks", {"entityType": "action"}, page_size=2, fields=["name"])]
+    ['a0', 'a1', 'a2', 'a3', 'a4']
+    >>> [(q.get("bookmark"), q["limit"], q["fields"]) for q in db.db_session.queries]
+    [(None, 2, ['name']), ('2', 2, ['name']), ('4', 2, ['name'])]
+    >>> docs = db.find_iter("whisks", {"entityType": "action"}, page_size=5); next(docs)["_id"], len(db.db_session.queries)
+    ('0', 4)
+    >>> len(list(docs)), len(db.db_session.queries)
+    (4, 5)
+    >>> db.db_session.failing = 2; list(db.find_iter("whisks", {}, page_size=2))
+    Traceback (most recent call last):
+    ...
+    Exception: query to whisks failed after 2 documents
+    >>> db.db_session.failing = 0; list(db.find_iter("whisks", {}, page_size=2))
+    []
+    """
+    query = {"selector": selector, "limit": page_size}
+    if fields:
+      query["fields"] = list(fields)
+    count = 0
+    while True:
+      res = self.find_doc(database, json.dumps(query), user, password, no_auth)
+      if res is None:
+        if count == 0:
+          return
+        logging.error(f"query to {database} failed after {count} documents")
+        raise Exception(f"query to {database} failed after {count} documents")
+      docs = res.get("docs") or []
+      for doc in docs:
+        count += 1
+        yield doc
+      if len(docs) < page_size or not res.get("bookmark"):
+        return
+      query["bookmark"] = res["bookmark"]
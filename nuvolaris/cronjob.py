@@ -98,4 +98,5 @@ def patch(status, action, owner=None):
         if  action == 'create':
             status['whisk_create']['cron']='error'
         else:            
-            status['whisk_update']['cron']='error'        
\ No newline at end of file
+            status['whisk_update']['cron']='error'        
+        raise
\ No newline at end of file
@@ -0,0 +1,139 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module deploys the components as a graph of dependencies,
+# running concurrently the components whose dependencies are already deployed
+import os, time, logging, contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# default time for each component to be deployed, in seconds
+DEFAULT_TIMEOUT = int(os.environ.get("NUVOLARIS_DEPLOY_TIMEOUT", "1200"))
+# components deployed at the same time
+WORKERS = int(os.environ.get("NUVOLARIS_DEPLOY_WORKERS", "8"))
+
+class Step:
+    """
+    A component to deploy: fn is invoked when the steps in needs are deployed,
+    keys are the keys of the state set to on, off or error (default the name).
+    When fatal, its error is raised once all the other steps are done.
+    """
+    def __init__(self, name, fn, enabled=True, needs=[], keys=None, timeout=None, fatal=False):
+        self.name = name
+        self.fn = fn
+        self.enabled = enabled
+        self.needs = list(needs)
+        self.keys = keys or [name]
+        self.timeout = timeout or DEFAULT_TIMEOUT
+        self.fatal = fatal
+
+def _set(state, step, value):
+    for key in step.keys:
+        state[key] = value
+
+# deploy the steps updating the state, returning it
+# a step runs after the enabled steps it needs succeeded, it is marked as error if any of them failed;
+# a step not done within its timeout is marked as error (its thread is left to complete)
+def run(steps, state, workers=None):
+    """
+    >>> import time
+    >>> order = []
+    >>> def deploy(name, secs=0.05, fail=False):
+    ...     def fn():
+    ...         time.sleep(secs); order.append(name)
+    ...         if fail: raise Exception(f"{name} failed")
+    ...         return name
+    ...     return fn
+    >>> steps = [Step("couchdb", deploy("couchdb", 0.2)), Step("minio", deploy("minio", 0.05, True)),
+    ...          Step("openwhisk", deploy("openwhisk"), needs=["couchdb", "redis"], keys=["openwhisk", "endpoint"]),
+    ...          Step("redis", deploy("redis"), enabled=False), Step("static", deploy("static"), needs=["minio"]),
+    ...          Step("slow", deploy("slow", 1), timeout=0.1)]
+    >>> start = time.time()
+    >>> run(steps, {})
+    {'redis': 'off', 'minio': 'error', 'static': 'error', 'slow': 'error', 'couchdb': 'on', 'openwhisk': 'on', 'endpoint': 'on'}
+    >>> order, time.time() - start < 0.5
+    (['minio', 'couchdb', 'openwhisk'], True)
+    >>> run([Step("postgres", deploy("postgres", 0, True), fatal=True), Step("redis", deploy("redis", 0.1))], {})
+    Traceback (most recent call last):
+    ...
+    Exception: postgres failed
+    """
+    names = {s.name for s in steps}
+    pending = [s for s in steps]
+    ok = {}
+    running = {}
+    fatal = []
+    pool = ThreadPoolExecutor(workers or WORKERS, thread_name_prefix="deploy")
+
+    def finish(step, error=None, result=None):
+        ok[step.name] = error is None
+        if error is None:
+            _set(state, step, "on")
+            if result:
+                logging.info(result)
+        else:
+            _set(state, step, "error")
+            logging.error(f"cannot create {step.name}: {error}", exc_info=error)
+            if step.fatal:
+                fatal.append(error)
+
+    try:
+        while pending or running:
+            progressed = True
+            while progressed:
+                progressed = False
+                for step in list(pending):
+                    if not step.enabled:
+                        pending.remove(step)
+                        ok[step.name] = True
+                        _set(state, step, "off")
+                        progressed = True
+                        continue
+                    needs = [n for n in step.needs if n in names]
+                    if not all(n in ok for n in needs):
+                        continue
+                    pending.remove(step)
+                    progressed = True
+                    failed = [n for n in needs if not ok[n]]
+                    if failed:
+                        finish(step, Exception(f"{', '.join(failed)} not available"))
+                        continue
+                    logging.info(f"*** deploying {step.name}")
+                    # the context carries the handler metrics and the staging folder
+                    future = pool.submit(contextvars.copy_context().run, step.fn)
+                    running[future] = (step, time.time() + step.timeout)
+            if not running:
+                if pending:
+                    raise Exception(f"circular dependencies among {[s.name for s in pending]}")
+                continue
+            deadline = min(d for _, d in running.values())
+            done, _ = wait(list(running), timeout=max(0, deadline - time.time()), return_when=FIRST_COMPLETED)
+            for future in done:
+                step, _ = running.pop(future)
+                try:
+                    finish(step, result=future.result())
+                except Exception as e:
+                    finish(step, e)
+            now = time.time()
+            for future, (step, deadline) in list(running.items()):
+                if deadline <= now:
+                    running.pop(future)
+                    finish(step, TimeoutError(f"{step.name} not deployed in {step.timeout}s"))
+    finally:
+        pool.shutdown(wait=False)
+    if fatal:
+        raise fatal[0]
+    return state
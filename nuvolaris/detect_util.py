@@ -0,0 +1,212 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module caches the detection of the cluster: the node labels telling the kubernetes flavour
+# and the default storage class, with the values detected from them, are kept in a configmap
+# and probed again only when they expire or a watch reports a change of the nodes or storage classes
+import os, json, time, logging, threading
+import nuvolaris.config as cfg
+import nuvolaris.kube as kube
+import nuvolaris.informer as informer
+
+CONFIGMAP = "nuvolaris-detect"
+
+# seconds the detection is valid
+TTL = int(os.environ.get("NUVOLARIS_DETECT_TTL", "3600"))
+
+# label selector of the nodes to look at, all by default; the nodes are watched only when it is set
+NODE_SELECTOR = os.environ.get("NUVOLARIS_DETECT_NODE_SELECTOR", "")
+
+# parts of the node labels telling the kubernetes flavour, as checked by config.detect_labels
+MARKERS = ["eksctl.io", "k8s.io/cloud-provider-aws", "microk8s.io", "lke.linode.com", "node.openshift.io",
+           "kubernetes.io/instance-type", "cloud.google.com/gke", "kubernetes.azure.com"]
+
+DEFAULT_CLASS = "storageclass.kubernetes.io/is-default-class"
+DEFAULT_CLASS_BETA = "storageclass.beta.kubernetes.io/is-default-class"
+
+_lock = threading.Lock()
+_entry = None
+_invalidated = 0
+_seen = {}
+
+# the node labels read by the detection
+def project(labels):
+    """
+    >>> project({"nuvolaris.io/hello": "world", "kubernetes.io/hostname": "node1", "microk8s.io/cluster": "true"})
+    {'microk8s.io/cluster': 'true', 'nuvolaris.io/hello': 'world'}
+    """
+    return {k: v for k, v in sorted((labels or {}).items())
+            if k.startswith("nuvolaris.io/") or any(m in k for m in MARKERS)}
+
+# the distinct projections of the node labels, so that a pool of alike nodes counts once
+def node_labels(labels):
+    """
+    >>> node_labels([{"eksctl.io/cluster": "a", "kubernetes.io/hostname": "n1"}, {"eksctl.io/cluster": "a"}, {}])
+    [{'eksctl.io/cluster': 'a'}, {}]
+    """
+    res = []
+    for projection in [project(l) for l in labels]:
+        if projection not in res:
+            res.append(projection)
+    return res
+
+# the default storage classes as {"name", "provisioner"}, the ones marked with the ga annotation first
+def default_storages(classes):
+    """
+    >>> classes = [{"metadata": {"name": "slow", "annotations": {DEFAULT_CLASS_BETA: "true"}}, "provisioner": "nfs"},
+    ...            {"metadata": {"name": "fast"}, "provisioner": "ebs"},
+    ...            {"metadata": {"name": "gp2", "annotations": {DEFAULT_CLASS: "true"}}, "provisioner": "ebs"}]
+    >>> default_storages(classes)
+    [{'name': 'gp2', 'provisioner': 'ebs'}, {'name': 'slow', 'provisioner': 'nfs'}]
+    """
+    res = []
+    for annotation in [DEFAULT_CLASS, DEFAULT_CLASS_BETA]:
+        for sc in classes:
+            if sc.get("metadata", {}).get("annotations", {}).get(annotation) == "true":
+                res.append({"name": sc["metadata"]["name"], "provisioner": sc.get("provisioner")})
+    return res
+
+# the labels of the nodes, listing only their metadata through the api,
+# with kubectl when the api is not available
+def _node_labels():
+    if not kube.mocker.enabled:
+        try:
+            api = informer.default_api()
+            items = api.list_objects(api.resource("nodes"), None, NODE_SELECTOR or None, metadata_only=True)["items"]
+            return [i.get("metadata", {}).get("labels") or {} for i in items]
+        except Exception as e:
+            logging.warning(f"cannot list the nodes metadata, using kubectl: {e}")
+    args = ["get", "nodes"] + (NODE_SELECTOR and ["-l", NODE_SELECTOR] or [])
+    return kube.kubectl(*args, jsonpath="{.items[*].metadata.labels}")
+
+# the inputs of the detection, read from the cluster
+def probe():
+    labels = _node_labels()
+    classes = kube.kubectl("get", "storageclass", jsonpath="{.items[*]}")
+    return {
+        "detected": time.time(),
+        "labels": node_labels(labels if isinstance(labels, list) else []),
+        "storages": default_storages(classes if isinstance(classes, list) else [])
+    }
+
+def _load():
+    cm = kube.get(f"cm/{CONFIGMAP}")
+    try:
+        return json.loads(cm["data"]["detect.json"])
+    except Exception:
+        return None
+
+def _save(entry):
+    try:
+        kube.apply(kube.configMap(CONFIGMAP, **{"detect.json": json.dumps(entry)}))
+    except Exception as e:
+        logging.warning(f"cannot save cm/{CONFIGMAP}: {e}")
+    logging.info(f"*** detected {entry['values']}")
+
+def _valid(entry):
+    if not isinstance(entry, dict) or "labels" not in entry or "storages" not in entry:
+        return False
+    return entry.get("detected", 0) > max(_invalidated, time.time() - TTL)
+
+# the detection, from memory, from the configmap or probed again when expired
+def cached():
+    global _entry
+    with _lock:
+        if _valid(_entry):
+            return _entry
+        entry = _load()
+        if not _valid(entry):
+            entry = probe()
+            # the values detected without any configuration, recorded for the people reading the configmap
+            with cfg.scope({"nuvolaris": {"kube": "auto"}}):
+                cfg.detect_storage(entry["storages"])
+                cfg.detect_labels(entry["labels"] or [{}])
+                entry["values"] = cfg.getall("nuvolaris")
+            _save(entry)
+        _entry = entry
+        return entry
+
+# forget the detection, it will be probed again at the next use
+def invalidate(reason):
+    global _invalidated
+    with _lock:
+        _invalidated = time.time()
+    logging.info(f"*** cluster detection invalidated: {reason}")
+
+# the part of the watched objects read by the detection
+def _projection(obj):
+    if obj.get("kind") == "StorageClass":
+        return default_storages([obj])
+    return project(obj.get("metadata", {}).get("labels"))
+
+# invalidate the detection when the projection of a node or a storage class changes,
+# ignoring the objects listed when the watch starts and the updates of the node status;
+# returns true when the detection was invalidated
+def _on_event(event_type, obj):
+    """
+    >>> node = {"kind": "Node", "metadata": {"name": "n1", "labels": {"microk8s.io/cluster": "true"}}}
+    >>> _on_event("ADDED", node)
+    False
+    >>> node["status"] = {"conditions": []}; _on_event("MODIFIED", node)
+    False
+    >>> node["metadata"]["labels"]["nuvolaris.io/hello"] = "world"; _on_event("MODIFIED", node)
+    True
+    >>> _on_event("DELETED", node), _on_event("DELETED", node)
+    (True, False)
+    """
+    key = (obj.get("kind"), obj.get("metadata", {}).get("name"))
+    projection = None if event_type == "DELETED" else _projection(obj)
+    previous = _seen.get(key, projection)
+    if projection is None:
+        _seen.pop(key, None)
+    else:
+        _seen[key] = projection
+    if projection == previous:
+        return False
+    invalidate(f"{key[0]} {key[1]} {event_type.lower()}")
+    return True
+
+# watch the storage classes and, when selected, the metadata of the nodes, started with the informers;
+# without a selector the changes of the nodes are seen when the detection expires
+def start(api=None):
+    if NODE_SELECTOR:
+        informer.watch("nodes", _on_event, label_selector=NODE_SELECTOR, api=api, metadata_only=True)
+    informer.watch("storageclasses", _on_event, api=api)
+
+# detect the cluster in the current configuration, as config.detect does, using the cached inputs
+def detect():
+    """
+    >>> kube.mocker.reset()
+    >>> kube.mocker.config("get nodes", [{"kubernetes.io/hostname": "n1", "k8s.io/cloud-provider-aws": "x"}])
+    >>> kube.mocker.config("get storageclass", [{"metadata": {"name": "gp2", "annotations": {DEFAULT_CLASS: "true"}}, "provisioner": "ebs"}])
+    >>> kube.mocker.config("get cm/nuvolaris-detect", "{}")
+    >>> kube.mocker.config("apply", "configmap/nuvolaris-detect created")
+    >>> cfg.clean(); _ = cfg.configure({"nuvolaris": {"kube": "auto", "storageclass": "auto"}}); detect()
+    >>> cfg.get("nuvolaris.kube"), cfg.get("nuvolaris.storageclass"), cfg.get("nuvolaris.provisioner")
+    ('eks', 'gp2', 'ebs')
+    >>> [cmd for cmd, _ in kube.mocker.queue]
+    ['get cm/nuvolaris-detect -ojson', 'get nodes', 'get storageclass', 'apply -f -']
+    >>> cfg.clean(); _ = cfg.configure({"nuvolaris": {"kube": "kind"}}); detect(); len(kube.mocker.queue)
+    4
+    >>> cfg.get("nuvolaris.kube"), cfg.get("nuvolaris.storageclass")
+    ('kind', 'gp2')
+    >>> kube.mocker.reset()
+    """
+    entry = cached()
+    cfg.detect_storage(entry["storages"])
+    cfg.detect_labels(entry["labels"] or [{}])
+    cfg.detect_env()
@@ -0,0 +1,178 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module computes a digest of the inputs of each component: the slice of the configuration
+# it reads and the deploy folders and templates its manifests are rendered from
+# the digests of the applied components are stored in status.digests of the whisk,
+# so that resume and update re-run only the components whose inputs changed
+import os, json, hashlib
+import nuvolaris.config as cfg
+
+# configuration read by all the components
+COMMON = ["nuvolaris", "operator.image"]
+
+# templates attached to the manifests of most components
+ATTACH = ["set-attach.yaml", "security-set-attach.yaml", "security-dep-attach.yaml",
+          "affinity-tolerance-sts-core-attach.yaml", "affinity-tolerance-dep-core-attach.yaml"]
+
+# for each component: configuration prefixes, deploy folders and templates
+INPUTS = {
+    "preloader": (["components.openwhisk"], ["runtimes"], ["runtimes-job-container-attach.yaml"]),
+    "couchdb": (["components.couchdb", "couchdb"], ["couchdb"], ["couchdb-init.yaml", "couchdb-set-tpl.yaml"]),
+    "redis": (["components.redis", "redis"], ["redis"], ["redis-conf.yaml", "redis-set.yaml", "redis_manage_user_tpl.txt"]),
+    "issuer": (["components.tls", "tls"], ["issuer"], ["cluster-issuer.yaml"]),
+    "cron": (["components.cron", "scheduler", "controller", "couchdb"], ["scheduler"], ["cron-init.yaml"]),
+    "minio": (["components.minio", "minio"], ["minio"], ["00-minio-pvc.yaml", "01-minio-dep.yaml", "02-minio-svc.yaml"]),
+    "static": (["components.static", "minio"], ["nginx-static"], ["nginx-static-cm.yaml", "nginx-static-sts.yaml"]),
+    "postgres": (["components.postgres", "postgres"], ["postgres-operator", "postgres-operator-deploy", "postgres-backup"],
+                 ["postgres.yaml", "postgres-backup-sts.yaml"]),
+    "mongodb": (["components.mongodb", "mongodb", "postgres"], ["ferretdb"], ["ferretdb-sts.yaml"]),
+    "openwhisk": (["components.openwhisk", "components.invoker", "components.kafka", "components.tls",
+                   "openwhisk", "controller", "invoker", "configs", "couchdb", "kafka", "tls"],
+                  ["openwhisk-standalone"], ["standalone-sts.yaml", "generic-ingress-tpl.yaml",
+                  "generic-openshift-route-tpl.yaml", "traefik-middleware-tpl.yaml"]),
+    "whisk-system": (["components.openwhisk", "components.minio", "components.static", "openwhisk", "couchdb", "minio"],
+                     ["whisk-system"], ["whisk-system-manifest-tpl.yaml"])
+}
+
+TEMPLATES = "nuvolaris/templates"
+
+# files generated in the deploy folders are not inputs
+def _generated(file):
+    return file.startswith("__") or file == "kustomization.yaml"
+
+def _update_folder(h, dir):
+    if not os.path.isdir(dir):
+        return
+    for file in sorted(os.listdir(dir)):
+        path = f"{dir}/{file}"
+        if _generated(file) or not os.path.isfile(path):
+            continue
+        h.update(file.encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+
+def _update_file(h, path):
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(b"\0")
+
+# the configuration read by the component
+def config_slice(name):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"redis": True, "couchdb": True}, "redis": {"volume-size": 10},
+    ...     "couchdb": {"host": "couchdb"}, "nuvolaris": {"kube": "kind"}, "state": {"redis": {"spec": "..."}}})
+    True
+    >>> config_slice("redis")
+    {'components.redis': True, 'nuvolaris.kube': 'kind', 'redis.volume-size': 10}
+    """
+    prefixes = COMMON + INPUTS[name][0]
+    return {k: v for k, v in sorted(cfg.getall().items())
+            if any(k == p or k.startswith(p + ".") for p in prefixes)}
+
+# digest of the inputs of the component
+def digest(name):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"redis": True}, "redis": {"volume-size": 10}})
+    True
+    >>> d = digest("redis")
+    >>> len(d), d == digest("redis"), d == digest("couchdb")
+    (16, True, False)
+    >>> _ = cfg.put("redis.volume-size", 20); d2 = digest("redis"); d == d2
+    False
+    >>> _ = cfg.put("state.redis.spec", "..."), cfg.put("couchdb.host", "couchdb"); digest("redis") == d2
+    True
+    """
+    folders, templates = INPUTS[name][1:]
+    h = hashlib.sha256()
+    h.update(json.dumps(config_slice(name), sort_keys=True, default=str).encode("utf-8"))
+    for folder in folders:
+        _update_folder(h, f"deploy/{folder}")
+    for template in templates + ATTACH:
+        _update_file(h, f"{TEMPLATES}/{template}")
+    return h.hexdigest()[:16]
+
+# recorded in place of the digest of a component that failed, so that it is always changed
+FAILED = "failed"
+
+# digests of the components that are on in the state of a deploy, FAILED for the ones in error
+def applied(state):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"redis": True}})
+    True
+    >>> res = applied({"redis": "on", "couchdb": "error", "minio": "off", "whisk-system": "on", "kafka": "on"})
+    >>> sorted(res), res["couchdb"]
+    (['couchdb', 'redis', 'whisk-system'], 'failed')
+    """
+    res = {}
+    for name, value in state.items():
+        if name in INPUTS and value in ["on", "error"]:
+            res[name] = value == "on" and digest(name) or FAILED
+    return res
+
+# the applied components whose inputs changed
+def changed(digests):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"redis": True, "couchdb": True}})
+    True
+    >>> digests = applied({"redis": "on", "couchdb": "on"})
+    >>> changed(digests)
+    []
+    >>> _ = cfg.put("redis.volume-size", 20); changed(digests)
+    ['redis']
+    >>> changed({"couchdb": FAILED})
+    ['couchdb']
+    """
+    return [name for name, value in digests.items() if name in INPUTS and digest(name) != value]
+
+# configuration enabling each component, when not components.<name>
+ENABLED_BY = {
+    "preloader": ["components.openwhisk"],
+    "issuer": ["components.tls"],
+    "postgres": ["components.postgres", "components.mongodb"],
+    "whisk-system": ["components.openwhisk"]
+}
+
+def enabled(name):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"mongodb": True, "tls": True}})
+    True
+    >>> enabled("postgres"), enabled("issuer"), enabled("redis")
+    (True, True, False)
+    """
+    return any(cfg.get(key) for key in ENABLED_BY.get(name, [f"components.{name}"]))
+
+# the digests after the given components are patched: they get the current digest
+# if they are still enabled, FAILED if they failed, so that they are patched again later
+def patched(digests, names, failed=[]):
+    """
+    >>> cfg.clean(); cfg.configure({"components": {"redis": True, "cron": True}})
+    True
+    >>> digests = {"redis": "old", "cron": "old", "minio": "old", "couchdb": "old"}
+    >>> res = patched(digests, ["redis", "cron", "minio"], failed=["cron"])
+    >>> sorted(res.items()) == [("couchdb", "old"), ("cron", FAILED), ("redis", digest("redis"))]
+    True
+    >>> "cron" in changed(res)
+    True
+    """
+    res = {k: v for k, v in digests.items() if k not in names}
+    for name in names:
+        if name in INPUTS and enabled(name):
+            res[name] = name in failed and FAILED or digest(name)
+    return res
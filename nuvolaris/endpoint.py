@@ -279,6 +279,7 @@ def patch(status, action, owner=None):
             status['whisk_create']['endpoint']='error'
         else:            
             status['whisk_update']['endpoint']='error'  
+        raise
 
 def create_ow_api_endpoint(ucfg, user_metadata: UserMetadata, owner=None):
     """
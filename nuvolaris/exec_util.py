@@ -0,0 +1,94 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module executes scripts inside pods streaming them over the stdin
+# of a single kubectl exec session, without copying files in the pod
+import logging
+import shlex
+import uuid
+import nuvolaris.kube as kube
+
+# build a bash program feeding each script to its command with a quoted heredoc
+# scripts is a list of (command, script) and env a dictionary of variables to export
+def build_program(scripts, env={}):
+    """
+    >>> print(build_program([("redis-cli", "ACL LIST")], {"A": "it's"}), end="")
+    set -e
+    export A='it'"'"'s'
+    redis-cli <<'__NUV_EOF_0__'
+    ACL LIST
+    __NUV_EOF_0__
+    """
+    lines = ["set -e"]
+    for key, value in env.items():
+        lines.append(f"export {key}={shlex.quote(str(value))}")
+    for n, (command, script) in enumerate(scripts):
+        marker = f"__NUV_EOF_{n}__"
+        while marker in script:
+            marker = f"__NUV_EOF_{uuid.uuid4().hex}__"
+        lines.append(f"{command} <<'{marker}'")
+        lines.append(script.rstrip("\n"))
+        lines.append(marker)
+    return "\n".join(lines) + "\n"
+
+# execute the scripts one after the other in the same exec session, stopping at the first failure
+def exec_scripts(pod_name, scripts, env={}, namespace="nuvolaris"):
+    """
+    >>> import nuvolaris.kube as kube
+    >>> kube.mocker.reset(); kube.mocker.config("exec", "OK")
+    >>> exec_scripts("redis-0", [("redis-cli", "PING")])
+    'OK'
+    >>> kube.mocker.peek()
+    'exec -i redis-0 -- /bin/bash -s'
+    >>> print(kube.mocker.dump(), end="")
+    set -e
+    redis-cli <<'__NUV_EOF_0__'
+    PING
+    __NUV_EOF_0__
+    >>> kube.mocker.reset()
+    """
+    logging.info(f"streaming {len(scripts)} scripts to pod {pod_name}")
+    program = build_program(scripts, env)
+    return kube.kubectl("exec", "-i", pod_name, "--", "/bin/bash", "-s", namespace=namespace, input=program)
+
+# execute a single script reading it from the stdin of command
+def exec_script(pod_name, command, script, env={}, namespace="nuvolaris"):
+    return exec_scripts(pod_name, [(command, script)], env, namespace)
+
+# extract the password from a .pgpass line (host:port:database:username:password)
+def pgpass_password(pgpass):
+    """
+    >>> pgpass_password("# comment\\nlocalhost:5432:postgres:postgres:s3cr\\\\:et\\n")
+    's3cr:et'
+    """
+    for line in pgpass.splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        fields, cur, escaped = [], "", False
+        for c in line:
+            if escaped:
+                cur += c
+                escaped = False
+            elif c == "\\":
+                escaped = True
+            elif c == ":" and len(fields) < 4:
+                fields.append(cur)
+                cur = ""
+            else:
+                cur += c
+        return cur
+    return None
@@ -0,0 +1,103 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module runs the blocking work of the async kopf handlers in bounded thread pools,
+# one for each backend, so that a slow backend cannot starve the event loop or the other backends
+import os, asyncio, logging, threading, contextvars, functools, weakref
+from concurrent.futures import ThreadPoolExecutor
+
+# threads of the pool of each backend
+SIZES = {
+    "kube": int(os.environ.get("NUVOLARIS_POOL_KUBE", "16")),
+    "couchdb": int(os.environ.get("NUVOLARIS_POOL_COUCHDB", "8")),
+    "minio": int(os.environ.get("NUVOLARIS_POOL_MINIO", "4")),
+    "exec": int(os.environ.get("NUVOLARIS_POOL_EXEC", "8"))
+}
+
+# handlers running at the same time, the others wait for their turn
+CONCURRENCY = int(os.environ.get("NUVOLARIS_HANDLER_CONCURRENCY", "32"))
+
+_lock = threading.Lock()
+_pools = {}
+_limits = weakref.WeakKeyDictionary()
+
+# the pool of the backend, created at the first use
+def pool(backend):
+    """
+    >>> pool("kube") is pool("kube"), pool("kube")._max_workers == SIZES["kube"]
+    (True, True)
+    >>> pool("ftp")
+    Traceback (most recent call last):
+    ...
+    Exception: unknown executor pool ftp
+    """
+    with _lock:
+        if backend not in _pools:
+            if backend not in SIZES:
+                raise Exception(f"unknown executor pool {backend}")
+            _pools[backend] = ThreadPoolExecutor(SIZES[backend], thread_name_prefix=f"pool-{backend}")
+        return _pools[backend]
+
+# run fn in the pool of the backend, awaiting its result
+# the context carries the handler metrics and the staging folder
+async def run(backend, fn, *args, **kwargs):
+    """
+    >>> import threading
+    >>> asyncio.run(run("couchdb", lambda x: (x, threading.current_thread().name.split("_")[0]), 1))
+    (1, 'pool-couchdb')
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+    return await loop.run_in_executor(pool(backend), call)
+
+# the semaphore limiting the handlers in the running loop
+def _limit():
+    loop = asyncio.get_running_loop()
+    with _lock:
+        if loop not in _limits:
+            _limits[loop] = asyncio.Semaphore(CONCURRENCY)
+        return _limits[loop]
+
+# decorator for the async kopf handlers: at most CONCURRENCY of them run at the same time
+def limited(fn):
+    """
+    >>> running, peak = [0], [0]
+    >>> @limited
+    ... async def handler(n):
+    ...     running[0] += 1; peak[0] = max(peak[0], running[0])
+    ...     await asyncio.sleep(0.01)
+    ...     running[0] -= 1
+    ...     return n
+    >>> async def resume(n):
+    ...     return await asyncio.gather(*[handler(i) for i in range(n)])
+    >>> asyncio.run(resume(CONCURRENCY * 3))[-1] == CONCURRENCY * 3 - 1, peak[0] == CONCURRENCY
+    (True, True)
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        async with _limit():
+            return await fn(*args, **kwargs)
+    return wrapper
+
+# stop the pools, waiting for the running calls
+def shutdown():
+    with _lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for p in pools:
+        p.shutdown(wait=True)
+    logging.info(f"stopped {len(pools)} executor pools")
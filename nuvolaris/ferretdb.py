@@ -141,6 +141,7 @@ def patch(status, action, owner=None):
             status['whisk_create']['ferretdb']='error'
         else:            
             status['whisk_update']['ferretdb']='error'              
+        raise
 
 def _add_mdb_user_metadata(user_metadata, data):
     """
@@ -180,12 +181,12 @@ def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
         data["password"]=ucfg.get('mongodb.password')
         data["mode"]="create"
         
-        path_to_pgpass = postgres.render_postgres_script(f"{namespace}_ferretdb","pgpass_tpl.properties",data)
-        path_to_mdb_script = postgres.render_postgres_script(f"{namespace}_ferretdb","postgres_manage_user_tpl.sql",data)
+        pgpass = postgres.render_postgres_script("pgpass_tpl.properties",data)
+        psql_script = postgres.render_postgres_script("postgres_manage_user_tpl.sql",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.app == 'nuvolaris-postgres')].metadata.name}")      
 
         if(pod_name):
-            res = postgres.exec_psql_command(pod_name,path_to_mdb_script,path_to_pgpass)
+            res = postgres.exec_psql_command(pod_name,pgpass,psql_script)
 
             if res:
                 _add_mdb_user_metadata(user_metadata, data)
@@ -207,12 +208,12 @@ def delete_db_user(namespace, database):
         data["username"]=f"{namespace}_ferretdb"
         data["mode"]="delete"
 
-        path_to_pgpass = postgres.render_postgres_script(f"{namespace}_ferretdb","pgpass_tpl.properties",data)
-        path_to_mdb_script = postgres.render_postgres_script(f"{namespace}_ferretdb","postgres_manage_user_tpl.sql",data)
+        pgpass = postgres.render_postgres_script("pgpass_tpl.properties",data)
+        psql_script = postgres.render_postgres_script("postgres_manage_user_tpl.sql",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.app == 'nuvolaris-postgres')].metadata.name}")
 
         if(pod_name):
-            res = postgres.exec_psql_command(pod_name,path_to_mdb_script,path_to_pgpass)
+            res = postgres.exec_psql_command(pod_name,pgpass,psql_script)
             return res 
 
         return None
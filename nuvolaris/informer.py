@@ -0,0 +1,525 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module keeps an in memory copy of the pods, services, configmaps and statefulsets
+# of the nuvolaris namespace, listing them once and then following a watch,
+# so that the lookups in nuvolaris.util do not need a kubectl call each
+import os, json, time, logging, threading
+import nuvolaris.kube as kube
+import nuvolaris.jsonpath_util as jp
+import nuvolaris.yaml_util as yu
+
+# resources followed by default
+WATCHED = ["pods", "services", "configmaps", "statefulsets"]
+
+ALIASES = {
+    "po": "pods", "pod": "pods",
+    "svc": "services", "service": "services",
+    "cm": "configmaps", "configmap": "configmaps",
+    "sts": "statefulsets", "statefulset": "statefulsets"
+}
+
+# after a write the cache is not used until the watch catches up, at most for this time
+WRITE_GRACE = 2.0
+
+KINDS = {"Pod": "pods", "Service": "services", "ConfigMap": "configmaps", "StatefulSet": "statefulsets"}
+
+class Gone(Exception):
+    pass
+
+def _requirement(labels, req):
+    req = req.strip()
+    for op in [" notin ", " in "]:
+        if op in req:
+            key, _, values = req.partition(op)
+            values = [v.strip() for v in values.strip().strip("()").split(",")]
+            present = labels.get(key.strip()) in values
+            return present if op == " in " else not present
+    for op in ["!=", "==", "="]:
+        if op in req:
+            key, _, value = req.partition(op)
+            matches = labels.get(key.strip()) == value.strip().strip("\"'")
+            return not matches if op == "!=" else matches
+    if req.startswith("!"):
+        return req[1:].strip() not in labels
+    return req in labels
+
+# split a selector on commas not inside parenthesis
+def _requirements(selector):
+    res, depth, cur = [], 0, ""
+    for c in selector:
+        if c == "(": depth += 1
+        elif c == ")": depth -= 1
+        if c == "," and depth == 0:
+            res.append(cur)
+            cur = ""
+        else:
+            cur += c
+    return [r for r in res + [cur] if r.strip()]
+
+# check the labels against a kubectl label selector
+def match_selector(labels, selector):
+    """
+    >>> labels = {"app": "nuvolaris-postgres", "replicationRole": "primary"}
+    >>> match_selector(labels, "app=nuvolaris-postgres")
+    True
+    >>> match_selector(labels, "app=nuvolaris-postgres,replicationRole!=primary")
+    False
+    >>> match_selector(labels, 'app="nuvolaris-postgres"')
+    True
+    >>> match_selector(labels, "replicationRole in (primary, replica),!missing")
+    True
+    >>> match_selector(labels, "app notin (redis)"), match_selector(labels, "missing")
+    (True, False)
+    >>> match_selector(labels, None)
+    True
+    """
+    if not selector:
+        return True
+    labels = labels or {}
+    return all(_requirement(labels, r) for r in _requirements(selector))
+
+# an informer follows one resource type in one namespace
+# listeners are invoked with (event_type, object) for each change
+class Informer:
+    """
+    >>> inf = Informer(None, "pods", "nuvolaris")
+    >>> inf.dispatch("ADDED", {"metadata": {"name": "redis-0", "resourceVersion": "1", "labels": {"name": "redis"}}})
+    >>> inf.dispatch("ADDED", {"metadata": {"name": "couchdb-0", "resourceVersion": "2", "labels": {"name": "couchdb"}}})
+    >>> [o["metadata"]["name"] for o in inf.list()]
+    ['couchdb-0', 'redis-0']
+    >>> [o["metadata"]["name"] for o in inf.list("name=redis")]
+    ['redis-0']
+    >>> inf.dispatch("DELETED", {"metadata": {"name": "redis-0", "resourceVersion": "3"}})
+    >>> inf.get("redis-0") is None, inf.resource_version
+    (True, '3')
+    """
+    def __init__(self, api, resource, namespace, field_selector=None, label_selector=None, keep=True, metadata_only=False):
+        self.api = api
+        self.resource = resource
+        self.namespace = namespace
+        self.field_selector = field_selector
+        self.label_selector = label_selector
+        # when true only the metadata of the objects are listed and watched
+        self.metadata_only = metadata_only
+        # when false the objects are not kept, the informer only feeds its listeners
+        self.keep = keep
+        self.objects = {}
+        self.resource_version = None
+        self.synced = threading.Event()
+        self.listeners = []
+        self.last_event = 0
+        # writes of ours not yet seen by the watch, by object name (None when unknown)
+        self.pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._response = None
+
+    def add_listener(self, fn):
+        self.listeners.append(fn)
+
+    def remove_listener(self, fn):
+        if fn in self.listeners:
+            self.listeners.remove(fn)
+
+    def get(self, name):
+        with self._lock:
+            return self.objects.get(name)
+
+    def list(self, selector=None):
+        with self._lock:
+            objs = [self.objects[k] for k in sorted(self.objects)]
+        return [o for o in objs if match_selector(o.get("metadata", {}).get("labels"), selector)]
+
+    # a write of the object is starting: the cache does not answer for it until the watch sees the write
+    def write_started(self, name):
+        with self._lock:
+            obj = self.objects.get(name) if name else None
+            before = obj and obj.get("metadata", {}).get("resourceVersion")
+            self.pending[name] = {"since": time.time(), "before": before, "version": None}
+
+    # the write completed, with the resourceVersion returned for the object when the backend gives it
+    def write_done(self, name, version=None):
+        with self._lock:
+            write = self.pending.get(name)
+            if write is None:
+                return
+            write["version"] = version
+            obj = self.objects.get(name) if name else None
+            if version and obj and _seen(obj.get("metadata", {}).get("resourceVersion"), version):
+                self.pending.pop(name, None)
+
+    # the cache can answer, for the named object or for all of them, when in sync
+    # and not waiting for a write of ours to come back; the writes are waited at most WRITE_GRACE
+    def usable(self, name=None):
+        """
+        >>> inf = Informer(None, "services", "nuvolaris"); inf.synced.set()
+        >>> inf.dispatch("ADDED", {"metadata": {"name": "redis", "resourceVersion": "10"}})
+        >>> inf.write_started("redis"); inf.write_done("redis", "12")
+        >>> inf.dispatch("MODIFIED", {"metadata": {"name": "couchdb", "resourceVersion": "11"}})
+        >>> inf.usable("redis"), inf.usable("couchdb"), inf.usable()
+        (False, True, False)
+        >>> inf.dispatch("MODIFIED", {"metadata": {"name": "redis", "resourceVersion": "12"}})
+        >>> inf.usable("redis"), inf.usable()
+        (True, True)
+        >>> inf.write_started("redis"); inf.write_done("redis")
+        >>> inf.usable("redis")
+        False
+        >>> inf.dispatch("MODIFIED", {"metadata": {"name": "redis", "resourceVersion": "13"}}); inf.usable("redis")
+        True
+        """
+        if not self.synced.is_set():
+            return False
+        now = time.time()
+        with self._lock:
+            for key, write in list(self.pending.items()):
+                if now - write["since"] > WRITE_GRACE:
+                    self.pending.pop(key)
+            if name is None:
+                return not self.pending
+            return name not in self.pending and None not in self.pending
+
+    def dispatch(self, event_type, obj):
+        meta = obj.get("metadata", {})
+        with self._lock:
+            if event_type == "DELETED":
+                self.objects.pop(meta.get("name"), None)
+            elif event_type != "BOOKMARK" and self.keep:
+                self.objects[meta.get("name")] = obj
+            self.resource_version = meta.get("resourceVersion", self.resource_version)
+            self.last_event = time.time()
+            write = self.pending.get(meta.get("name"))
+            if write is not None and event_type != "BOOKMARK":
+                version = meta.get("resourceVersion")
+                # the version returned by the write, or without it the first change after the write started
+                if write["version"] and _seen(version, write["version"]) or \
+                   not write["version"] and version != write["before"]:
+                    self.pending.pop(meta.get("name"))
+        if event_type == "BOOKMARK":
+            return
+        for fn in list(self.listeners):
+            try:
+                fn(event_type, obj)
+            except Exception as e:
+                logging.warning(f"informer {self.resource} listener failed: {e}")
+
+    def _params(self, **kwargs):
+        params = dict(kwargs)
+        if self.field_selector:
+            params["fieldSelector"] = self.field_selector
+        if self.label_selector:
+            params["labelSelector"] = self.label_selector
+        return params
+
+    def _headers(self, watch=False):
+        """
+        >>> Informer(None, "nodes", None)._headers() is None
+        True
+        >>> Informer(None, "nodes", None, metadata_only=True)._headers(watch=True)["Accept"].split(";")[1]
+        'as=PartialObjectMetadata'
+        """
+        if not self.metadata_only:
+            return None
+        import nuvolaris.kube_api as kube_api
+        return {"Accept": watch and kube_api.METADATA_WATCH or kube_api.METADATA_LIST}
+
+    # the objects have the kind of the resource, also when only their metadata are read
+    def _typed(self, res, obj):
+        if self.metadata_only:
+            obj["apiVersion"], obj["kind"] = res.group_version, res.kind
+        obj.setdefault("apiVersion", res.group_version)
+        obj.setdefault("kind", res.kind)
+        return obj
+
+    def _relist(self):
+        res = self.api.resource(self.resource)
+        data = self.api._check(self.api.request("GET", res.path(self.namespace), params=self._params(),
+                                                headers=self._headers())).json()
+        items = {i["metadata"]["name"]: i for i in data.get("items", [])}
+        with self._lock:
+            removed = [o for n, o in self.objects.items() if n not in items]
+        for obj in removed:
+            self.dispatch("DELETED", obj)
+        for obj in items.values():
+            self._typed(res, obj)
+            self.dispatch("MODIFIED" if self.get(obj["metadata"]["name"]) else "ADDED", obj)
+        self.resource_version = data.get("metadata", {}).get("resourceVersion")
+        self.synced.set()
+
+    def _watch(self):
+        res = self.api.resource(self.resource)
+        params = self._params(watch="1", allowWatchBookmarks="true", timeoutSeconds="300",
+                              resourceVersion=self.resource_version)
+        r = self.api.request("GET", res.path(self.namespace), params=params, stream=True, timeout=(10, 330),
+                             headers=self._headers(watch=True))
+        self._response = r
+        try:
+            if r.status_code == 410:
+                raise Gone()
+            self.api._check(r)
+            for line in r.iter_lines():
+                if self._stop.is_set():
+                    return
+                if not line:
+                    continue
+                event = json.loads(line)
+                obj = event.get("object", {})
+                if event.get("type") == "ERROR":
+                    if obj.get("code") == 410:
+                        raise Gone()
+                    raise Exception(obj.get("message", "watch error"))
+                self.dispatch(event.get("type"), self._typed(res, obj))
+        finally:
+            r.close()
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                if self.resource_version is None:
+                    self._relist()
+                self._watch()
+                backoff = 1
+            except Gone:
+                logging.debug(f"informer {self.resource} expired, relisting")
+                self.resource_version = None
+            except Exception as e:
+                if self._stop.is_set():
+                    return
+                logging.warning(f"informer {self.resource} disconnected: {e}")
+                self.synced.clear()
+                self.resource_version = None
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"informer-{self.resource}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.synced.clear()
+        if self._response is not None:
+            try: self._response.close()
+            except Exception: pass
+
+_informers = {}
+
+def _resource(kind):
+    return ALIASES.get(kind, kind)
+
+# true if the version is the expected one or a later one; versions are compared as numbers
+# when they are, as the api server gives them, otherwise only for equality
+def _seen(version, expected):
+    """
+    >>> _seen("12", "12"), _seen("13", "12"), _seen("11", "12"), _seen("b", "a"), _seen(None, "1")
+    (True, True, False, False, False)
+    """
+    if version is None:
+        return False
+    if version.isdigit() and expected.isdigit():
+        return int(version) >= int(expected)
+    return version == expected
+
+# the (resource, name) written by a kubectl call, name None when it is not known
+def written(args, input=None):
+    """
+    >>> written(["annotate", "cm/config", "--overwrite", "a=b"])
+    [('configmaps', 'config')]
+    >>> written(["delete", "pods", "-l", "app=redis"]), written(["scale", "sts", "couchdb", "redis"])
+    ([('pods', None)], [('statefulsets', 'couchdb'), ('statefulsets', 'redis')])
+    >>> written(["apply", "-f", "-"], '{"kind": "List", "items": [{"kind": "Service", "metadata": {"name": "redis"}}]}')
+    [('services', 'redis')]
+    >>> sorted(written(["apply", "-f", "-"], "not: [valid"))
+    [('configmaps', None), ('pods', None), ('services', None), ('statefulsets', None)]
+    """
+    pos = []
+    for a in args[1:]:
+        if a.startswith("-"):
+            break
+        pos.append(a)
+    if not pos:
+        try:
+            res = []
+            for doc in yu.load_all(input.decode("utf-8") if isinstance(input, bytes) else input or ""):
+                for obj in doc.get("items") or [doc] if doc.get("kind", "").endswith("List") else [doc]:
+                    if obj.get("kind") in KINDS:
+                        res.append((KINDS[obj["kind"]], obj.get("metadata", {}).get("name")))
+            return res
+        except Exception:
+            return [(r, None) for r in WATCHED]
+    res = []
+    kind = None
+    for p in pos:
+        if "=" in p or p.endswith("-"):
+            continue
+        if "/" in p:
+            k, _, name = p.partition("/")
+            res.append((_resource(k.split(".")[0]), name))
+        elif kind is None:
+            kind = _resource(p.split(".")[0])
+        else:
+            res.append((kind, p))
+    if kind is not None and not any(r == kind for r, _ in res):
+        res.append((kind, None))
+    return res
+
+# versions returned by the write for each (resource, name), when the backend gives them
+def _versions(result):
+    return {(w[0], w[1]): w[2] for w in getattr(result, "written", None) or []}
+
+# called before each write, and after it with its result: the objects written are not
+# answered from the cache until the watch sees the write, at most for WRITE_GRACE seconds
+def _on_write(args, namespace, input=None, result=None):
+    """
+    >>> inf = Informer(None, "configmaps", "nuvolaris"); inf.synced.set()
+    >>> _informers[("configmaps", "nuvolaris")] = inf
+    >>> _on_write(["annotate", "cm/config", "--overwrite", "a=b"], "nuvolaris")
+    >>> inf.usable("config"), inf.usable("other")
+    (False, True)
+    >>> _on_write(["annotate", "cm/config", "--overwrite", "a=b"], "nuvolaris", result=kube.KubeResult(0, written=[("configmaps", "config", "7")]))
+    >>> inf.dispatch("MODIFIED", {"metadata": {"name": "config", "resourceVersion": "7"}}); inf.usable("config")
+    True
+    >>> _informers.clear()
+    """
+    informers = [(key[0], inf) for key, inf in list(_informers.items()) if key[1] == namespace and inf.keep]
+    if not informers:
+        return
+    targets = written(args, input)
+    versions = _versions(result)
+    for resource, inf in informers:
+        for r, name in targets:
+            if r != resource:
+                continue
+            if result is None:
+                inf.write_started(name)
+            else:
+                inf.write_done(name, versions.get((r, name)))
+
+_api = None
+
+# the api client of the informers: the kube backend when it is the api one, otherwise one of their own
+def default_api():
+    global _api
+    backend = kube.get_backend()
+    if backend.name == "api":
+        return backend
+    if _api is None:
+        import nuvolaris.kube_api as kube_api
+        _api = kube_api.ApiBackend()
+    return _api
+
+# start the informers for the given namespace, returning them
+# enabled unless NUVOLARIS_INFORMER is set to false
+def start(namespace="nuvolaris", resources=WATCHED, api=None, wait=10):
+    if os.environ.get("NUVOLARIS_INFORMER", "true").lower() == "false":
+        logging.info("informers disabled")
+        return []
+    api = api or default_api()
+    started = []
+    for resource in resources:
+        key = (resource, namespace)
+        if key in _informers:
+            started.append(_informers[key])
+            continue
+        inf = Informer(api, resource, namespace)
+        _informers[key] = inf
+        inf.start()
+        started.append(inf)
+    kube.add_write_hook(_on_write)
+    deadline = time.time() + wait
+    for inf in started:
+        inf.synced.wait(max(0, deadline - time.time()))
+    logging.info(f"informers started for {resources} in {namespace}")
+    return started
+
+# follow a resource, also cluster wide with namespace None, invoking the listener for each change
+# without keeping the objects; returns the informer, or None when the informers are disabled
+# only their metadata when metadata_only
+# the informers with a selector or reading only the metadata are not shared with the others
+def watch(resource, listener, namespace=None, label_selector=None, api=None, metadata_only=False):
+    """
+    >>> class Api:
+    ...     def resource(self, name): raise Exception("offline")
+    >>> a, b = watch("nodes", print, label_selector="a=b", api=Api()), watch("nodes", print, label_selector="c=d", api=Api())
+    >>> a is b, a.label_selector, b.label_selector
+    (False, 'a=b', 'c=d')
+    >>> watch("nodes", print, label_selector="a=b", api=Api()) is a
+    True
+    >>> stop()
+    """
+    if os.environ.get("NUVOLARIS_INFORMER", "true").lower() == "false":
+        return None
+    api = api or default_api()
+    key = (_resource(resource), namespace)
+    if label_selector or metadata_only:
+        key += (label_selector, metadata_only)
+    inf = _informers.get(key)
+    if inf is None:
+        inf = Informer(api, _resource(resource), namespace, label_selector=label_selector, keep=False,
+                       metadata_only=metadata_only)
+        _informers[key] = inf
+        inf.add_listener(listener)
+        inf.start()
+    elif listener not in inf.listeners:
+        inf.add_listener(listener)
+    return inf
+
+def stop():
+    for inf in _informers.values():
+        inf.stop()
+    _informers.clear()
+
+# return the informer of the resource if it can answer queries, None otherwise
+def get_informer(kind, namespace="nuvolaris", name=None):
+    if kube.mocker.enabled:
+        return None
+    inf = _informers.get((_resource(kind), namespace))
+    if inf is None or not inf.keep or not inf.usable(name):
+        return None
+    return inf
+
+# evaluate the jsonpath over the cached objects as kubectl get would do,
+# over a single object if name is given, otherwise over the list of objects
+# matching the selector; returns None when the cache is not available
+def query(kind, jsonpath, namespace="nuvolaris", selector=None, name=None):
+    """
+    >>> inf = Informer(None, "services", "nuvolaris")
+    >>> inf.synced.set()
+    >>> _informers[("services", "nuvolaris")] = inf
+    >>> inf.dispatch("ADDED", {"metadata": {"name": "redis", "labels": {"app": "redis"}}})
+    >>> query("svc", "{.items[?(@.metadata.labels.app == 'redis')].metadata.name}")
+    ['redis']
+    >>> query("svc", "{.metadata.name}", name="redis"), query("svc", "{.metadata.name}", name="missing")
+    (['redis'], None)
+    >>> query("pods", "{.items[*].metadata.name}") is None
+    True
+    >>> _on_write(["annotate", "svc/redis", "--overwrite", "a=b"], "nuvolaris")
+    >>> query("svc", "{.items[*].metadata.name}") is None
+    True
+    >>> _informers.clear()
+    """
+    inf = get_informer(kind, namespace, name)
+    if inf is None:
+        return None
+    if name is not None:
+        obj = inf.get(name)
+        if obj is None:
+            return None
+        return jp.query(obj, jsonpath)
+    return jp.query({"kind": "List", "items": inf.list(selector)}, jsonpath)
@@ -20,6 +20,10 @@ import nuvolaris.kube as kube
 import nuvolaris.kustomize as kus
 import nuvolaris.config as cfg
 
+# the generated issuer is written in a staging folder, but it has the same name of this one:
+# this is enough to delete it
+ISSUER = "deploy/issuer/cluster-issuer.yaml"
+
 def create(owner=None):
     logging.info(f"*** Configuring cluster issuer")
     # We deploy a cluster-issuer
@@ -49,14 +53,14 @@ def create(owner=None):
     }
     
     kust = kus.patchTemplate("issuer", "cluster-issuer.yaml", data)
-    spec = "deploy/issuer/__cluster-issuer.yaml"
+    spec = f"{kus.folder('issuer')}/__cluster-issuer.yaml"
 
-    cfg.put("state.issuer.spec", spec)
+    cfg.put("state.issuer.spec", ISSUER)
     res = kube.kubectl("apply", "-f", spec,namespace=None)
     return res
 
 def delete_by_owner():
-    spec = "deploy/issuer/__cluster-issuer.yaml"
+    spec = ISSUER
     res = kube.kubectl("delete", "-f", spec,namespace=None)
     logging.info(f"delete minio: {res}")
     return res
@@ -98,4 +102,5 @@ def patch(status, action, owner=None):
             status['whisk_create']['issuer']='error'
         else:            
             status['whisk_update']['issuer']='error'           
+        raise
 
@@ -0,0 +1,200 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module evaluates the subset of the kubectl jsonpath syntax
+# used by the operator, returning the same results of
+# kubectl -o jsonpath-as-json=<expr>, so that filtering can happen in process
+import re
+from functools import lru_cache
+
+_OPERATORS = ["==", "!=", "<=", ">=", "<", ">"]
+
+# find the position of the closing bracket, skipping quoted strings and parenthesis
+def _closing(body, start):
+    depth = 0
+    quote = None
+    i = start
+    while i < len(body):
+        c = body[i]
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in "'\"":
+            quote = c
+        elif c in "[(":
+            depth += 1
+        elif c in "])":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    raise ValueError(f"unbalanced brackets in jsonpath {body}")
+
+def _literal(value):
+    """
+    >>> _literal("'primary'"), _literal("3"), _literal("true")
+    ('primary', 3, True)
+    """
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    if value in ["true", "false"]:
+        return value == "true"
+    try: return int(value)
+    except ValueError: pass
+    try: return float(value)
+    except ValueError: pass
+    raise ValueError(f"unsupported jsonpath literal {value}")
+
+def _parse_filter(expr):
+    quote = None
+    for i, c in enumerate(expr):
+        if quote:
+            if c == quote: quote = None
+            continue
+        if c in "'\"":
+            quote = c
+            continue
+        for op in _OPERATORS:
+            if expr.startswith(op, i):
+                left = _parse_steps(expr[:i].strip())
+                return ("filter", left, op, _literal(expr[i+len(op):]))
+    return ("filter", _parse_steps(expr.strip()), None, None)
+
+def _parse_steps(body):
+    steps = []
+    i = 0
+    if body[:1] in ["@", "$"]:
+        i = 1
+    while i < len(body):
+        c = body[i]
+        if c == ".":
+            i += 1
+            name = ""
+            while i < len(body) and body[i] not in ".[":
+                if body[i] == "\\" and i+1 < len(body):
+                    name += body[i+1]
+                    i += 2
+                    continue
+                name += body[i]
+                i += 1
+            if name == "":
+                raise ValueError(f"recursive descent is not supported: {body}")
+            steps.append(("field", name))
+        elif c == "[":
+            j = _closing(body, i)
+            inner = body[i+1:j].strip()
+            if inner in ["", "*"]:
+                steps.append(("all",))
+            elif inner.startswith("?(") and inner.endswith(")"):
+                steps.append(_parse_filter(inner[2:-1]))
+            elif re.fullmatch(r"-?\d+", inner):
+                steps.append(("index", int(inner)))
+            else:
+                raise ValueError(f"unsupported jsonpath selector [{inner}]")
+            i = j + 1
+        else:
+            raise ValueError(f"unexpected character '{c}' in jsonpath {body}")
+    return tuple(steps)
+
+# parse a jsonpath template in the form {expression} returning a tuple of steps
+@lru_cache(maxsize=256)
+def parse(jsonpath):
+    """
+    >>> parse("{.items[*].metadata.name}")
+    (('field', 'items'), ('all',), ('field', 'metadata'), ('field', 'name'))
+    >>> parse(r"{.metadata.annotations.whisks\\.nuvolaris\\.org\\/annotate-version}")[-1]
+    ('field', 'whisks.nuvolaris.org/annotate-version')
+    >>> parse("{.items[?(@.metadata.labels.name == 'redis')]}")[-1]
+    ('filter', (('field', 'metadata'), ('field', 'labels'), ('field', 'name')), '==', 'redis')
+    >>> parse("{@}")
+    ()
+    """
+    expr = jsonpath.strip()
+    if not (expr.startswith("{") and expr.endswith("}")):
+        raise ValueError(f"only single {{expression}} templates are supported: {jsonpath}")
+    return _parse_steps(expr[1:-1].strip())
+
+def _compare(value, op, literal):
+    if isinstance(literal, bool) or isinstance(value, bool):
+        value, literal = str(value).lower(), str(literal).lower()
+    elif isinstance(literal, (int, float)) and isinstance(value, str):
+        try: value = type(literal)(value)
+        except ValueError: return False
+    try:
+        if op == "==": return value == literal
+        if op == "!=": return value != literal
+        if op == "<":  return value < literal
+        if op == ">":  return value > literal
+        if op == "<=": return value <= literal
+        if op == ">=": return value >= literal
+    except TypeError:
+        return False
+    return False
+
+def _walk(steps, nodes):
+    for step in steps:
+        out = []
+        kind = step[0]
+        for node in nodes:
+            if kind == "field":
+                if isinstance(node, dict) and step[1] in node:
+                    out.append(node[step[1]])
+            elif kind == "all":
+                if isinstance(node, list):
+                    out.extend(node)
+                elif isinstance(node, dict):
+                    out.extend(node.values())
+            elif kind == "index":
+                if isinstance(node, list) and -len(node) <= step[1] < len(node):
+                    out.append(node[step[1]])
+            elif kind == "filter":
+                if isinstance(node, list):
+                    for elem in node:
+                        values = _walk(step[1], [elem])
+                        if step[2] is None:
+                            if values: out.append(elem)
+                        elif any(_compare(v, step[2], step[3]) for v in values):
+                            out.append(elem)
+        nodes = out
+    return nodes
+
+# evaluate the jsonpath over the given object
+# missing keys are silently skipped, as kubectl does by default
+def query(obj, jsonpath):
+    """
+    >>> pods = {"items": [
+    ...   {"metadata": {"name": "redis-0", "labels": {"name": "redis"}}},
+    ...   {"metadata": {"name": "couchdb-0", "labels": {"name": "couchdb"}, "annotations": {"a.b/c": "true"}}}]}
+    >>> query(pods, "{.items[*].metadata.name}")
+    ['redis-0', 'couchdb-0']
+    >>> query(pods, "{.items[?(@.metadata.labels.name == 'couchdb')].metadata.name}")
+    ['couchdb-0']
+    >>> query(pods, r"{.items[?(@.metadata.annotations.a\\.b\\/c=='true')].metadata.name}")
+    ['couchdb-0']
+    >>> query(pods, r"{.items[?(@.metadata.annotations.a\\.b\\/c)].metadata.labels.name}")
+    ['couchdb']
+    >>> query(pods, "{.items[].metadata.labels}")
+    [{'name': 'redis'}, {'name': 'couchdb'}]
+    >>> query(pods, "{.items[1].metadata.missing}")
+    []
+    >>> query({"spec": {"replicas": 2}}, "{.spec.replicas}")
+    [2]
+    >>> query({"a": 1}, "{@}")
+    [{'a': 1}]
+    """
+    return _walk(parse(jsonpath), [obj])
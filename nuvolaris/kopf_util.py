@@ -105,4 +105,32 @@ def detect_component_changes(kopf_diff):
     response = {}
     evaluate_differences(response, differences)
 
-    return response
\ No newline at end of file
+    return response
+
+# action patching each component when its inputs changed
+DIGEST_ACTIONS = {
+    "postgres": ("postgres", "create"),
+    "mongodb": ("mongodb", "create"),
+    "redis": ("redis", "create"),
+    "cron": ("cron", "create"),
+    "minio": ("minio", "create"),
+    "static": ("static", "create"),
+    "openwhisk": ("openwhisk", "update"),
+    "issuer": ("endpoint", "update")
+}
+
+def evaluate_digests(response: dict, changed: list):
+    """
+    Adds to the response the components whose inputs changed according to their digests,
+    when the differences did not already decide what to do with them
+    >>> response = {"redis": "delete"}
+    >>> evaluate_digests(response, ["redis", "cron", "issuer", "couchdb"])
+    >>> response
+    {'redis': 'delete', 'cron': 'create', 'endpoint': 'update'}
+    """
+    for name in changed:
+        if name in DIGEST_ACTIONS:
+            key, action = DIGEST_ACTIONS[name]
+            if key not in response:
+                logging.info(f"*** inputs of {name} changed")
+                response[key] = action
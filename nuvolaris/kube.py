@@ -18,20 +18,108 @@
 # this module wraps kubectl
 import nuvolaris.testutil as tu
 import nuvolaris.template as tpl
+import nuvolaris.metrics as metrics
+import nuvolaris.yaml_util as yu
 import subprocess
 import json
 import logging
-import yaml
-
-
-output = ""
-error = ""
-returncode = -1
+import os
+import threading
+import contextvars
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 dry_run = False
 
 mocker = tu.MockKube()
 
+# result of a single kubectl invocation
+# data holds the already parsed jsonpath result when the backend provides it,
+# written the (resource, name, resourceVersion) of the objects written, when it knows them
+class KubeResult:
+    def __init__(self, returncode, output="", error="", data=None, written=None):
+        self.returncode = returncode
+        self.output = output
+        self.error = error
+        self.data = data
+        self.written = written
+
+# default backend, forking a kubectl process per call
+class KubectlBackend:
+    name = "kubectl"
+
+    def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+        cmd = namespace and ["kubectl", "-n", namespace] or ["kubectl"]
+        cmd += list(args)
+        if jsonpath:
+            cmd += ["-o", "jsonpath-as-json=%s" % jsonpath]
+
+        # if is a string, convert input in bytes
+        try: input = input.encode('utf-8')
+        except: pass
+
+        # executing
+        logging.debug(cmd)
+        res = subprocess.run(cmd, capture_output=True, input=input)
+        return KubeResult(res.returncode, res.stdout.decode(), res.stderr.decode())
+
+_kubectl_backend = KubectlBackend()
+_backend = None
+_backend_lock = threading.Lock()
+_last = threading.local()
+
+# select the backend used by kubectl: "kubectl" forks a process per call,
+# "api" talks in process with the api server (see nuvolaris.kube_api)
+# and delegates to kubectl only the calls it does not support;
+# any object with a run method like KubectlBackend can also be passed
+def set_backend(name):
+    global _backend
+    if not isinstance(name, str):
+        # a backend object, ex. testutil.KubeReplayer
+        _backend = name
+        name = name.name
+    elif name == "api":
+        import nuvolaris.kube_api as kube_api
+        _backend = kube_api.ApiBackend()
+    elif name == "kubectl":
+        _backend = _kubectl_backend
+    else:
+        raise Exception(f"unknown kube backend {name}")
+    logging.info(f"using kube backend {name}")
+    return _backend
+
+# return the current backend, initialized from NUVOLARIS_KUBE_BACKEND (default kubectl)
+def get_backend():
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                try:
+                    set_backend(os.environ.get("NUVOLARIS_KUBE_BACKEND", "kubectl"))
+                except Exception as e:
+                    logging.warning(f"cannot initialize kube backend, using kubectl: {e}")
+                    set_backend("kubectl")
+    return _backend
+
+WRITE_VERBS = ["apply", "create", "delete", "patch", "annotate", "label", "scale", "replace"]
+_write_hooks = []
+
+# register a function invoked with (args, namespace, input) before each write
+# and with (args, namespace, input, result) after it
+def add_write_hook(fn):
+    if fn not in _write_hooks:
+        _write_hooks.append(fn)
+
+# result of the last kubectl call executed by the current thread
+def last_result():
+    return getattr(_last, "result", KubeResult(-1))
+
+# output, error and returncode are per thread, and refer to the last call
+def __getattr__(name):
+    if name in ["output", "error", "returncode"]:
+        return getattr(last_result(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 # execute kubectl commands
 # default namespace is nuvolaris, you can change with keyword arg namespace
 # default output is text
@@ -44,61 +132,53 @@ def kubectl(*args, namespace="nuvolaris", input=None, jsonpath=None, debugresult
         mocker.save(input)
         return mres
 
-    cmd = namespace and ["kubectl", "-n", namespace] or ["kubectl"]
-    cmd += list(args)
-    if jsonpath:
-        cmd += ["-o", "jsonpath-as-json=%s" % jsonpath]
-
-    # if is a string, convert input in bytes
-    try: input = input.encode('utf-8')
-    except: pass
-        
-    # executing
-    logging.debug(cmd)
-    res = subprocess.run(cmd, capture_output=True, input=input)
+    write = args and args[0] in WRITE_VERBS
+    if write:
+        for hook in _write_hooks:
+            hook(args, namespace, input)
 
-    global returncode, output, error
-    returncode = res.returncode
-    output = res.stdout.decode()
-    error = res.stderr.decode()
+    backend = get_backend()
+    start = time.time()
+    res = backend.run(args, namespace=namespace, input=input, jsonpath=jsonpath)
+    if res is None:
+        res = _kubectl_backend.run(args, namespace=namespace, input=input, jsonpath=jsonpath)
+    _last.result = res
+    if write:
+        for hook in _write_hooks:
+            hook(args, namespace, input, res)
+    metrics.observe(args and args[0] or "-", metrics.kind_of(args, input), time.time() - start,
+                    len(input or ""), len(res.output or ""), res.returncode != 0)
 
     if res.returncode == 0:
         if jsonpath:
                 try:
-                    parsed = json.loads(output)
+                    parsed = res.data if res.data is not None else json.loads(res.output)
                     if debugresult:
                         logging.debug("result: %s", json.dumps(parsed, indent=2))
                     return parsed
                 except Exception as e:
-                    logging.info(output)
+                    logging.info(res.output)
                     logging.info(e)
                     return e
         else:
-            return output
-    logging.info(f"Error: kubectl f{cmd} input='{input}' output='{output}' error='{error}'")
-    raise Exception(error)
+            return res.output
+    # the input is not logged, it can carry secrets and the scripts streamed to exec
+    logging.info(f"Error: kubectl {list(args)} input={len(input or '')} bytes output='{res.output}' error='{res.error}'")
+    raise Exception(res.error)
 
-# create a configmap from keyword arguments
+# create a configmap from keyword arguments, as an object to apply
 def configMap(name, **kwargs):
     """
-    >>> import nuvolaris.kube as kube, nuvolaris.testutil as tu
-    >>> tu.grep(kube.configMap("hello", value="world"), "kind:|name:|value:", sort=True)
+    >>> import nuvolaris.kube as kube, nuvolaris.testutil as tu, nuvolaris.yaml_util as yu
+    >>> tu.grep(yu.dump(kube.configMap("hello", value="world")), "kind:|name:|value:", sort=True)
     kind: ConfigMap
     name: hello
     value: world
-    >>> tu.grep(kube.configMap("hello", **{"file.js":"function", "file.py": "def"}), "file.", sort=True)
+    >>> tu.grep(yu.dump(kube.configMap("hello", **{"file.js":"function", "file.py": "def"})), "file.", sort=True)
     file.js: function
     file.py: def
     """
-    out = yaml.safe_load("""apiVersion: v1
-kind: ConfigMap
-metadata:
-  name: %s
-data: {}
-"""% name)
-    for key, value in kwargs.items():
-        out['data'][key] = value
-    return yaml.dump(out)
+    return {"apiVersion": "v1", "kind": "ConfigMap", "metadata": {"name": name}, "data": dict(kwargs)}
     
 # delete an object
 def delete(obj, namespace="nuvolaris"):
@@ -115,11 +195,226 @@ def ctl(arg, jsonpath='{@}', flatten=False):
         return dict(flatdict.FlatterDict(data, delimiter="."))
     return data
 
-# apply an object
-def apply(obj, namespace="nuvolaris"):
-    if not isinstance(obj, str):
-        obj = json.dumps(obj)
-    return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+# annotation holding the hash of the applied content
+APPLY_HASH = "nuvolaris.org/apply-hash"
+
+# skip the objects whose live hash matches, unless NUVOLARIS_APPLY_SKIP_UNCHANGED=false
+skip_unchanged = os.environ.get("NUVOLARIS_APPLY_SKIP_UNCHANGED", "true").lower() != "false"
+
+# output of an apply, that also reports the objects created, updated and skipped
+class ApplyResult(str):
+    """
+    >>> res = ApplyResult("configmap/a created\\nstatefulset.apps/redis configured\\n", ["service/redis"])
+    >>> res.created, res.updated, res.skipped
+    (['configmap/a'], ['statefulset.apps/redis'], ['service/redis'])
+    >>> print(res, end="")
+    configmap/a created
+    statefulset.apps/redis configured
+    service/redis unchanged
+    """
+    def __new__(cls, output, skipped=[], latency={}):
+        res = str.__new__(cls, (output or "") + "".join(f"{s} unchanged\n" for s in skipped))
+        res.created, res.updated, res.skipped = [], [], []
+        res.latency = dict(latency)
+        for line in res.splitlines():
+            name, _, status = line.strip().rpartition(" ")
+            if status == "created":
+                res.created.append(name)
+            elif status == "unchanged":
+                res.skipped.append(name)
+            elif name:
+                res.updated.append(name)
+        return res
+
+# flatten an object, a List or a yaml string in a list of objects
+def _items(obj):
+    if isinstance(obj, str):
+        docs = yu.load_all(obj)
+    elif isinstance(obj, list):
+        docs = obj
+    else:
+        docs = [obj]
+    items = []
+    for doc in docs:
+        if doc.get("kind", "").endswith("List") and "items" in doc:
+            items.extend(doc["items"] or [])
+        else:
+            items.append(doc)
+    return items
+
+# hash of the content of an object, ignoring the hash annotation
+def content_hash(obj):
+    """
+    >>> h = content_hash({"kind": "ConfigMap", "metadata": {"name": "a"}, "data": {"x": "1"}})
+    >>> h == content_hash({"data": {"x": "1"}, "kind": "ConfigMap", "metadata": {"name": "a", "annotations": {APPLY_HASH: "old"}}})
+    True
+    >>> h == content_hash({"kind": "ConfigMap", "metadata": {"name": "a"}, "data": {"x": "2"}})
+    False
+    """
+    meta = dict(obj.get("metadata") or {})
+    annotations = {k: v for k, v in (meta.get("annotations") or {}).items() if k != APPLY_HASH}
+    if annotations:
+        meta["annotations"] = annotations
+    else:
+        meta.pop("annotations", None)
+    data = json.dumps(dict(obj, metadata=meta), sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+# copy of the object with the hash annotation
+def _stamp(obj):
+    meta = dict(obj.get("metadata") or {})
+    meta["annotations"] = dict(meta.get("annotations") or {}, **{APPLY_HASH: content_hash(obj)})
+    return dict(obj, metadata=meta)
+
+# name of the object as printed by kubectl, ex statefulset.apps/redis
+def _display(obj):
+    group = obj.get("apiVersion", "").rpartition("/")[0]
+    kind = obj.get("kind", "").lower()
+    return f"{kind}.{group}/{obj['metadata']['name']}" if group else f"{kind}/{obj['metadata']['name']}"
+
+# hashes of the live objects of the same kinds, with one read per namespace
+def _live_hashes(items, namespace):
+    kinds = {}
+    for item in items:
+        ns = item["metadata"].get("namespace") or namespace
+        kinds.setdefault(ns, set()).add(_display(item).split("/")[0])
+    hashes = set()
+    for ns, types in kinds.items():
+        try:
+            res = kubectl("get", ",".join(sorted(types)), namespace=ns, debugresult=False,
+                          jsonpath="{.items[*].metadata.annotations.nuvolaris\\.org\\/apply-hash}")
+            if isinstance(res, list):
+                hashes.update(res)
+        except Exception as e:
+            logging.debug(f"cannot read the live hashes in {ns}: {e}")
+    return hashes
+
+# objects are applied in tiers, so that what is needed by the next tier already exists
+APPLY_TIERS = [
+    ["Namespace", "CustomResourceDefinition", "PriorityClass", "StorageClass", "ServiceAccount",
+     "ClusterRole", "Role", "ClusterRoleBinding", "RoleBinding"],
+    ["ConfigMap", "Secret", "PersistentVolume", "PersistentVolumeClaim", "Service"],
+    ["Deployment", "StatefulSet", "DaemonSet", "ReplicaSet", "Pod", "Job", "CronJob"]
+]
+
+# number of objects of the same tier applied concurrently
+apply_workers = int(os.environ.get("NUVOLARIS_APPLY_WORKERS", "4"))
+
+# tier of an object, the other kinds (ingresses, custom resources...) come last
+def apply_tier(obj):
+    """
+    >>> [apply_tier({"kind": k}) for k in ["CustomResourceDefinition", "Secret", "StatefulSet", "Kubegres"]]
+    [0, 1, 2, 3]
+    """
+    for n, kinds in enumerate(APPLY_TIERS):
+        if obj.get("kind") in kinds:
+            return n
+    return len(APPLY_TIERS)
+
+def _apply_one(item, namespace):
+    start = time.time()
+    try:
+        return kubectl("apply", "-f", "-", namespace=namespace, input=json.dumps(item)), None, time.time() - start
+    except Exception as e:
+        return "", f"{_display(item)}: {e}", time.time() - start
+
+# apply the objects tier by tier; with the api backend the objects of a tier are applied concurrently,
+# one call each, otherwise each tier is applied as a single List, so kubectl is forked once per tier
+# returns the output and the latency of each object; errors are raised at the end, as kubectl does
+def _apply_tiers(items, namespace, workers=None):
+    """
+    >>> import contextvars
+    >>> handler = contextvars.ContextVar("handler", default=None)
+    >>> class Backend:
+    ...     def __init__(self, name): self.name, self.calls = name, []
+    ...     def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+    ...         self.calls.append((json.loads(input).get("kind"), handler.get()))
+    ...         return KubeResult(0, "applied")
+    >>> items = [{"kind": k, "metadata": {"name": n}} for k, n in [("StatefulSet", "redis"), ("Service", "redis"), ("ConfigMap", "redis")]]
+    >>> old = get_backend(); _ = handler.set("whisk_create")
+    >>> backend = set_backend(Backend("kubectl"))
+    >>> _ = _apply_tiers(items, "nuvolaris"); backend.calls
+    [('List', 'whisk_create'), ('StatefulSet', 'whisk_create')]
+    >>> backend = set_backend(Backend("api"))
+    >>> _ = _apply_tiers(items, "nuvolaris"); sorted(backend.calls)
+    [('ConfigMap', 'whisk_create'), ('Service', 'whisk_create'), ('StatefulSet', 'whisk_create')]
+    >>> metrics._series.clear(); _ = metrics.as_component("redis", _apply_tiers, items, "nuvolaris")
+    >>> sorted(set(key[3] for key in metrics._series))
+    ['redis']
+    >>> _ = set_backend(old)
+    """
+    workers = max(1, workers or apply_workers)
+    outputs, errors, latency = {}, [], {}
+    tiers = {}
+    for n, item in enumerate(items):
+        tiers.setdefault(apply_tier(item), []).append(n)
+    per_object = get_backend().name == "api"
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for tier in sorted(tiers):
+            indexes = tiers[tier]
+            if per_object and len(indexes) > 1:
+                # the context carries the handler metrics and the configuration scope, while
+                # the component is taken here, as the stack of the pool threads does not tell it
+                component = metrics.caller_component()
+                futures = [pool.submit(contextvars.copy_context().run, metrics.as_component, component,
+                                       _apply_one, items[n], namespace) for n in indexes]
+                results = [f.result() for f in futures]
+            else:
+                batch = [items[n] for n in indexes]
+                output, error, elapsed = _apply_one(batch[0] if len(batch) == 1 else {"apiVersion": "v1", "kind": "List", "items": batch}, namespace)
+                results = [(output, error, elapsed)] + [("", None, elapsed)] * (len(indexes) - 1)
+            for n, (output, error, elapsed) in zip(indexes, results):
+                outputs[n] = output
+                latency[_display(items[n])] = elapsed
+                logging.debug(f"applied {_display(items[n])} in {elapsed:.3f}s")
+                if error:
+                    errors.append(error)
+    output = "".join(outputs[n] for n in sorted(outputs))
+    if errors:
+        logging.info(f"Error: apply failed for {len(errors)} of {len(tiers)} tiers or objects")
+        raise Exception("\n".join(errors))
+    return output, latency
+
+# apply an object, a list or a yaml string
+# unless skip is False, each object is stamped with the hash of its content,
+# and objects whose live hash is the same are not applied again;
+# lists are applied in tiers (see APPLY_TIERS) with up to workers objects at a time
+def apply(obj, namespace="nuvolaris", skip=None, workers=None):
+    if skip is None:
+        skip = skip_unchanged and not mocker.enabled
+    items = None
+    if not mocker.enabled:
+        try:
+            items = _items(obj)
+            if skip:
+                items = [_stamp(i) for i in items]
+            names = [_display(i) for i in items]
+        except Exception as e:
+            logging.debug(f"cannot parse the applied objects, applying as is: {e}")
+            items = None
+    if items is None:
+        if not isinstance(obj, str):
+            obj = json.dumps(obj)
+        return kubectl("apply", "-f", "-", namespace=namespace, input=obj)
+
+    todo, skipped = items, []
+    if skip:
+        live = _live_hashes(items, namespace)
+        todo = [i for i in items if i["metadata"]["annotations"][APPLY_HASH] not in live]
+        skipped = [n for i, n in zip(items, names) if i["metadata"]["annotations"][APPLY_HASH] in live]
+    output, latency = "", {}
+    start = time.time()
+    if len(todo) == 1:
+        output = kubectl("apply", "-f", "-", namespace=namespace, input=json.dumps(todo[0]))
+        latency[_display(todo[0])] = time.time() - start
+    elif len(todo) > 1:
+        output, latency = _apply_tiers(todo, namespace, workers)
+    if todo:
+        slowest = max(latency, key=latency.get)
+        logging.info(f"applied {len(todo)} objects in {time.time() - start:.2f}s, slowest {slowest} {latency[slowest]:.2f}s")
+    if skipped:
+        logging.info(f"skipped {len(skipped)} unchanged objects: {' '.join(skipped)}")
+    return ApplyResult(output, skipped, latency)
 
 # apply an expanded template
 def applyTemplate(name, data, namespace="nuvolaris"):
@@ -0,0 +1,524 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module implements an in-process backend for nuvolaris.kube
+# it talks directly with the api server using a pooled pykube session
+# instead of forking a kubectl process per call.
+# calls it cannot serve (exec, cp, tables, kustomizations...) return None
+# so that nuvolaris.kube falls back to kubectl
+import os, json, time, logging, threading, datetime
+import pykube
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import nuvolaris.jsonpath_util as jp
+import nuvolaris.yaml_util as yu
+from nuvolaris.kube import KubeResult
+
+SERVICE_ACCOUNT_TOKEN = "/var/run/secrets/kubernetes.io/serviceaccount/token"
+FIELD_MANAGER = "nuvolaris-operator"
+
+PATCH_TYPES = {
+    "merge": "application/merge-patch+json",
+    "json": "application/json-patch+json",
+    "strategic": "application/strategic-merge-patch+json"
+}
+
+# accept headers asking the api server for the metadata of the objects only, falling back to the full objects
+METADATA_LIST = "application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,application/json"
+METADATA_WATCH = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json"
+
+# flags accepting a value, mapped to the name used by the handlers
+_VALUE_FLAGS = {
+    "-f": "filename", "--filename": "filename",
+    "-l": "selector", "--selector": "selector",
+    "-o": "output", "--output": "output",
+    "-p": "patch", "--patch": "patch",
+    "--type": "type",
+    "--for": "for",
+    "--timeout": "timeout",
+    "--replicas": "replicas"
+}
+
+_BOOL_FLAGS = {
+    "--overwrite": "overwrite"
+}
+
+# raised before any side effect when a call must be delegated to kubectl
+class Unsupported(Exception):
+    pass
+
+class ApiError(Exception):
+    def __init__(self, code, reason, message):
+        super().__init__(f"Error from server ({reason}): {message}")
+        self.code = code
+        self.reason = reason
+
+def parse_args(args):
+    """
+    split kubectl arguments in verb, positional arguments and flags
+    returns None if there are flags not understood by the api backend
+    >>> parse_args(["get", "pods", "-l", "app=x", "-ojson"])
+    ('get', ['pods'], {'selector': 'app=x', 'output': 'json'})
+    >>> parse_args(["wait", "pod/couchdb-0", "--for=condition=ready", "--timeout=600s"])
+    ('wait', ['pod/couchdb-0'], {'for': 'condition=ready', 'timeout': '600s'})
+    >>> parse_args(["annotate", "cm/config", "a=b", "--overwrite"])
+    ('annotate', ['cm/config', 'a=b'], {'overwrite': True})
+    >>> parse_args(["delete", "pods", "--all"]) is None
+    True
+    """
+    if len(args) == 0:
+        return None
+    verb = args[0]
+    pos, flags = [], {}
+    i = 1
+    while i < len(args):
+        arg = str(args[i])
+        if arg == "--":
+            return None
+        if arg.startswith("-") and arg != "-":
+            name, eq, value = arg.partition("=")
+            if name in _BOOL_FLAGS and not eq:
+                flags[_BOOL_FLAGS[name]] = True
+            elif name in _VALUE_FLAGS:
+                if not eq:
+                    i += 1
+                    if i >= len(args):
+                        return None
+                    value = str(args[i])
+                flags[_VALUE_FLAGS[name]] = value
+            elif not arg.startswith("--") and arg[:2] in _VALUE_FLAGS and len(arg) > 2:
+                flags[_VALUE_FLAGS[arg[:2]]] = arg[2:]
+            else:
+                return None
+        else:
+            pos.append(arg)
+        i += 1
+    return (verb, pos, flags)
+
+def parse_timeout(value):
+    """
+    >>> parse_timeout("600s"), parse_timeout("5m"), parse_timeout("30")
+    (600.0, 300.0, 30.0)
+    """
+    units = {"s": 1, "m": 60, "h": 3600}
+    if value[-1:] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+def load_config():
+    if os.path.isfile(SERVICE_ACCOUNT_TOKEN):
+        return pykube.KubeConfig.from_service_account()
+    kubeconfig = os.environ.get("KUBECONFIG", os.path.expanduser("~/.kube/config"))
+    return pykube.KubeConfig.from_file(kubeconfig.split(os.pathsep)[0])
+
+# an api resource as returned by the discovery endpoints
+class Resource:
+    def __init__(self, group_version, plural, kind, namespaced):
+        self.group_version = group_version
+        self.group = group_version.split("/")[0] if "/" in group_version else ""
+        self.plural = plural
+        self.kind = kind
+        self.namespaced = namespaced
+
+    def with_version(self, api_version):
+        return Resource(api_version, self.plural, self.kind, self.namespaced)
+
+    # name used by kubectl in its messages, ex statefulset.apps
+    def display(self):
+        """
+        >>> Resource("apps/v1", "statefulsets", "StatefulSet", True).display()
+        'statefulset.apps'
+        >>> Resource("v1", "configmaps", "ConfigMap", True).display()
+        'configmap'
+        """
+        return self.group and f"{self.kind.lower()}.{self.group}" or self.kind.lower()
+
+    def path(self, namespace=None, name=None, subresource=None):
+        """
+        >>> Resource("apps/v1", "statefulsets", "StatefulSet", True).path("nuvolaris", "couchdb", "scale")
+        '/apis/apps/v1/namespaces/nuvolaris/statefulsets/couchdb/scale'
+        >>> Resource("v1", "nodes", "Node", False).path("nuvolaris")
+        '/api/v1/nodes'
+        """
+        bits = [self.group and f"/apis/{self.group_version}" or "/api/v1"]
+        if self.namespaced and namespace:
+            bits.append(f"namespaces/{namespace}")
+        bits.append(self.plural)
+        if name:
+            bits.append(name)
+        if subresource:
+            bits.append(subresource)
+        return "/".join(bits)
+
+# the (resource, name, resourceVersion) of an object written, from the response of the api server
+def _written(res, name, response):
+    """
+    >>> class Response:
+    ...     def json(self): return {"metadata": {"name": "redis", "resourceVersion": "42"}}
+    >>> _written(Resource("v1", "services", "Service", True), "redis", Response())
+    ('services', 'redis', '42')
+    """
+    try:
+        version = response.json().get("metadata", {}).get("resourceVersion")
+    except Exception:
+        version = None
+    return (res.plural, name, version)
+
+class ApiBackend:
+    name = "api"
+
+    def __init__(self, config=None, pool_size=None):
+        self.config = config or load_config()
+        self.client = pykube.HTTPClient(self.config)
+        size = int(pool_size or os.environ.get("NUVOLARIS_KUBE_POOL_SIZE", "10"))
+        adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.session = self.client.session
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = float(os.environ.get("NUVOLARIS_KUBE_TIMEOUT", "60"))
+        self._lock = threading.Lock()
+        self._aliases = None
+        self._kinds = None
+        self._discovered = 0
+        self._handlers = {
+            "get": self._get,
+            "apply": self._apply,
+            "delete": self._delete,
+            "patch": self._patch,
+            "annotate": self._annotate,
+            "wait": self._wait,
+            "scale": self._scale,
+            "rollout": self._rollout
+        }
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, self.client.url.rstrip("/") + path, **kwargs)
+
+    def _check(self, r):
+        if r.status_code < 400:
+            return r
+        try:
+            status = r.json()
+        except ValueError:
+            status = {}
+        if not isinstance(status, dict):
+            status = {}
+        raise ApiError(r.status_code, status.get("reason", r.reason), status.get("message", r.text))
+
+    # discovery of the api resources, refreshed at most every 10 seconds
+    # when a resource is not found (ex. a CRD has just been created)
+    def _discover(self):
+        aliases, kinds = {}, {}
+
+        def register(group_version, resources):
+            group = group_version.split("/")[0] if "/" in group_version else ""
+            for r in resources:
+                if "/" in r["name"]:
+                    continue
+                res = Resource(group_version, r["name"], r["kind"], r["namespaced"])
+                kinds.setdefault((group, r["kind"]), res)
+                names = [r["name"], r.get("singularName") or r["kind"].lower(), r["kind"].lower()]
+                for alias in names + r.get("shortNames", []):
+                    aliases.setdefault(alias, res)
+                    if group:
+                        aliases.setdefault(f"{alias}.{group}", res)
+
+        register("v1", self._check(self.request("GET", "/api/v1")).json()["resources"])
+        groups = self._check(self.request("GET", "/apis")).json()["groups"]
+        versions = [g["preferredVersion"]["groupVersion"] for g in groups]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            lists = pool.map(lambda gv: self.request("GET", f"/apis/{gv}"), versions)
+            for gv, r in zip(versions, lists):
+                if r.status_code == 200:
+                    register(gv, r.json().get("resources", []))
+        self._aliases, self._kinds = aliases, kinds
+        self._discovered = time.time()
+
+    def _lookup(self, table, key):
+        with self._lock:
+            if self._aliases is None:
+                self._discover()
+            res = getattr(self, table).get(key)
+            if res is None and time.time() - self._discovered > 10:
+                self._discover()
+                res = getattr(self, table).get(key)
+        return res
+
+    def resource(self, alias):
+        res = self._lookup("_aliases", alias.lower())
+        if res is None:
+            raise ApiError(404, "NotFound", f"the server doesn't have a resource type \"{alias}\"")
+        return res
+
+    def resource_for(self, api_version, kind):
+        group = "/" in api_version and api_version.split("/")[0] or ""
+        res = self._lookup("_kinds", (group, kind))
+        if res is None:
+            raise ApiError(404, "NotFound", f"no matches for kind \"{kind}\" in version \"{api_version}\"")
+        return res.with_version(api_version)
+
+    def _namespace(self, res, namespace):
+        if not res.namespaced:
+            return None
+        return namespace or self.config.namespace or "default"
+
+    # parse the positional arguments in a list of (resource, name)
+    def _targets(self, pos):
+        if len(pos) == 0:
+            raise Unsupported()
+        if "/" in pos[0]:
+            res = []
+            for p in pos:
+                kind, _, name = p.partition("/")
+                res.append((self.resource(kind), name))
+            return res
+        if "," in pos[0]:
+            if len(pos) != 1:
+                raise Unsupported()
+            return [(self.resource(kind), None) for kind in pos[0].split(",") if kind]
+        kind = self.resource(pos[0])
+        if len(pos) == 1:
+            return [(kind, None)]
+        return [(kind, name) for name in pos[1:]]
+
+    # load the objects passed with -f, flattening List kinds
+    def _documents(self, flags, input):
+        filename = flags.get("filename")
+        if filename is None:
+            raise Unsupported()
+        if filename == "-":
+            text = input.decode("utf-8") if isinstance(input, bytes) else input
+        elif os.path.isfile(filename):
+            with open(filename) as f:
+                text = f.read()
+        else:
+            raise Unsupported()
+        objs = []
+        for doc in yu.load_all(text or ""):
+            if doc.get("kind") == "List" or doc.get("kind", "").endswith("List") and "items" in doc:
+                objs.extend(doc.get("items") or [])
+            else:
+                objs.append(doc)
+        return objs
+
+    def get_object(self, res, namespace, name):
+        obj = self._check(self.request("GET", res.path(namespace, name))).json()
+        return obj
+
+    # the objects of the resource, only their metadata when metadata_only
+    # (then apiVersion and kind are the ones of the resource, not PartialObjectMetadata)
+    def list_objects(self, res, namespace, selector=None, metadata_only=False):
+        params = selector and {"labelSelector": selector} or None
+        headers = metadata_only and {"Accept": METADATA_LIST} or None
+        data = self._check(self.request("GET", res.path(namespace), params=params, headers=headers)).json()
+        items = data.get("items", [])
+        for item in items:
+            if metadata_only:
+                item["apiVersion"], item["kind"] = res.group_version, res.kind
+            item.setdefault("apiVersion", res.group_version)
+            item.setdefault("kind", res.kind)
+        return {"apiVersion": "v1", "kind": "List", "metadata": {"resourceVersion": ""}, "items": items}
+
+    def _get(self, pos, flags, namespace, input, jsonpath):
+        output = flags.get("output")
+        if jsonpath:
+            try:
+                jp.parse(jsonpath)
+            except ValueError:
+                raise Unsupported()
+        elif output not in ["json", "yaml"]:
+            raise Unsupported()
+        targets = self._targets(pos)
+        if len(targets) > 1 and all(name is None for _, name in targets):
+            # get kind1,kind2 lists all the kinds in a single List
+            obj = self.list_objects(targets[0][0], self._namespace(targets[0][0], namespace), flags.get("selector"))
+            for res, _ in targets[1:]:
+                more = self.list_objects(res, self._namespace(res, namespace), flags.get("selector"))
+                obj["items"].extend(more["items"])
+        elif len(targets) != 1:
+            raise Unsupported()
+        elif targets[0][1]:
+            res, name = targets[0]
+            obj = self.get_object(res, self._namespace(res, namespace), name)
+        else:
+            res = targets[0][0]
+            obj = self.list_objects(res, self._namespace(res, namespace), flags.get("selector"))
+        if jsonpath:
+            data = jp.query(obj, jsonpath)
+            return KubeResult(0, json.dumps(data), "", data)
+        if output == "json":
+            return KubeResult(0, json.dumps(obj, indent=4))
+        return KubeResult(0, yu.dump(obj))
+
+    def _apply(self, pos, flags, namespace, input, jsonpath):
+        if pos or len(flags) != 1:
+            raise Unsupported()
+        objs = self._documents(flags, input)
+        lines, written = [], []
+        for obj in objs:
+            res = self.resource_for(obj["apiVersion"], obj["kind"])
+            name = obj["metadata"]["name"]
+            ns = self._namespace(res, obj["metadata"].get("namespace") or namespace)
+            r = self._check(self.request("PATCH", res.path(ns, name),
+                params={"fieldManager": FIELD_MANAGER, "force": "true"},
+                headers={"Content-Type": "application/apply-patch+yaml"},
+                data=json.dumps(obj)))
+            lines.append(f"{res.display()}/{name} {r.status_code == 201 and 'created' or 'serverside-applied'}")
+            written.append(_written(res, name, r))
+        return KubeResult(0, "".join(f"{line}\n" for line in lines), written=written)
+
+    def _delete(self, pos, flags, namespace, input, jsonpath):
+        if "filename" in flags:
+            if pos or len(flags) != 1:
+                raise Unsupported()
+            targets = []
+            for obj in self._documents(flags, input):
+                res = self.resource_for(obj["apiVersion"], obj["kind"])
+                ns = self._namespace(res, obj["metadata"].get("namespace") or namespace)
+                targets.append((res, ns, obj["metadata"]["name"]))
+        else:
+            targets = []
+            for res, name in self._targets(pos):
+                ns = self._namespace(res, namespace)
+                if name:
+                    targets.append((res, ns, name))
+                elif "selector" in flags:
+                    for item in self.list_objects(res, ns, flags["selector"])["items"]:
+                        targets.append((res, ns, item["metadata"]["name"]))
+                else:
+                    raise Unsupported()
+        body = json.dumps({"kind": "DeleteOptions", "apiVersion": "v1", "propagationPolicy": "Background"})
+        lines, errors = [], []
+        for res, ns, name in targets:
+            try:
+                self._check(self.request("DELETE", res.path(ns, name), data=body,
+                    headers={"Content-Type": "application/json"}))
+                lines.append(f"{res.display()} \"{name}\" deleted\n")
+            except ApiError as e:
+                errors.append(f"{e}\n")
+        return KubeResult(errors and 1 or 0, "".join(lines), "".join(errors))
+
+    def _patch(self, pos, flags, namespace, input, jsonpath):
+        targets = self._targets(pos)
+        if len(targets) != 1 or targets[0][1] is None or "patch" not in flags:
+            raise Unsupported()
+        content_type = PATCH_TYPES.get(flags.get("type", "strategic"))
+        if not content_type:
+            raise Unsupported()
+        res, name = targets[0]
+        r = self._check(self.request("PATCH", res.path(self._namespace(res, namespace), name),
+            headers={"Content-Type": content_type}, data=flags["patch"]))
+        return KubeResult(0, f"{res.display()}/{name} patched\n", written=[_written(res, name, r)])
+
+    def _annotate(self, pos, flags, namespace, input, jsonpath):
+        if not flags.get("overwrite"):
+            raise Unsupported()
+        names = [p for p in pos if not "=" in p and not p.endswith("-")]
+        annotations = {}
+        for p in pos[len(names):]:
+            if "=" in p:
+                key, _, value = p.partition("=")
+                annotations[key] = value
+            elif p.endswith("-"):
+                annotations[p[:-1]] = None
+            else:
+                raise Unsupported()
+        targets = self._targets(names)
+        if any(name is None for _, name in targets):
+            raise Unsupported()
+        data = json.dumps({"metadata": {"annotations": annotations}})
+        out, written = "", []
+        for res, name in targets:
+            r = self._check(self.request("PATCH", res.path(self._namespace(res, namespace), name),
+                headers={"Content-Type": PATCH_TYPES["merge"]}, data=data))
+            out += f"{res.display()}/{name} annotated\n"
+            written.append(_written(res, name, r))
+        return KubeResult(0, out, written=written)
+
+    def _condition_met(self, obj, condition):
+        ctype, _, status = condition.partition("=")
+        status = status or "true"
+        for c in obj.get("status", {}).get("conditions", []) or []:
+            if c.get("type", "").lower() == ctype.lower():
+                return str(c.get("status", "")).lower() == status.lower()
+        return False
+
+    def _wait(self, pos, flags, namespace, input, jsonpath):
+        targets = self._targets(pos)
+        wait_for = flags.get("for", "")
+        if len(targets) != 1 or targets[0][1] is None:
+            raise Unsupported()
+        if not (wait_for == "delete" or wait_for.startswith("condition=")):
+            raise Unsupported()
+        res, name = targets[0]
+        ns = self._namespace(res, namespace)
+        deadline = time.time() + parse_timeout(flags.get("timeout", "30s"))
+        while True:
+            try:
+                obj = self.get_object(res, ns, name)
+            except ApiError as e:
+                if e.code == 404 and wait_for == "delete":
+                    return KubeResult(0, f"{res.display()}/{name} condition met\n")
+                raise
+            if wait_for != "delete" and self._condition_met(obj, wait_for[len("condition="):]):
+                return KubeResult(0, f"{res.display()}/{name} condition met\n")
+            if time.time() >= deadline:
+                return KubeResult(1, "", f"error: timed out waiting for the condition on {res.plural}/{name}\n")
+            time.sleep(1)
+
+    def _scale(self, pos, flags, namespace, input, jsonpath):
+        targets = self._targets(pos)
+        if len(targets) != 1 or targets[0][1] is None or "replicas" not in flags:
+            raise Unsupported()
+        res, name = targets[0]
+        data = json.dumps({"spec": {"replicas": int(flags["replicas"])}})
+        self._check(self.request("PATCH", res.path(self._namespace(res, namespace), name, "scale"),
+            headers={"Content-Type": PATCH_TYPES["merge"]}, data=data))
+        return KubeResult(0, f"{res.display()}/{name} scaled\n")
+
+    def _rollout(self, pos, flags, namespace, input, jsonpath):
+        if len(pos) < 2 or pos[0] != "restart" or flags:
+            raise Unsupported()
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        data = json.dumps({"spec": {"template": {"metadata": {"annotations": {"kubectl.kubernetes.io/restartedAt": now}}}}})
+        targets = self._targets(pos[1:])
+        if any(name is None for _, name in targets):
+            raise Unsupported()
+        out = ""
+        for res, name in targets:
+            self._check(self.request("PATCH", res.path(self._namespace(res, namespace), name),
+                headers={"Content-Type": PATCH_TYPES["strategic"]}, data=data))
+            out += f"{res.display()}/{name} restarted\n"
+        return KubeResult(0, out)
+
+    # execute a kubectl-like command, returning a KubeResult
+    # or None when the command has to be executed by kubectl
+    def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+        parsed = parse_args(args)
+        if not parsed or not parsed[0] in self._handlers:
+            return None
+        verb, pos, flags = parsed
+        try:
+            return self._handlers[verb](pos, flags, namespace, input, jsonpath)
+        except Unsupported:
+            logging.debug(f"api backend delegating to kubectl: {list(args)}")
+            return None
+        except ApiError as e:
+            return KubeResult(1, "", f"{e}\n")
+        except Exception as e:
+            return KubeResult(1, "", f"error: {e}\n")
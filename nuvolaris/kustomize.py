@@ -17,10 +17,257 @@
 #
 # this module wraps generation of kustomizations
 
-import os, io, yaml, subprocess
+import os, json, copy, shutil, hashlib, logging, tempfile, threading, subprocess, contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
 import nuvolaris.kube as kube
 import nuvolaris.kustomize as nku
 import nuvolaris.template as ntp
+import nuvolaris.kustomize_native as native
+import nuvolaris.yaml_util as yu
+
+# renderer used by default: "kustomize" runs kustomize build, "native" renders in process
+RENDERER = os.environ.get("NUVOLARIS_KUSTOMIZE_RENDERER", "kustomize")
+
+# a bounded map evicting the least recently used entries
+# when a directory is given values (strings) are also stored there, named by key
+class LruCache:
+    """
+    >>> c = LruCache(2)
+    >>> c.put("a", "1"); c.put("b", "2"); c.get("a")
+    '1'
+    >>> c.put("c", "3"); c.get("b") is None, c.get("a"), len(c)
+    (True, '1', 2)
+    """
+    def __init__(self, size, dir=None):
+        self.size = size
+        self.dir = dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        value = self._load(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.put(key, value, store=False)
+        return value
+
+    def put(self, key, value, store=True):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+        if store and self.dir:
+            try:
+                os.makedirs(self.dir, exist_ok=True)
+                tmp = f"{self.dir}/{key}.tmp"
+                with open(tmp, "w") as f:
+                    f.write(value)
+                os.replace(tmp, f"{self.dir}/{key}")
+            except Exception as e:
+                logging.warning(f"cannot store {key} in {self.dir}: {e}")
+
+    def _load(self, key):
+        if not self.dir:
+            return None
+        try:
+            with open(f"{self.dir}/{key}") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# kustomize builds by digest of the input files, also on disk if NUVOLARIS_KUSTOMIZE_CACHE_DIR is set
+# the size is NUVOLARIS_KUSTOMIZE_CACHE_SIZE, 0 disables the cache
+_builds = LruCache(int(os.environ.get("NUVOLARIS_KUSTOMIZE_CACHE_SIZE", "64")),
+                   os.environ.get("NUVOLARIS_KUSTOMIZE_CACHE_DIR"))
+# parsed lists by digest of the built yaml
+_lists = LruCache(int(os.environ.get("NUVOLARIS_KUSTOMIZE_CACHE_SIZE", "64")))
+
+# digest of the files kustomize reads building a folder: the generated kustomization.yaml,
+# the resources and the spooled templates and patches, which carry the template data
+def digest(dir):
+    """
+    >>> d1 = digest("deploy/test")
+    >>> len(d1), d1 == digest("deploy/test")
+    (64, True)
+    """
+    h = hashlib.sha256()
+    for file in sorted(os.listdir(dir)):
+        path = f"{dir}/{file}"
+        if not os.path.isfile(path):
+            continue
+        h.update(file.encode("utf-8") + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def _kustomize_build(dir):
+    res = subprocess.run(["kustomize", "build", dir], capture_output=True)
+    return res.stdout.decode("utf-8"), res.returncode == 0
+
+# render the folder in process, falling back to kustomize for what it does not support
+# the parsed objects are kept so that kustom_list does not parse them again
+def _native_build(dir):
+    try:
+        items = native.render(dir)
+    except Exception as e:
+        logging.warning(f"native kustomize of {dir} failed, using kustomize: {e}")
+        return _kustomize_build(dir)
+    out = native.dump(items)
+    if _lists.size:
+        _lists.put(hashlib.sha256(out.encode("utf-8")).hexdigest(), items)
+    return out, True
+
+# build the folder, unless the same inputs were already built
+def _build(dir, renderer=None):
+    build = _native_build if (renderer or RENDERER) == "native" else _kustomize_build
+    if _builds.size == 0:
+        return build(dir)[0]
+    key = digest(dir)
+    if build == _native_build:
+        key = f"native-{key}"
+    out = _builds.get(key)
+    if out is not None:
+        logging.debug(f"kustomize {dir}: cached {key[:12]}")
+        return out
+    out, ok = build(dir)
+    if ok:
+        _builds.put(key, out)
+    return out
+
+# parse the built yaml in a list, reusing the last parsing of the same yaml
+def _parse(yml):
+    key = hashlib.sha256(yml.encode("utf-8")).hexdigest()
+    items = _lists.get(key) if _lists.size else None
+    if items is None:
+        items = yu.load_all(yml)
+        if _lists.size:
+            _lists.put(key, items)
+    return {"apiVersion": "v1", "kind": "List", "items": copy.deepcopy(items)}
+
+# a private copy of the deploy folders, where the generated files of a reconcile are written
+class Workspace:
+    def __init__(self, root):
+        self.root = root
+        self.staged = set()
+        self._lock = threading.Lock()
+
+    # the staged copy of deploy/<where>, with the files hardlinked (copied across filesystems)
+    # leftovers of unstaged runs (kustomization.yaml and __ files) are not staged
+    def folder(self, where):
+        dir = f"{self.root}/{where}"
+        with self._lock:
+            if where not in self.staged:
+                os.makedirs(dir, exist_ok=True)
+                src = f"deploy/{where}"
+                for file in os.listdir(src) if os.path.isdir(src) else []:
+                    if _generated(file):
+                        continue
+                    if os.path.isdir(f"{src}/{file}"):
+                        shutil.copytree(f"{src}/{file}", f"{dir}/{file}", copy_function=_link)
+                    else:
+                        _link(f"{src}/{file}", f"{dir}/{file}")
+                self.staged.add(where)
+        return dir
+
+def _link(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+# where workspaces are created, better on a tmpfs
+STAGING_DIR = os.environ.get("NUVOLARIS_STAGING_DIR") or tempfile.gettempdir()
+_workspace = contextvars.ContextVar("workspace", default=None)
+
+# run the block with a private workspace for the deploy folders, removed at the end
+# it can decorate the handlers, nested scopes use the outer workspace
+@contextmanager
+def staging():
+    """
+    >>> with staging():
+    ...     staged = folder("test")
+    ...     _ = patchTemplate("test", "set-attach.yaml", {"name": "n", "container": "c", "dir": "/d"})
+    ...     os.path.exists(f"{staged}/__set-attach.yaml"), os.path.exists(f"{staged}/pod.yaml")
+    (True, True)
+    >>> os.path.exists(staged), folder("test")
+    (False, 'deploy/test')
+    """
+    if _workspace.get() is not None:
+        yield _workspace.get()
+        return
+    root = tempfile.mkdtemp(prefix="nuv-", dir=STAGING_DIR)
+    token = _workspace.set(Workspace(root))
+    try:
+        yield _workspace.get()
+    finally:
+        _workspace.reset(token)
+        shutil.rmtree(root, ignore_errors=True)
+
+# the generated files of the last kustomization of each folder, kept across the staging scopes
+# so that build can expand it again, as the delete of a component by owner does
+BUILT_DIR = os.environ.get("NUVOLARIS_BUILT_DIR") or f"{STAGING_DIR}/nuvolaris-built"
+
+def _generated(file):
+    return file == "kustomization.yaml" or file.startswith("__")
+
+# record the generated files of the staged folder, replacing atomically the previous ones
+def _remember(where, dir):
+    if _workspace.get() is None:
+        return
+    files = {}
+    for file in sorted(os.listdir(dir)):
+        if _generated(file) and os.path.isfile(f"{dir}/{file}"):
+            with open(f"{dir}/{file}") as f:
+                files[file] = f.read()
+    os.makedirs(BUILT_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=BUILT_DIR, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump(files, f)
+    os.replace(tmp, f"{BUILT_DIR}/{where}.json")
+
+# put back in the staged folder the generated files of the last kustomization, if any
+def _restore(where):
+    try:
+        with open(f"{BUILT_DIR}/{where}.json") as f:
+            files = json.load(f)
+    except (OSError, ValueError):
+        return False
+    for file, content in files.items():
+        with open(target(where, file), "w") as f:
+            f.write(content)
+    return True
+
+# the folder of the component: the staged copy in a staging scope, deploy/<where> otherwise
+def folder(where):
+    ws = _workspace.get()
+    return ws.folder(where) if ws else f"deploy/{where}"
+
+# the path of a file generated in the folder of the component
+# an existing file is removed first, so that the hardlinked sources are never overwritten
+def target(where, name):
+    path = f"{folder(where)}/{name}"
+    if _workspace.get() and os.path.lexists(path):
+        os.unlink(path)
+    return path
 
 # execute the kustomization of a folder under "deploy"
 # specified with `where`
@@ -29,7 +276,7 @@ import nuvolaris.template as ntp
 # you have to pass a list of kustomizations to apply
 # you can use various helpers in this module to generate customizations
 # it returns the expanded kustomization
-def kustomize(where, *what, templates=[], data={}):
+def kustomize(where, *what, templates=[], data={}, renderer=None):
     """Test kustomize
     >>> import nuvolaris.kustomize as ku
     >>> import nuvolaris.testutil as tu
@@ -46,14 +293,14 @@ def kustomize(where, *what, templates=[], data={}):
     name: test-svc
     """
     # prepare the kustomization
-    dir = f"deploy/{where}"
-    tgt = f"{dir}/kustomization.yaml"
+    dir = folder(where)
+    tgt = target(where, "kustomization.yaml")
     with open(tgt, "w") as f:
         f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n")
         for s in list(what):
             f.write(s)
         f.write("resources:\n")
-        dirs = os.listdir(f"deploy/{where}")
+        dirs = os.listdir(dir)
         dirs.sort()
         for file in dirs:
             if file == "kustomization.yaml":
@@ -63,21 +310,32 @@ def kustomize(where, *what, templates=[], data={}):
             f.write(f"- {file}\n")
         # adding extra temmplatized resources
         for template in templates:
-            out = f"deploy/{where}/__{template}"
+            out = target(where, f"__{template}")
             file = ntp.spool_template(template, out, data)
             f.write(f"- __{template}\n")
-    res = subprocess.run(["kustomize", "build", dir], capture_output=True)
-    return res.stdout.decode("utf-8")
+    _remember(where, dir)
+    return _build(dir, renderer)
 
 # execute the kustomization of a folder under "deploy"
 # specified with `where` returning the expanded kustomization
 # it expects that the folder contains already a full kustomization
 # this methid will be used to extract the existing kustomization in case
 # the nuvolaris operator needs to delete a component
-def build(where):
-    dir = f"deploy/{where}"
-    res = subprocess.run(["kustomize", "build", dir], capture_output=True)
-    return res.stdout.decode("utf-8")   
+# in a staging scope the kustomization generated by the last create is staged again
+def build(where, renderer=None):
+    """
+    >>> with staging():
+    ...     created = kustomize("test", image("nginx", "busybox"), templates=['testcm.yaml'], data={"name": "test-config"}, renderer="native")
+    >>> with staging():
+    ...     deleted = build("test", renderer="native")
+    >>> deleted == created, "name: test-config" in deleted, "image: busybox" in deleted
+    (True, True, True)
+    """
+    dir = folder(where)
+    if _workspace.get() is not None and not os.path.exists(f"{dir}/kustomization.yaml"):
+        if not _restore(where):
+            logging.warning(f"no kustomization of {where} was generated, building the static files")
+    return _build(dir, renderer)
 
 # execute the kustomization of a folder under "deploy"
 # specified with `where`
@@ -87,7 +345,7 @@ def build(where):
 # you have to pass a list of kustomizations to apply
 # you can use various helpers in this module to generate customizations
 # it returns the expanded kustomization
-def restricted_kustomize(where, *what, templates=[], templates_filter=[],data={}):
+def restricted_kustomize(where, *what, templates=[], templates_filter=[],data={}, renderer=None):
     """Test kustomize
     >>> import nuvolaris.kustomize as ku
     >>> import nuvolaris.testutil as tu
@@ -104,14 +362,14 @@ def restricted_kustomize(where, *what, templates=[], templates_filter=[],data={}
     name: test-svc
     """
     # prepare the kustomization
-    dir = f"deploy/{where}"
-    tgt = f"{dir}/kustomization.yaml"
+    dir = folder(where)
+    tgt = target(where, "kustomization.yaml")
     with open(tgt, "w") as f:
         f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n")
         for s in list(what):
             f.write(s)
         f.write("resources:\n")
-        dirs = os.listdir(f"deploy/{where}")
+        dirs = os.listdir(dir)
         dirs.sort()
         for file in dirs:
             if file == "kustomization.yaml":
@@ -122,11 +380,11 @@ def restricted_kustomize(where, *what, templates=[], templates_filter=[],data={}
               f.write(f"- {file}\n")
         # adding extra temmplatized resources
         for template in templates:
-            out = f"deploy/{where}/__{template}"
+            out = target(where, f"__{template}")
             file = ntp.spool_template(template, out, data)
             f.write(f"- __{template}\n")
-    res = subprocess.run(["kustomize", "build", dir], capture_output=True)
-    return res.stdout.decode("utf-8")    
+    _remember(where, dir)
+    return _build(dir, renderer)    
 
 # generate image kustomization
 def image(name, newName=None, newTag=None):
@@ -165,7 +423,7 @@ def configMapTemplate(name, where, template, data):
       files:
       - test.json=__test.json
     """
-    out = f"deploy/{where}/__{template}"
+    out = target(where, f"__{template}")
     file = ntp.spool_template(template, out, data)
     return f"""configMapGenerator:
 - name: {name}
@@ -186,7 +444,7 @@ def patchTemplate(where, template, data):
     >>> os.path.exists("deploy/test/__set-attach.yaml")
     True
     """
-    out = f"deploy/{where}/__{template}"
+    out = target(where, f"__{template}")
     file = ntp.spool_template(template, out, data)
     return f"""patches:
 - path: __{template}
@@ -207,7 +465,7 @@ def patchTemplates(where, templates=[], data={}):
     """
     paths = []
     for template in templates:
-      out = f"deploy/{where}/__{template}"
+      out = target(where, f"__{template}")
       file = ntp.spool_template(template, out, data)
       paths.append(f"- path: __{template}\n")
 
@@ -236,7 +494,7 @@ def secretLiteral(name, *args):
   return res
 
 # returns a list of kustomized objects
-def kustom_list(where, *what, templates=[], data={}):
+def kustom_list(where, *what, templates=[], data={}, renderer=None):
   """
   >>> import nuvolaris.kustomize as nku
   >>> where = "test"
@@ -247,14 +505,12 @@ def kustom_list(where, *what, templates=[], data={}):
   >>> print(out)
   ['Pod', 'Service']
   """
-  yml = nku.kustomize(where, *what, templates=templates, data=data)
-  stream = io.StringIO(yml)
-  res = list(yaml.load_all(stream, yaml.Loader))
-  return {"apiVersion": "v1", "kind": "List", "items": res }
+  yml = nku.kustomize(where, *what, templates=templates, data=data, renderer=renderer)
+  return _parse(yml)
 
 
 # returns a list of kustomized objects restricting the deploy available templates to given ones
-def restricted_kustom_list(where, *what, templates=[], templates_filter=[], data={}):
+def restricted_kustom_list(where, *what, templates=[], templates_filter=[], data={}, renderer=None):
   """
   >>> import nuvolaris.kustomize as nku
   >>> where = "test"
@@ -265,35 +521,33 @@ def restricted_kustom_list(where, *what, templates=[], templates_filter=[], data
   >>> print(out)
   ['Pod', 'Service']
   """
-  yml = nku.restricted_kustomize(where, *what, templates=templates, templates_filter=templates_filter,data=data)
-  stream = io.StringIO(yml)
-  res = list(yaml.load_all(stream, yaml.Loader))
-  return {"apiVersion": "v1", "kind": "List", "items": res }
+  yml = nku.restricted_kustomize(where, *what, templates=templates, templates_filter=templates_filter,data=data, renderer=renderer)
+  return _parse(yml)
 
 # load the given yaml file under deploy/{where} folder
 def raw(where, yamlfile):
-  with open(f"deploy/{where}/{yamlfile}", 'r') as f:
-    return list(yaml.load_all(f, yaml.Loader))
+  with open(f"{folder(where)}/{yamlfile}", 'r') as f:
+    return yu.load_all(f)
 
 def processTemplate(where,template,data,out_template=None):
     """
     merges the given template and write it under the deploy/{where} folder returning a kind list items
     """  
-    out = f"deploy/{where}/_{template}"
+    out = target(where, f"_{template}")
 
     if(out_template):
-      out = f"deploy/{where}/{out_template}"
+      out = target(where, out_template)
 
-    ntp.spool_template(template, out, data)
-    with open(out, 'r') as f:
-      res = list(yaml.load_all(f, yaml.Loader))
-      return {"apiVersion": "v1", "kind": "List", "items": res }
+    text = ntp.expand_template(template, data)
+    with open(out, "w") as f:
+      f.write(text)
+    return {"apiVersion": "v1", "kind": "List", "items": yu.load_all(text) }
 
 def renderTemplate(where,template,data,out_template):
     """
     merges the given template and write it under the deploy/{where} folder returning the relative generated file path
     """  
-    out = f"deploy/{where}/{out_template}"
+    out = target(where, out_template)
     ntp.spool_template(template, out, data)
     return out
 
@@ -0,0 +1,505 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module renders in process the subset of kustomize used by the operator:
+# resources, images, patches (strategic merge and json6902), configMapGenerator
+# and secretGenerator with the name hash suffix, without running kustomize build
+import os, re, json, base64, hashlib, copy
+import nuvolaris.informer as informer
+import nuvolaris.yaml_util as yu
+
+SUPPORTED = ["apiVersion", "kind", "resources", "images", "patches", "patchesStrategicMerge",
+             "patchesJson6902", "configMapGenerator", "secretGenerator", "generatorOptions"]
+
+# the kustomize legacy ordering of the output
+ORDER_FIRST = ["Namespace", "ResourceQuota", "StorageClass", "CustomResourceDefinition", "ServiceAccount",
+               "PodSecurityPolicy", "Role", "ClusterRole", "RoleBinding", "ClusterRoleBinding", "ConfigMap",
+               "Secret", "Endpoints", "Service", "LimitRange", "PriorityClass", "PersistentVolume",
+               "PersistentVolumeClaim", "Deployment", "StatefulSet", "CronJob", "PodDisruptionBudget"]
+ORDER_LAST = ["MutatingWebhookConfiguration", "ValidatingWebhookConfiguration"]
+
+# merge keys of the lists of the kubernetes schema
+MERGE_KEYS = {
+    "containers": "name", "initContainers": "name", "ephemeralContainers": "name", "volumes": "name",
+    "env": "name", "imagePullSecrets": "name", "volumeMounts": "mountPath", "volumeDevices": "devicePath",
+    "hostAliases": "ip", "conditions": "type", "topologySpreadConstraints": "topologyKey"
+}
+# lists without a merge key in the kubernetes schema, always replaced
+REPLACED = ["tolerations", "volumeClaimTemplates", "args", "command", "envFrom", "matchExpressions",
+            "values", "accessModes", "rules", "subjects"]
+# keys guessed for lists not in the schema, as kustomize does
+ASSOCIATIVE = ["mountPath", "devicePath", "ip", "type", "topologyKey", "name", "containerPort"]
+
+# the kustomize name suffix of a generated configmap or secret
+def name_hash(obj):
+    """
+    >>> name_hash({"kind": "ConfigMap", "metadata": {"name": ""}, "data": {"one": ""}})
+    '9g67k2htb6'
+    >>> name_hash({"kind": "Secret", "type": "my-type", "metadata": {"name": ""}, "data": {"one": ""}})
+    '74bd68bm66'
+    """
+    m = {"kind": obj["kind"], "name": obj["metadata"]["name"], "data": obj.get("data") or {}}
+    if obj["kind"] == "Secret":
+        m["type"] = obj.get("type", "Opaque")
+    if obj.get("binaryData"):
+        m["binaryData"] = obj["binaryData"]
+    # as encoding/json in go
+    enc = json.dumps(m, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    for c, e in [("<", "\\u003c"), (">", "\\u003e"), ("&", "\\u0026"), ("\u2028", "\\u2028"),
+                 ("\u2029", "\\u2029"), ("\\b", "\\u0008"), ("\\f", "\\u000c")]:
+        enc = enc.replace(c, e)
+    hex = hashlib.sha256(enc.encode("utf-8")).hexdigest()[:10]
+    return hex.translate(str.maketrans("013ae", "ghkmt"))
+
+def _unquote(value):
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+# the key/value pairs of a generator, values as bytes
+def _sources(dir, gen):
+    pairs = []
+    for file in gen.get("files", []):
+        key, _, path = file.rpartition("=")
+        with open(os.path.join(dir, path), "rb") as f:
+            pairs.append((key or os.path.basename(path), f.read()))
+    for env in gen.get("envs", []) + ([gen["env"]] if gen.get("env") else []):
+        with open(os.path.join(dir, env)) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    key, _, value = line.partition("=")
+                    pairs.append((key, value.encode("utf-8")))
+    for literal in gen.get("literals", []):
+        key, _, value = literal.strip().partition("=")
+        pairs.append((key, _unquote(value).encode("utf-8")))
+    return pairs
+
+def _generators(kust):
+    return [(kind, gen) for kind, field in [("ConfigMap", "configMapGenerator"), ("Secret", "secretGenerator")]
+            for gen in kust.get(field) or []]
+
+# build the configmaps and secrets of the generators
+def generate(dir, kust):
+    """
+    >>> [cm] = generate(".", {"configMapGenerator": [{"name": "test-cm", "namespace": "nuvolaris", "literals": ["a=b"]}]})
+    >>> cm["metadata"], cm["data"]
+    ({'name': 'test-cm-f688mb52fh', 'namespace': 'nuvolaris'}, {'a': 'b'})
+    >>> [sec] = generate(".", {"secretGenerator": [{"name": "auth", "literals": ["user=mike"]}]})
+    >>> sec["type"], sec["data"]
+    ('Opaque', {'user': 'bWlrZQ=='})
+    """
+    opts = kust.get("generatorOptions") or {}
+    res = []
+    for kind, gen in _generators(kust):
+        if gen.get("behavior", "create") != "create":
+            raise Exception(f"generator behavior {gen['behavior']} not supported")
+        obj = {"apiVersion": "v1", "kind": kind, "metadata": {"name": gen["name"]}}
+        if gen.get("namespace"):
+            obj["metadata"]["namespace"] = gen["namespace"]
+        gopts = dict(opts, **(gen.get("options") or {}))
+        for meta in ["labels", "annotations"]:
+            if gopts.get(meta):
+                obj["metadata"][meta] = dict(gopts[meta])
+        data, binary = {}, {}
+        for key, value in _sources(dir, gen):
+            if kind == "Secret":
+                data[key] = base64.b64encode(value).decode("ascii")
+                continue
+            try:
+                data[key] = value.decode("utf-8")
+            except UnicodeDecodeError:
+                binary[key] = base64.b64encode(value).decode("ascii")
+        if kind == "Secret":
+            obj["type"] = gen.get("type", "Opaque")
+        obj["data"] = data
+        if binary:
+            obj["binaryData"] = binary
+        if not gopts.get("disableNameSuffixHash"):
+            obj["metadata"]["name"] = f"{gen['name']}-{name_hash(obj)}"
+        res.append(obj)
+    return res
+
+def _namespace(obj):
+    return obj.get("metadata", {}).get("namespace") or "default"
+
+# check if the object is selected by a kustomize target
+def selected(obj, target):
+    """
+    >>> pvc = {"apiVersion": "v1", "kind": "PersistentVolumeClaim", "metadata": {"name": "mongodb-data", "namespace": "nuvolaris"}}
+    >>> selected(pvc, {"version": "v1", "kind": "PersistentVolumeClaim", "namespace": "nuvolaris", "name": "mongodb-data"})
+    True
+    >>> selected(pvc, {"kind": "PersistentVolumeClaim", "name": "mongodb-.*"}), selected(pvc, {"group": "apps"})
+    (True, False)
+    """
+    group, _, version = obj.get("apiVersion", "").rpartition("/")
+    meta = obj.get("metadata", {})
+    if target.get("group") and target["group"] != group:
+        return False
+    if target.get("version") and target["version"] != version:
+        return False
+    if target.get("kind") and target["kind"] != obj.get("kind"):
+        return False
+    if target.get("name") and not re.fullmatch(target["name"], meta.get("name", "")):
+        return False
+    if target.get("namespace") and not re.fullmatch(target["namespace"], _namespace(obj)):
+        return False
+    if target.get("labelSelector") and not informer.match_selector(meta.get("labels"), target["labelSelector"]):
+        return False
+    if target.get("annotationSelector") and not informer.match_selector(meta.get("annotations"), target["annotationSelector"]):
+        return False
+    return True
+
+def _merge_key(field, items):
+    if field in REPLACED:
+        return None
+    if not items or not all(isinstance(i, dict) for i in items):
+        return None
+    if field == "ports":
+        return "containerPort" if any("containerPort" in i for i in items) else "port"
+    if field in MERGE_KEYS:
+        return MERGE_KEYS[field]
+    for key in ASSOCIATIVE:
+        if all(key in i for i in items):
+            return key
+    return None
+
+def _clean(value):
+    if isinstance(value, dict):
+        return {k: _clean(v) for k, v in value.items() if not k.startswith("$")}
+    if isinstance(value, list):
+        return [_clean(v) for v in value if not (isinstance(v, dict) and "$patch" in v)]
+    return copy.deepcopy(value)
+
+def _merge_list(orig, patch, field):
+    if any(isinstance(i, dict) and i.get("$patch") == "replace" for i in patch):
+        return _clean(patch)
+    key = _merge_key(field, [i for i in orig + patch if not (isinstance(i, dict) and "$patch" in i and len(i) == 1)])
+    if key is None:
+        return _clean(patch)
+    res = copy.deepcopy(orig)
+    for item in patch:
+        pos = [n for n, o in enumerate(res) if isinstance(o, dict) and key in item and o.get(key) == item.get(key)]
+        if item.get("$patch") == "delete":
+            res = [o for n, o in enumerate(res) if n not in pos]
+        elif pos:
+            res[pos[0]] = merge(res[pos[0]], item)
+        else:
+            res.append(_clean(item))
+    return res
+
+# apply a strategic merge patch: maps are merged, lists by their merge key if they have one,
+# a null value deletes the field and the $patch directives replace or delete
+def merge(orig, patch, field=None):
+    """
+    >>> sts = {"spec": {"template": {"spec": {"containers": [{"name": "redis", "image": "redis"}], "tolerations": [{"key": "a"}]}}}}
+    >>> patch = {"spec": {"template": {"spec": {"containers": [{"name": "redis", "volumeMounts": [{"name": "data", "mountPath": "/data"}]}], "tolerations": None}}}}
+    >>> merge(sts, patch)
+    {'spec': {'template': {'spec': {'containers': [{'name': 'redis', 'image': 'redis', 'volumeMounts': [{'name': 'data', 'mountPath': '/data'}]}]}}}}
+    >>> merge({"a": {"b": 1, "c": 2}}, {"a": {"$patch": "replace", "d": 3}})
+    {'a': {'d': 3}}
+    """
+    if not isinstance(orig, dict) or not isinstance(patch, dict):
+        return _clean(patch)
+    if patch.get("$patch") == "replace":
+        return _clean(patch)
+    res = copy.deepcopy(orig)
+    for key, value in patch.items():
+        if key.startswith("$"):
+            continue
+        if value is None:
+            res.pop(key, None)
+        elif isinstance(value, dict) and value.get("$patch") == "delete":
+            res.pop(key, None)
+        elif isinstance(value, dict) and isinstance(res.get(key), dict):
+            res[key] = merge(res[key], value, key)
+        elif isinstance(value, list) and isinstance(res.get(key), list):
+            res[key] = _merge_list(res[key], value, key)
+        else:
+            res[key] = _clean(value)
+    return res
+
+def _pointer(path):
+    if path == "":
+        return []
+    return [p.replace("~1", "/").replace("~0", "~") for p in path.split("/")[1:]]
+
+def _resolve(doc, parts):
+    for p in parts:
+        doc = doc[int(p)] if isinstance(doc, list) else doc[p]
+    return doc
+
+def _index(container, key, add=False):
+    if key == "-" and add:
+        return len(container)
+    n = int(key)
+    if n < 0 or n > len(container) or (n == len(container) and not add):
+        raise Exception(f"index {key} out of range")
+    return n
+
+# apply a json6902 patch, as a list of operations
+def json_patch(doc, ops):
+    """
+    >>> pvc = {"spec": {"resources": {"requests": {"storage": "1Gi"}}, "accessModes": ["ReadWriteOnce"]}}
+    >>> json_patch(pvc, [{"op": "replace", "path": "/spec/resources/requests/storage", "value": "10Gi"},
+    ...                  {"op": "add", "path": "/spec/accessModes/-", "value": "ReadOnlyMany"}])
+    {'spec': {'resources': {'requests': {'storage': '10Gi'}}, 'accessModes': ['ReadWriteOnce', 'ReadOnlyMany']}}
+    """
+    doc = copy.deepcopy(doc)
+    for op in ops:
+        kind, parts = op["op"], _pointer(op["path"])
+        if kind in ["move", "copy"]:
+            value = copy.deepcopy(_resolve(doc, _pointer(op["from"])))
+            if kind == "move":
+                doc = json_patch(doc, [{"op": "remove", "path": op["from"]}])
+            doc = json_patch(doc, [{"op": "add", "path": op["path"], "value": value}])
+            continue
+        if kind == "test":
+            if _resolve(doc, parts) != op.get("value"):
+                raise Exception(f"test failed at {op['path']}")
+            continue
+        if not parts:
+            if kind in ["add", "replace"]:
+                doc = copy.deepcopy(op["value"])
+                continue
+            raise Exception(f"cannot {kind} the whole document")
+        parent, last = _resolve(doc, parts[:-1]), parts[-1]
+        if isinstance(parent, list):
+            if kind == "add":
+                parent.insert(_index(parent, last, True), copy.deepcopy(op["value"]))
+            elif kind == "remove":
+                parent.pop(_index(parent, last))
+            elif kind == "replace":
+                parent[_index(parent, last)] = copy.deepcopy(op["value"])
+            else:
+                raise Exception(f"unknown patch op {kind}")
+        else:
+            if kind in ["remove", "replace"] and last not in parent:
+                raise Exception(f"{kind} operation does not apply: doc is missing path {op['path']}")
+            if kind == "remove":
+                del parent[last]
+            elif kind in ["add", "replace"]:
+                parent[last] = copy.deepcopy(op["value"])
+            else:
+                raise Exception(f"unknown patch op {kind}")
+    return doc
+
+def _load_docs(text):
+    return yu.load_all(text)
+
+def _patches(dir, kust):
+    res = []
+    for entry in kust.get("patchesStrategicMerge") or []:
+        res.append({"path": entry} if os.path.isfile(os.path.join(dir, entry)) else {"patch": entry})
+    res += kust.get("patchesJson6902") or []
+    res += kust.get("patches") or []
+    return res
+
+# apply the patches in order to the objects
+def patch(dir, kust, objs):
+    for entry in _patches(dir, kust):
+        if "path" in entry:
+            with open(os.path.join(dir, entry["path"])) as f:
+                text = f.read()
+        else:
+            text = entry.get("patch") or ""
+        docs = _load_docs(text)
+        target = entry.get("target")
+        if len(docs) == 1 and isinstance(docs[0], list):
+            if not target:
+                raise Exception("json6902 patch without a target")
+            objs = [json_patch(o, docs[0]) if selected(o, target) else o for o in objs]
+            continue
+        for doc in docs:
+            if target:
+                objs = [merge(o, doc) if selected(o, target) else o for o in objs]
+                continue
+            meta = doc.get("metadata", {})
+            match = {"kind": doc.get("kind"), "name": re.escape(meta.get("name", ""))}
+            if meta.get("namespace"):
+                match["namespace"] = meta["namespace"]
+            if not any(selected(o, match) for o in objs):
+                raise Exception(f"no matches for patch {doc.get('kind')}/{meta.get('name')}")
+            objs = [merge(o, doc) if selected(o, match) else o for o in objs]
+    return objs
+
+def _split_image(image):
+    name, sep, digest = image.partition("@")
+    tag = ""
+    if ":" in name.rsplit("/", 1)[-1]:
+        name, tag = name.rsplit(":", 1)
+    return name, tag, digest
+
+# replace the images of the containers, as the images transformer does
+def set_images(obj, images):
+    """
+    >>> pod = {"spec": {"containers": [{"name": "a", "image": "nginx:1.2"}, {"name": "b", "image": "redis"}]}}
+    >>> set_images(pod, [{"name": "nginx", "newName": "busybox"}, {"name": "redis", "newTag": "7"}])
+    {'spec': {'containers': [{'name': 'a', 'image': 'busybox:1.2'}, {'name': 'b', 'image': 'redis:7'}]}}
+    """
+    if isinstance(obj, list):
+        return [set_images(o, images) for o in obj]
+    if not isinstance(obj, dict):
+        return obj
+    res = {}
+    for key, value in obj.items():
+        if key in ["containers", "initContainers"] and isinstance(value, list):
+            value = [_set_image(c, images) for c in value]
+        res[key] = set_images(value, images)
+    return res
+
+def _set_image(container, images):
+    if not isinstance(container, dict) or not isinstance(container.get("image"), str):
+        return container
+    name, tag, digest = _split_image(container["image"])
+    for img in images:
+        if img.get("name") != name:
+            continue
+        name = img.get("newName") or name
+        if img.get("newTag") is not None:
+            tag, digest = str(img["newTag"]), ""
+        if img.get("digest"):
+            tag, digest = "", img["digest"]
+        image = name + (f":{tag}" if tag else "") + (f"@{digest}" if digest else "")
+        return dict(container, image=image)
+    return container
+
+# references to configmaps and secrets in a pod spec
+def _pod_refs(spec):
+    refs = []
+    for vol in spec.get("volumes") or []:
+        refs.append(("ConfigMap", vol.get("configMap"), "name"))
+        refs.append(("Secret", vol.get("secret"), "secretName"))
+        for src in (vol.get("projected") or {}).get("sources") or []:
+            refs.append(("ConfigMap", src.get("configMap"), "name"))
+            refs.append(("Secret", src.get("secret"), "name"))
+    for c in (spec.get("containers") or []) + (spec.get("initContainers") or []):
+        for env in c.get("env") or []:
+            vf = env.get("valueFrom") or {}
+            refs.append(("ConfigMap", vf.get("configMapKeyRef"), "name"))
+            refs.append(("Secret", vf.get("secretKeyRef"), "name"))
+        for env in c.get("envFrom") or []:
+            refs.append(("ConfigMap", env.get("configMapRef"), "name"))
+            refs.append(("Secret", env.get("secretRef"), "name"))
+    for ref in spec.get("imagePullSecrets") or []:
+        refs.append(("Secret", ref, "name"))
+    return [r for r in refs if isinstance(r[1], dict)]
+
+def _pod_specs(obj):
+    spec = obj.get("spec") or {}
+    if obj.get("kind") == "Pod":
+        return [spec]
+    job = (spec.get("jobTemplate") or {}).get("spec") or {}
+    return [s for s in [(spec.get("template") or {}).get("spec"), (job.get("template") or {}).get("spec")] if s]
+
+# update the references to the generated names
+def rename_refs(objs, renamed):
+    """
+    >>> pod = {"kind": "Pod", "metadata": {}, "spec": {"volumes": [{"name": "cm", "configMap": {"name": "test-cm"}}]}}
+    >>> rename_refs([pod], {("ConfigMap", "default", "test-cm"): "test-cm-abc"})[0]["spec"]
+    {'volumes': [{'name': 'cm', 'configMap': {'name': 'test-cm-abc'}}]}
+    """
+    objs = copy.deepcopy(objs)
+    for obj in objs:
+        ns = _namespace(obj)
+        for spec in _pod_specs(obj):
+            for kind, ref, field in _pod_refs(spec):
+                new = renamed.get((kind, ns, ref.get(field)))
+                if new:
+                    ref[field] = new
+    return objs
+
+def _rank(obj):
+    kind = obj.get("kind")
+    if kind in ORDER_FIRST:
+        return ORDER_FIRST.index(kind)
+    if kind in ORDER_LAST:
+        return len(ORDER_FIRST) + 1 + ORDER_LAST.index(kind)
+    return len(ORDER_FIRST)
+
+def _sort_key(obj):
+    group, _, version = obj.get("apiVersion", "").rpartition("/")
+    gvk = f"{group or '~G'}_{version or '~V'}_{obj.get('kind') or '~K'}"
+    meta = obj.get("metadata", {})
+    return (_rank(obj), gvk, meta.get("namespace", ""), meta.get("name", ""))
+
+# load the resources listed in the kustomization, also flattening lists
+def resources(dir, kust):
+    objs = []
+    for res in kust.get("resources") or []:
+        path = os.path.join(dir, res)
+        if not os.path.isfile(path):
+            raise Exception(f"resource {res} is not a file")
+        with open(path) as f:
+            for doc in _load_docs(f.read()):
+                objs += (doc.get("items") or []) if doc.get("kind", "").endswith("List") else [doc]
+    return objs
+
+# render the kustomization of the folder returning the list of objects
+def render(dir):
+    """
+    >>> import tempfile, shutil
+    >>> dir = tempfile.mkdtemp()
+    >>> for f in ["pod.yaml", "svc.yaml"]: _ = shutil.copy(f"deploy/test/{f}", dir)
+    >>> with open(f"{dir}/kustomization.yaml", "w") as f:
+    ...     _ = f.write("resources:\\n- pod.yaml\\n- svc.yaml\\nimages:\\n- name: nginx\\n  newName: busybox\\n"
+    ...                 "configMapGenerator:\\n- name: test-cm\\n  literals:\\n  - a=b\\n")
+    >>> [(o["kind"], o["metadata"]["name"]) for o in render(dir)]
+    [('ConfigMap', 'test-cm-f688mb52fh'), ('Service', 'test-svc'), ('Pod', 'test-pod')]
+    >>> render(dir)[2]["spec"]["containers"][0]["image"]
+    'busybox'
+    >>> shutil.rmtree(dir)
+    """
+    with open(os.path.join(dir, "kustomization.yaml")) as f:
+        kust = yu.load(f) or {}
+    unsupported = [k for k in kust if k not in SUPPORTED]
+    if unsupported:
+        raise Exception(f"kustomization fields not supported: {unsupported}")
+    objs = resources(dir, kust)
+    generated = generate(dir, kust)
+    renamed = {}
+    for (kind, gen), obj in zip(_generators(kust), generated):
+        renamed[(kind, _namespace(obj), gen["name"])] = obj["metadata"]["name"]
+    objs = patch(dir, kust, objs + generated)
+    if kust.get("images"):
+        objs = [set_images(o, kust["images"]) for o in objs]
+    objs = rename_refs(objs, renamed)
+    return sorted(objs, key=_sort_key)
+
+class Dumper(yu.Dumper):
+    pass
+
+# multiline strings as literal blocks, as kustomize writes them
+def _str(dumper, value):
+    return dumper.represent_scalar("tag:yaml.org,2002:str", value, style="|" if "\n" in value else None)
+
+Dumper.add_representer(str, _str)
+
+# the objects as a yaml stream
+def dump(objs):
+    """
+    >>> print(dump([{"data": {"a": "x\\ny\\n"}}]), end="")
+    data:
+      a: |
+        x
+        y
+    """
+    return yu.dump_all(objs, Dumper=Dumper)
+
+# render the kustomization of the folder as a yaml stream
+def render_yaml(dir):
+    return dump(render(dir))
@@ -20,6 +20,12 @@ import logging
 import json, os, os.path
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
+import nuvolaris.metrics as metrics
+import nuvolaris.kustomize as kus
+import nuvolaris.template as ntp
+import nuvolaris.dag_util as dag
+import nuvolaris.executor_util as pools
+import nuvolaris.digest_util as dg
 import nuvolaris.redis as redis
 import nuvolaris.couchdb as couchdb
 import nuvolaris.bucket as bucket
@@ -34,14 +40,40 @@ import nuvolaris.minio_static as static
 import nuvolaris.operator_util as operator_util
 import nuvolaris.postgres_operator as postgres
 import nuvolaris.runtimes_preloader as preloader
+import nuvolaris.informer as informer
+import nuvolaris.detect_util as detect
 
 @kopf.on.startup()
-def configure(settings: kopf.OperatorSettings, **_):
+async def configure(settings: kopf.OperatorSettings, **_):
   settings.watching.server_timeout = 210
+  # the handlers are async, sync ones left share a pool of the same size
+  settings.execution.max_workers = pools.CONCURRENCY
+  try:
+    await pools.run("kube", informer.start)
+  except Exception as e:
+    logging.warning(f"cannot start informers, using kubectl lookups: {e}")
+  try:
+    await pools.run("kube", detect.start)
+  except Exception as e:
+    logging.warning(f"cannot watch nodes and storage classes, cluster detection expires after {detect.TTL}s: {e}")
+  try:
+    ntp.precompile()
+  except Exception as e:
+    logging.warning(f"cannot precompile templates: {e}")
+  try:
+    metrics.serve()
+  except Exception as e:
+    logging.warning(f"cannot serve metrics: {e}")
+
+@kopf.on.cleanup()
+async def cleanup(**_):
+  informer.stop()
+  metrics.stop()
+  pools.shutdown()
 
 # tested by an integration test
 @kopf.on.login()
-def login(**kwargs):
+async def login(**kwargs):
     token = '/var/run/secrets/kubernetes.io/serviceaccount/token'
     if os.path.isfile(token):
         logging.debug("found serviceaccount token: login via pykube in kubernetes")
@@ -49,12 +81,28 @@ def login(**kwargs):
     logging.debug("login via client")
     return kopf.login_via_client(**kwargs)
 
+# time to deploy the components, when different from dag_util.DEFAULT_TIMEOUT
+TIMEOUTS = {
+    "preloader": 3600 # pulls all the runtime images
+}
+
 # tested by an integration test
 @kopf.on.create('nuvolaris.org', 'v1', 'whisks')
-def whisk_create(spec, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_create(spec, name, patch, **kwargs):
     logging.info(f"*** whisk_create {name}")
-
+    with cfg.scope(), kus.staging():
+        state, digests = await pools.run("kube", deploy, spec, name)
+        patch.status['digests'] = digests
+        cfg.publish()
+        return state
+
+# deploy the whisk, returning its state and the digests of the components deployed
+def deploy(spec, name):
     operator_util.config_from_spec(spec)
+    # the user handlers can start as soon as the configuration is known
+    cfg.publish()
     owner = kube.get(f"wsk/{name}")
 
     state = {
@@ -74,117 +122,38 @@ def whisk_create(spec, name, **kwargs):
         "zookeeper": "?" #Zookeeper configuration
     }
 
-    runtime = cfg.get('nuvolaris.kube')
-    logging.info(f"kubernetes engine in use={runtime}")
-
-    if cfg.get('components.openwhisk'):
-        try:
-            msg = preloader.create(owner)
-            state['preloader']= "on"
-            logging.info(msg)
-        except:
-            logging.exception("could not create runtime preloader batach")
-            state['preloader']= "error"
-    else:
-        state['preloader']= "off"   
-
-    if cfg.get('components.couchdb'):
-        try:
-            msg = couchdb.create(owner)
-            state['couchdb']= "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create couchdb")
-            state['couchdb']= "error"
-    else:
-        state['couchdb'] = "off"
-
-    if cfg.get('components.redis'):
-        try:
-            msg = redis.create(owner)
-            state['redis'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create redis")
-            state['redis']= "error"
-    else:
-        state['redis'] = "off"
-
-    if cfg.get('components.tls') and not runtime in ["kind","openshift"]:
-        try:
-            msg = issuer.create(owner)
-            state['issuer'] = "on"
-            state['tls'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot configure issuer")
-            state['issuer']= "error"
-            state['tls'] = "error"
-    else:
-        state['issuer'] = "off"
-        state['tls'] = "off"
-        if runtime == "kind" and cfg.get('components.tls'):
-            logging.info("*** cluster issuer will not be deployed with kind runtime")
-
-    if cfg.get('components.cron'):
-        try:
-            msg = cron.create(owner)
-            state['cron'] = "on"
-            logging.info(msg)
-        except:
-            logging.exception("cannot create cron")
-            state['cron']= "error"
-    else:
-        state['cron'] = "off" 
-
-    if cfg.get('components.minio'):
-        msg = minio.create(owner)
-        logging.info(msg)
-        state['minio'] = "on"
-    else:
-        state['minio'] = "off"
-
-    if cfg.get('components.static'):
-        msg = static.create(owner)
-        logging.info(msg)
-        state['static'] = "on"
-    else:
-        state['static'] = "off"
+    dag.run(steps(owner), state)
 
-    if cfg.get('components.postgres') or cfg.get('components.mongodb'):
-        msg = postgres.create(owner)
-        logging.info(msg)
-        state['postgres'] = "on"
-    else:
-        state['postgres'] = "off"
+    whisk_post_create(name,state)
+    return state, dg.applied(state)
 
-    if cfg.get('components.mongodb'):
-        msg = mongodb.create(owner)
-        logging.info(msg)
-        state['mongodb'] = "on"
-    else:
-        state['mongodb'] = "off"                        
-
-    if cfg.get('components.openwhisk'):
-        try:
-            msg = openwhisk.create(owner)
-            state['openwhisk'] = "on"
-            logging.info(msg)
-
-            msg = endpoint.create(owner)
-            state['endpoint'] = "on"
-            logging.info(msg)
-
-        except:
-            logging.exception("cannot create openwhisk")
-            state['openwhisk']= "error"
-            state['endpoint'] = "error"
-    else:
-        state['openwhisk'] = "off"
-        state['endpoint'] = "off"
+# the steps deploying the components, enabled according to the configuration
+def steps(owner):
+    runtime = cfg.get('nuvolaris.kube')
+    logging.info(f"kubernetes engine in use={runtime}")
 
-    whisk_post_create(name,state)
-    return state
+    tls = cfg.get('components.tls') and not runtime in ["kind","openshift"]
+    if runtime == "kind" and cfg.get('components.tls'):
+        logging.info("*** cluster issuer will not be deployed with kind runtime")
+
+    def create_openwhisk():
+        logging.info(openwhisk.create(owner))
+        return endpoint.create(owner)
+
+    # independent components are deployed concurrently, the others after what they need
+    # minio, static, postgres and mongodb errors fail the handler, so that kopf retries it
+    return [
+        dag.Step("preloader", lambda: preloader.create(owner), cfg.get('components.openwhisk'), timeout=TIMEOUTS.get("preloader")),
+        dag.Step("couchdb", lambda: couchdb.create(owner), cfg.get('components.couchdb')),
+        dag.Step("redis", lambda: redis.create(owner), cfg.get('components.redis')),
+        dag.Step("issuer", lambda: issuer.create(owner), tls, keys=["issuer", "tls"]),
+        dag.Step("cron", lambda: cron.create(owner), cfg.get('components.cron')),
+        dag.Step("minio", lambda: minio.create(owner), cfg.get('components.minio'), fatal=True),
+        dag.Step("static", lambda: static.create(owner), cfg.get('components.static'), needs=["minio"], fatal=True),
+        dag.Step("postgres", lambda: postgres.create(owner), cfg.get('components.postgres') or cfg.get('components.mongodb'), fatal=True),
+        dag.Step("mongodb", lambda: mongodb.create(owner), cfg.get('components.mongodb'), needs=["postgres"], fatal=True),
+        dag.Step("openwhisk", create_openwhisk, cfg.get('components.openwhisk'), needs=["couchdb"], keys=["openwhisk", "endpoint"])
+    ]
 
 def whisk_post_create(name, state):    
     sysres = operator_util.whisk_post_create(name)
@@ -195,10 +164,15 @@ def whisk_post_create(name, state):
 
 # tested by an integration test
 @kopf.on.delete('nuvolaris.org', 'v1', 'whisks')
-def whisk_delete(spec, **kwargs):
-    runtime = cfg.get('nuvolaris.kube')
+@pools.limited
+@metrics.reconcile
+async def whisk_delete(spec, **kwargs):
     logging.info("whisk_delete")
-   
+    with cfg.scope(), kus.staging():
+        await pools.run("kube", undeploy)
+
+def undeploy():
+    runtime = cfg.get('nuvolaris.kube')
 
     if cfg.get("components.openwhisk"):
         msge = preloader.delete()
@@ -275,28 +249,61 @@ def deploy_update(old, new, name, **kwargs):
         logging.info(kube.applyTemplate("couchdb-init.yaml", data))
 
 @kopf.on.update('nuvolaris.org', 'v1', 'whisks')
-def whisk_update(spec, status, namespace, diff, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_update(spec, status, namespace, diff, name, patch, **kwargs):
     logging.info(f"*** detected an update of wsk/{name} under namespace {namespace}")
-    
-    operator_util.config_from_spec(spec,handler_type="on_update")
-    owner = kube.get(f"wsk/{name}")
-
-    patcher.patch(diff, status, owner, name)
+    with cfg.scope(), kus.staging():
+        await pools.run("kube", operator_util.config_from_spec, spec, handler_type="on_update")
+        cfg.publish()
+        owner = await pools.run("kube", kube.get, f"wsk/{name}")
+        digests = await pools.run("kube", patcher.patch, diff, status, owner, name)
+        if digests is not None:
+            patch.status['digests'] = digests
+        cfg.publish()
 
 @kopf.on.resume('nuvolaris.org', 'v1', 'whisks')
-def whisk_resume(spec, name, **kwargs):   
+@pools.limited
+@metrics.reconcile
+async def whisk_resume(spec, name, status, patch, **kwargs):
+    with cfg.scope(), kus.staging():
+        patch.status['digests'] = await pools.run("kube", resume, spec, name, status)
+        cfg.publish()
+
+# re-run the components whose inputs changed since they were applied, returning the new digests
+# a whisk deployed before the digests were recorded is resumed as before, recording them
+def resume(spec, name, status):
     operator_util.config_from_spec(spec, handler_type="on_resume")
-    operator_util.whisk_post_resume(name)
+    cfg.publish()
+    digests = status.get("digests")
+    if digests is None:
+        operator_util.whisk_post_resume(name)
+        return dg.applied(status.get("whisk_create") or {})
+
+    changed = dg.changed(digests)
+    if not changed:
+        logging.info(f"*** inputs of wsk/{name} unchanged, nothing to resume")
+        return digests
+
+    logging.info(f"*** inputs of {changed} changed, resuming them")
+    owner = kube.get(f"wsk/{name}")
+    state = {}
+    dag.run([step for step in steps(owner) if step.name in changed], state)
+    state["whisk-system"] = operator_util.whisk_post_resume(name, changed) and "on" or "error"
+    return dg.patched(digests, list(state), [n for n, v in state.items() if v == "error"])
 
 def runtimes_filter(name, type, **kwargs):
     return name == 'openwhisk-runtimes' and type == 'MODIFIED'  
 
 @kopf.on.event("configmap", when=runtimes_filter)
-def runtimes_cm_event_watcher(event, **kwargs):    
+@pools.limited
+@metrics.reconcile
+async def runtimes_cm_event_watcher(event, **kwargs):
     logging.info("*** detected a change in cm/openwhisk-runtimes config map, restarting openwhisk related PODs")
-    owner = kube.get(f"wsk/controller") 
-    patcher.patch_preloader(owner)
+    with cfg.scope(), kus.staging():
+        owner = await pools.run("kube", kube.get, f"wsk/controller")
+        await pools.run("kube", patcher.patch_preloader, owner)
 
-    if cfg.get('components.openwhisk'):
-        patcher.restart_whisk(owner)
+        if cfg.get('components.openwhisk'):
+            await pools.run("kube", patcher.restart_whisk, owner)
 
@@ -0,0 +1,259 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module collects metrics of the kube calls, per verb, kind, kopf handler and component,
+# serving them in the prometheus text format and logging a summary at the end of each reconcile
+import os, re, sys, time, asyncio, logging, threading, contextvars
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# modules that are never the component issuing a call
+HELPERS = ["kube", "kube_api", "metrics", "util", "kustomize", "template", "informer", "readiness",
+           "exec_util", "configmap_util", "jsonpath_util", "testutil", "config", "kopf_util"]
+
+# modules hosting the kopf handlers: the component is the module they call
+ENTRIES = ["main", "patcher", "user_handlers", "workflows"]
+
+_handler = contextvars.ContextVar("handler", default="-")
+_reconcile = contextvars.ContextVar("reconcile", default=None)
+# the component of the calls made by the pool threads working for it, where the stack does not tell
+_component = contextvars.ContextVar("component", default="-")
+_lock = threading.Lock()
+_series = {}
+
+class Series:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, elapsed, bytes_in, bytes_out, error):
+        self.count += 1
+        self.errors += error and 1 or 0
+        self.seconds += elapsed
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        for n, le in enumerate(BUCKETS):
+            if elapsed <= le:
+                self.buckets[n] += 1
+
+# the component is the outermost nuvolaris module, below the handler, that is not an helper
+def caller_component(frame=None):
+    """
+    >>> caller_component()
+    '-'
+    >>> as_component("redis", caller_component)
+    'redis'
+    """
+    frame = frame or sys._getframe(1)
+    found = "-"
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith("nuvolaris."):
+            name = module.split(".")[1]
+            if name in ENTRIES:
+                return found if found != "-" else name
+            if name not in HELPERS:
+                found = name
+        frame = frame.f_back
+    return found if found != "-" else _component.get()
+
+# run fn as the given component, ex. in a pool thread applying its objects
+def as_component(component, fn, *args, **kwargs):
+    token = _component.set(component)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _component.reset(token)
+
+_KIND = re.compile(r"""["']?kind["']?\s*:\s*["']?([A-Za-z]+)""")
+
+# the kind of the resource a kubectl command refers to
+def kind_of(args, input=None):
+    """
+    >>> kind_of(["get", "pods"]), kind_of(["annotate", "cm/config", "a=b"]), kind_of(["rollout", "restart", "sts/redis"])
+    ('pods', 'cm', 'sts')
+    >>> kind_of(["apply", "-f", "-"], '{"apiVersion": "v1", "kind": "ConfigMap"}'), kind_of(["exec", "-i", "redis-0"])
+    ('ConfigMap', 'pod')
+    """
+    verb = args and args[0] or ""
+    if verb in ["exec", "cp", "logs"]:
+        return "pod"
+    if "-f" in args and input:
+        text = input.decode("utf-8", errors="replace") if isinstance(input, bytes) else str(input)
+        m = _KIND.search(text[:500])
+        return m and m.group(1) or "-"
+    pos = [a for a in args[1:] if not a.startswith("-")]
+    if verb == "rollout" and pos:
+        pos = pos[1:]
+    if not pos:
+        return "-"
+    return pos[0].split("/")[0].split(",")[0]
+
+# record a kube call
+def observe(verb, kind, elapsed, bytes_in=0, bytes_out=0, error=False, component=None):
+    """
+    >>> _series.clear()
+    >>> observe("get", "pods", 0.02, 0, 120)
+    >>> observe("get", "pods", 0.2, 0, 80, error=True)
+    >>> s = _series[("get", "pods", "-", "-")]
+    >>> s.count, s.errors, s.bytes_out, s.buckets[:6]
+    (2, 1, 200, [0, 0, 1, 1, 1, 2])
+    """
+    key = (verb, kind, _handler.get(), component or caller_component())
+    with _lock:
+        _series.setdefault(key, Series()).observe(elapsed, bytes_in, bytes_out, error)
+        current = _reconcile.get()
+        if current is not None:
+            current.setdefault((verb, kind), Series()).observe(elapsed, bytes_in, bytes_out, error)
+
+def _labels(key, **extra):
+    names = ["verb", "kind", "handler", "component"]
+    pairs = list(zip(names, key)) + list(extra.items())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+# metrics in the prometheus text format
+def render():
+    """
+    >>> _series.clear()
+    >>> observe("apply", "ConfigMap", 0.2, 300, 30, component="redis")
+    >>> print(render())  # doctest: +ELLIPSIS
+    # HELP nuvolaris_kube_requests_total kube calls
+    # TYPE nuvolaris_kube_requests_total counter
+    nuvolaris_kube_requests_total{verb="apply",kind="ConfigMap",handler="-",component="redis"} 1
+    ...
+    nuvolaris_kube_request_seconds_bucket{verb="apply",kind="ConfigMap",handler="-",component="redis",le="0.25"} 1
+    ...
+    nuvolaris_kube_request_bytes_total{verb="apply",kind="ConfigMap",handler="-",component="redis",direction="in"} 300
+    ...
+    """
+    with _lock:
+        series = {k: v for k, v in _series.items()}
+    out = []
+    def metric(name, kind, help):
+        out.append(f"# HELP {name} {help}")
+        out.append(f"# TYPE {name} {kind}")
+    metric("nuvolaris_kube_requests_total", "counter", "kube calls")
+    for k, s in series.items():
+        out.append(f"nuvolaris_kube_requests_total{_labels(k)} {s.count}")
+    metric("nuvolaris_kube_errors_total", "counter", "failed kube calls")
+    for k, s in series.items():
+        out.append(f"nuvolaris_kube_errors_total{_labels(k)} {s.errors}")
+    metric("nuvolaris_kube_request_seconds", "histogram", "latency of the kube calls")
+    for k, s in series.items():
+        for le, n in zip(BUCKETS, s.buckets):
+            out.append(f"nuvolaris_kube_request_seconds_bucket{_labels(k, le=le)} {n}")
+        out.append(f"nuvolaris_kube_request_seconds_bucket{_labels(k, le='+Inf')} {s.count}")
+        out.append(f"nuvolaris_kube_request_seconds_sum{_labels(k)} {s.seconds:.6f}")
+        out.append(f"nuvolaris_kube_request_seconds_count{_labels(k)} {s.count}")
+    metric("nuvolaris_kube_request_bytes_total", "counter", "bytes sent to and received from the kube calls")
+    for k, s in series.items():
+        out.append(f"nuvolaris_kube_request_bytes_total{_labels(k, direction='in')} {s.bytes_in}")
+        out.append(f"nuvolaris_kube_request_bytes_total{_labels(k, direction='out')} {s.bytes_out}")
+    return "\n".join(out) + "\n"
+
+# one line summary of the calls of a reconcile, the slowest first
+def summary(name, stats, elapsed):
+    """
+    >>> a, b = Series(), Series()
+    >>> a.observe(1.5, 0, 0, False); a.observe(0.5, 0, 0, True); b.observe(0.1, 0, 0, False)
+    >>> summary("whisk_create", {("apply", "StatefulSet"): a, ("get", "pods"): b}, 10)
+    '*** whisk_create: 3 kube calls, 2.10s of 10.00s, 1 errors, top: apply StatefulSet 2x 2.00s, get pods 1x 0.10s'
+    """
+    calls = sum(s.count for s in stats.values())
+    seconds = sum(s.seconds for s in stats.values())
+    errors = sum(s.errors for s in stats.values())
+    top = sorted(stats.items(), key=lambda i: -i[1].seconds)[:5]
+    detail = ", ".join(f"{v} {k} {s.count}x {s.seconds:.2f}s" for (v, k), s in top)
+    return f"*** {name}: {calls} kube calls, {seconds:.2f}s of {elapsed:.2f}s, {errors} errors, top: {detail}"
+
+# decorator for the kopf handlers, sync or async: tags the kube calls with the handler name
+# and logs a summary of them when the handler completes
+def reconcile(fn):
+    """
+    >>> @reconcile
+    ... async def handler():
+    ...     observe("get", "pods", 0.1, component="redis")
+    ...     return _handler.get()
+    >>> asyncio.run(handler()), _handler.get()
+    ('handler', '-')
+    """
+    def start():
+        return _handler.set(fn.__name__), _reconcile.set({}), time.time()
+
+    def end(handler, stats, started):
+        logging.info(summary(fn.__name__, _reconcile.get(), time.time() - started))
+        _handler.reset(handler)
+        _reconcile.reset(stats)
+
+    if asyncio.iscoroutinefunction(fn):
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            tokens = start()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                end(*tokens)
+        return async_wrapper
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        tokens = start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            end(*tokens)
+    return wrapper
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+_server = None
+
+# serve /metrics on NUVOLARIS_METRICS_PORT (default 9095, 0 disables it)
+def serve(port=None):
+    global _server
+    port = int(port if port is not None else os.environ.get("NUVOLARIS_METRICS_PORT", "9095"))
+    if port == 0 or _server is not None:
+        return _server
+    _server = ThreadingHTTPServer(("", port), MetricsHandler)
+    threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    logging.info(f"serving kube metrics on :{port}/metrics")
+    return _server
+
+def stop():
+    global _server
+    if _server is not None:
+        _server.shutdown()
+        _server = None
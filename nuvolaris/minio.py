@@ -105,19 +105,20 @@ def _annotate_nuv_metadata(data):
             minio_host = f"{minio_service['metadata']['name']}.{minio_service['metadata']['namespace']}.svc.cluster.local"
             access_key = data["minio_nuv_user"]
             secret_key = data["minio_nuv_password"]
-            openwhisk.annotate(f"minio_host={minio_host}")
-            openwhisk.annotate(f"minio_access_key={access_key}")
-            openwhisk.annotate(f"minio_secret_key={secret_key}")
-            openwhisk.annotate(f"s3_host={minio_host}")
-            openwhisk.annotate(f"s3_access_key={access_key}")
-            openwhisk.annotate(f"s3_secret_key={secret_key}")
-            openwhisk.annotate(f"s3_provider=minio")
-
-            ports = list(minio_service['spec']['ports'])
-            for port in ports:
-                if(port['name']=='minio-api'):
-                    openwhisk.annotate(f"minio_port={port['port']}")
-                    openwhisk.annotate(f"s3_port={port['port']}")                  
+            with openwhisk.annotations():
+                openwhisk.annotate(f"minio_host={minio_host}")
+                openwhisk.annotate(f"minio_access_key={access_key}")
+                openwhisk.annotate(f"minio_secret_key={secret_key}")
+                openwhisk.annotate(f"s3_host={minio_host}")
+                openwhisk.annotate(f"s3_access_key={access_key}")
+                openwhisk.annotate(f"s3_secret_key={secret_key}")
+                openwhisk.annotate(f"s3_provider=minio")
+
+                ports = list(minio_service['spec']['ports'])
+                for port in ports:
+                    if(port['name']=='minio-api'):
+                        openwhisk.annotate(f"minio_port={port['port']}")
+                        openwhisk.annotate(f"s3_port={port['port']}")                  
         return None
     except Exception as e:
         logging.error(f"failed to build minio_host for nuvolaris: {e}")
@@ -293,6 +294,7 @@ def patch(status, action, owner=None):
     except Exception as e:
         logging.error('*** failed to update minio: %s' % e)
         operator_util.patch_operator_status(status,'minio','error')
+        raise
 
 def patch_ingresses(status, action, owner=None):
     """
@@ -262,4 +262,5 @@ def patch(status, action, owner=None):
         if  action == 'create':
             status['whisk_create']['static']='error'
         else:            
-            status['whisk_update']['static']='error'            
\ No newline at end of file
+            status['whisk_update']['static']='error'            
+        raise
\ No newline at end of file
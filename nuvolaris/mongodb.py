@@ -27,6 +27,7 @@ import nuvolaris.mongodb_operator as operator
 import nuvolaris.mongodb_standalone as standalone
 import nuvolaris.kube as kube
 import nuvolaris.template as ntp
+import nuvolaris.exec_util as exec_util
 import logging, json
 import os
 import urllib.parse
@@ -111,20 +112,19 @@ def delete(owner=None):
 def init():
     return "TODO"
 
-def render_mongodb_script(namespace,template,data):
+def render_mongodb_script(template,data):
     """
     uses the given template to render a js script to execute as a json.
     """  
-    out = f"/tmp/__{namespace}_{template}"
-    file = ntp.spool_template(template, out, data)
-    return os.path.abspath(file)
-
-def exec_mongosh_command(pod_name,path_to_mdb_script):
-    logging.info(f"passing script {path_to_mdb_script} to pod {pod_name}")
-    res = kube.kubectl("cp",path_to_mdb_script,f"{pod_name}:{path_to_mdb_script}")
-    res = kube.kubectl("exec","-it",pod_name,"--","/bin/bash","-c",f"mongosh --file {path_to_mdb_script}")
-    os.remove(path_to_mdb_script)
-    return res
+    return ntp.expand_template(template, data)
+
+def exec_mongosh_command(pod_name,*scripts):
+    """
+    streams the given mongosh scripts to the pod in a single exec session
+    """
+    logging.info(f"passing mongosh script to pod {pod_name}")
+    # read as a file, so that a failing statement exits with an error and stops the session
+    return exec_util.exec_scripts(pod_name, [("mongosh --quiet --file /dev/stdin", script) for script in scripts])
 
 def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
     database = ucfg.get('mongodb.database')
@@ -137,11 +137,11 @@ def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
         data["auth"]=ucfg.get('mongodb.password')
         data["mode"]="create"
 
-        path_to_mdb_script = render_mongodb_script(ucfg.get('namespace'),"mongodb_manage_user_tpl.js",data)
+        mdb_script = render_mongodb_script("mongodb_manage_user_tpl.js",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.app == 'nuvolaris-mongodb')].metadata.name}")
 
         if(pod_name):
-            res = exec_mongosh_command(pod_name,path_to_mdb_script)
+            res = exec_mongosh_command(pod_name,mdb_script)
             _add_mdb_user_metadata(ucfg, user_metadata)
             return res
 
@@ -159,11 +159,11 @@ def delete_db_user(namespace, database):
         data["database"]=database
         data["mode"]="delete"
 
-        path_to_mdb_script = render_mongodb_script(namespace,"mongodb_manage_user_tpl.js",data)
+        mdb_script = render_mongodb_script("mongodb_manage_user_tpl.js",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.app == 'nuvolaris-mongodb')].metadata.name}")
 
         if(pod_name):
-            res = exec_mongosh_command(pod_name,path_to_mdb_script)
+            res = exec_mongosh_command(pod_name,mdb_script)
             return res
 
         return None
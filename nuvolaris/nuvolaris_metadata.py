@@ -19,11 +19,12 @@ import json
 import logging
 import nuvolaris.config as cfg
 import nuvolaris.util as util
+from nuvolaris.configmap_util import ConfigMapSnapshot
 
 class NuvolarisMetadata:
     _data = {}
 
-    def __init__(self):
+    def __init__(self, snapshot: ConfigMapSnapshot = None):
         self._data = {
             "login":"nuvolaris",
             "password":cfg.get('nuvolaris.password') or "nuvpassw0rd",
@@ -31,12 +32,14 @@ class NuvolarisMetadata:
             "metadata":[]            
         }
 
+        # cm/config is read once and all the annotations are taken from this snapshot
+        self._snapshot = snapshot or ConfigMapSnapshot()
         self._configure_from_cm()
 
     
     def _store_safely_from_cm(self,metadata_key,json_path):
         try: 
-            value = util.get_value_from_config_map("nuvolaris", json_path)
+            value = util.get_value_from_config_map("nuvolaris", json_path, snapshot=self._snapshot)
             if value:
                 self.add_metadata(metadata_key, value)
         except Exception as e:
@@ -15,16 +15,112 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import logging
+import logging, json, contextvars
 import nuvolaris.config as cfg
 import nuvolaris.openwhisk_standalone as standalone
 import nuvolaris.kube as kube
 import nuvolaris.util as util
+import nuvolaris.informer as informer
+from contextlib import contextmanager
 from nuvolaris.util import nuv_retry
 
-@nuv_retry()
+# annotations collected by the current annotations() scope, followed by the work it hands to the pools
+_pending = contextvars.ContextVar("annotations", default=None)
+
+# annotate cm/config with a key=value pair
+# inside an annotations() scope the write is delayed to the end of the scope
 def annotate(keyval):
-    kube.kubectl("annotate", "cm/config",  keyval, "--overwrite")
+    """
+    >>> import nuvolaris.kube as kube
+    >>> kube.mocker.reset(); kube.mocker.config("patch", "patched")
+    >>> with annotations():
+    ...     annotate("minio_host=minio")
+    ...     annotate("minio_port=9000")
+    ...     annotate("minio_port=9001")
+    >>> kube.mocker.peek()
+    'patch cm/config --type merge -p {"metadata": {"annotations": {"minio_host": "minio", "minio_port": "9001"}}}'
+    >>> len(kube.mocker.queue)
+    1
+    >>> annotate("minio_host=minio")
+    >>> len(kube.mocker.queue)
+    2
+    >>> kube.mocker.reset()
+    """
+    key, _, value = keyval.partition("=")
+    pending = _pending.get()
+    if pending is not None:
+        pending[key] = value
+    else:
+        write_annotations({key: value})
+
+# collect the annotate calls executed in the block, writing them as a single merge patch on exit
+# if the block raises nothing is written: nested scopes are merged in the outermost one,
+# dropping their own annotations when they raise
+@contextmanager
+def annotations():
+    """
+    >>> import nuvolaris.kube as kube
+    >>> kube.mocker.reset(); kube.mocker.config("patch", "patched")
+    >>> with annotations():
+    ...     annotate("redis_url=redis://redis")
+    ...     raise Exception("redis not ready")
+    Traceback (most recent call last):
+    ...
+    Exception: redis not ready
+    >>> len(kube.mocker.queue)
+    0
+    >>> with annotations():
+    ...     annotate("minio_host=minio")
+    ...     try:
+    ...         with annotations():
+    ...             annotate("mongodb_url=mongodb://ferretdb")
+    ...             raise Exception("ferretdb not ready")
+    ...     except Exception:
+    ...         pass
+    >>> kube.mocker.peek()
+    'patch cm/config --type merge -p {"metadata": {"annotations": {"minio_host": "minio"}}}'
+    >>> from concurrent.futures import ThreadPoolExecutor
+    >>> with annotations(), ThreadPoolExecutor(1) as pool:
+    ...     pool.submit(contextvars.copy_context().run, annotate, "redis_url=redis://redis").result()
+    >>> kube.mocker.peek()
+    'patch cm/config --type merge -p {"metadata": {"annotations": {"redis_url": "redis://redis"}}}'
+    >>> kube.mocker.reset()
+    """
+    pending = _pending.get()
+    if pending is not None:
+        saved = dict(pending)
+        try:
+            yield pending
+        except BaseException:
+            pending.clear()
+            pending.update(saved)
+            raise
+        return
+    pending = {}
+    token = _pending.set(pending)
+    try:
+        yield pending
+    finally:
+        _pending.reset(token)
+    if pending:
+        write_annotations(pending)
+
+# the annotations of cm/config from the informer cache, empty when it is not usable:
+# a read would cost as much as the merge patch it could save
+def _current_annotations():
+    res = informer.query("cm", "{.metadata.annotations}", name="config")
+    return res and res[0] or {}
+
+# write the annotations with one merge patch, skipping the values already in cm/config
+@nuv_retry()
+def write_annotations(values):
+    current = _current_annotations()
+    changed = {k: v for k, v in values.items() if current.get(k) != v}
+    if not changed:
+        logging.debug(f"cm/config annotations {list(values)} unchanged")
+        return None
+    data = json.dumps({"metadata": {"annotations": changed}})
+    return kube.kubectl("patch", "cm/config", "--type", "merge", "-p", data)
 
 def create(owner=None):
     # openwhisk controller relies on couchdb therefore we wait for pod readiness
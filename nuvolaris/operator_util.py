@@ -20,6 +20,7 @@ import nuvolaris.openwhisk as openwhisk
 import nuvolaris.kube as kube
 import nuvolaris.userdb_util as userdb
 import nuvolaris.config as cfg
+import nuvolaris.detect_util as detect
 import nuvolaris.util as ut
 import nuvolaris.whisk_actions_deployer as system
 import nuvolaris.redis as redis
@@ -35,16 +36,17 @@ def annotate_operator_components_version():
         logging.info("**** annotating nuvolaris operator component versions")
         pods = kube.kubectl("get","pods",jsonpath="{.items[?(@.metadata.annotations.whisks\.nuvolaris\.org\/annotate-version)]}",debugresult=False)
 
-        for pod in pods:
-            if(pod['metadata'].get('labels') and pod['metadata']['labels'].get('name')):
-                pod_name = pod['metadata']['labels']['name']
-                pod_image = pod['spec']['containers'][0]['image']
+        with openwhisk.annotations():
+            for pod in pods:
+                if(pod['metadata'].get('labels') and pod['metadata']['labels'].get('name')):
+                    pod_name = pod['metadata']['labels']['name']
+                    pod_image = pod['spec']['containers'][0]['image']
 
-                if(pod_name):
-                    openwhisk.annotate(f"{pod_name}_version={pod_image}")
-            else:
-                logging.warn("**** found a pod with whisks.nuvolaris.org/annotate-version without metadata.labels.name attribute")
-                logging.warn(pod)
+                    if(pod_name):
+                        openwhisk.annotate(f"{pod_name}_version={pod_image}")
+                else:
+                    logging.warning("**** found a pod with whisks.nuvolaris.org/annotate-version without metadata.labels.name attribute")
+                    logging.warning(pod)
         
         logging.info("**** completed annotation of nuvolaris operator component versions")       
     except Exception as e:
@@ -70,6 +72,12 @@ def whisk_post_create(name):
     logging.info(f"*** whisk_post_create {name}")
     update_nuvolaris_metadata()
     annotate_operator_components_version()
+    return deploy_system_actions()
+
+def deploy_system_actions():
+    """
+    Deploys the system actions, annotating the outcome in cm/config
+    """
     if system.deploy_whisk_system_action():
         openwhisk.annotate(f"system_action_status=created")
         return True
@@ -77,26 +85,32 @@ def whisk_post_create(name):
     openwhisk.annotate(f"system_action_status=failed")
     return False; 
 
-def whisk_post_resume(name):
+def whisk_post_resume(name, changed=None):
     """    
     Executes a set of common operations after the operator resumes, which is also the scenario
     triggered by a nuv update operator
     - restore redis nuvolaris namespace if redis is active
     - annotate operator deployed components version
     - redeploys system actions
+    When changed lists the components whose inputs changed, redis and the system actions
+    are redone only if they are listed. Returns False if the system actions failed.
     """
     logging.info(f"*** whisk_post_resume {name}")
 
-    if cfg.get("components.redis"):
+    if cfg.get("components.redis") and (changed is None or "redis" in changed):
         redis.restore_nuvolaris_db_user()
 
     annotate_operator_components_version()
+    if changed is not None and not "whisk-system" in changed:
+        return True
+
     sysres = system.deploy_whisk_system_action()
 
     if sysres:
         logging.info("system action redeployed after operator restart")
     else:    
         logging.warn("system action deploy issues after operator restart. Checl logs for further details")
+    return sysres
 
 def config_from_spec(spec, handler_type = "on_create"):
     """
@@ -106,7 +120,7 @@ def config_from_spec(spec, handler_type = "on_create"):
     """
     cfg.clean()
     cfg.configure(spec)
-    cfg.detect()
+    detect.detect()
 
     if "on_create" in handler_type:       
         cfg.put("config.apihost", "https://pending")
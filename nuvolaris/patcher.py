@@ -26,6 +26,8 @@ import nuvolaris.config as cfg
 import nuvolaris.kube as kube
 import nuvolaris.util as util
 import nuvolaris.kopf_util as kopf_util
+import nuvolaris.digest_util as dg
+import nuvolaris.dag_util as dag
 import nuvolaris.postgres_operator as postgres
 import nuvolaris.endpoint as endpoint
 import nuvolaris.issuer as issuer
@@ -82,13 +84,95 @@ def redeploy_whisk(owner=None):
     redeploy_controller(owner)
     
 
+# components whose digests are updated by each patch action
+PATCHED = {"endpoint": ["issuer", "openwhisk"]}
+
+# a component is created after and deleted before the components it needs
+NEEDS = {"mongodb": ["postgres"], "static": ["minio"], "endpoint": ["openwhisk"]}
+
+# the work after the patch each component needs: the nuvolaris metadata persisted in couchdb,
+# the annotations of the versions of the components and the system actions
+POST_CREATE = {
+    "postgres": ["metadata", "versions"],
+    "mongodb": ["metadata", "versions"],
+    "redis": ["metadata", "versions"],
+    "cron": ["versions"],
+    "minio": ["metadata", "versions", "whisk-system"],
+    "static": ["metadata", "versions", "whisk-system"],
+    "openwhisk": ["versions", "whisk-system"]
+}
+
+def components():
+    return {"postgres": postgres, "mongodb": mongodb, "redis": redis, "cron": cron, "minio": minio, "static": static}
+
+# the function patching the component, None if there is nothing to do
+def patch_fn(key, action, status, owner=None):
+    if key in components():
+        return lambda: components()[key].patch(status, action, owner)
+    if key == "openwhisk" and action == "update":
+        return lambda: redeploy_whisk(owner)
+    if key == "endpoint" and action == "update":
+        def patch_endpoint():
+            try:
+                issuer.patch(status, action, owner)
+            finally:
+                endpoint.patch(status, action, owner)
+        return patch_endpoint
+    return None
+
+def deploy_system_actions():
+    if not operator_util.deploy_system_actions():
+        raise Exception("system actions not deployed")
+    return "*** system actions deployed"
+
+# the steps of the patch: independent components are patched concurrently,
+# then the post create work the patched components need
+def plan(what_to_do, status, owner=None):
+    """
+    >>> what_to_do = {"mongodb": "create", "postgres": "create", "static": "delete", "minio": "delete", "cron": "create"}
+    >>> [(s.name, s.needs) for s in plan(what_to_do, {})]
+    [('mongodb', ['postgres']), ('postgres', []), ('static', []), ('minio', ['static']), ('cron', []), ('metadata', ['mongodb', 'postgres', 'static', 'minio', 'cron']), ('versions', ['mongodb', 'postgres', 'static', 'minio', 'cron']), ('whisk-system', ['mongodb', 'postgres', 'static', 'minio', 'cron'])]
+    >>> [(s.name, s.enabled) for s in plan({"cron": "create", "endpoint": "update"}, {})][2:]
+    [('metadata', False), ('versions', True), ('whisk-system', False)]
+    """
+    steps = []
+    for key, action in what_to_do.items():
+        fn = patch_fn(key, action, status, owner)
+        if fn is None:
+            continue
+        if action == "delete":
+            needs = [k for k, v in what_to_do.items() if key in NEEDS.get(k, []) and v == "delete"]
+        else:
+            needs = [k for k in NEEDS.get(key, []) if what_to_do.get(k, "delete") != "delete"]
+        steps.append(dag.Step(key, fn, needs=needs))
+
+    patched = [s.name for s in steps]
+    post = [work for key in patched for work in POST_CREATE.get(key, [])]
+    steps.append(dag.Step("metadata", operator_util.update_nuvolaris_metadata, "metadata" in post, needs=patched))
+    steps.append(dag.Step("versions", operator_util.annotate_operator_components_version, "versions" in post, needs=patched))
+    steps.append(dag.Step("whisk-system", deploy_system_actions, "whisk-system" in post, needs=patched))
+    return steps
+
+# the digests names of the components whose patch step failed in the state returned by dag.run
+def failures(what_to_do, state):
+    """
+    >>> failures({"mongodb": "update", "endpoint": "update", "redis": "update"}, {"mongodb": "error", "endpoint": "error", "redis": "on"})
+    ['mongodb', 'issuer', 'openwhisk']
+    """
+    return [n for key in what_to_do if state.get(key) == "error" for n in PATCHED.get(key, [key])]
+
 def patch(diff, status, owner=None, name=None):
     """
     Implements the patching logic of the nuvolaris operator by analyzing the kopf
     provided diff object to identify which components needs to be added/removed.
+    The components whose inputs changed since the digests in status are patched too.
+    Returns the new digests, None if there is nothing to patch.
     """
     logging.info(status)
     what_to_do = kopf_util.detect_component_changes(diff)
+    digests = status.get("digests")
+    if digests is not None:
+        kopf_util.evaluate_digests(what_to_do, dg.changed(digests))
 
     if len(what_to_do) == 0:
         logging.warn("*** no relevant changes identified by the operator patcher. Skipping processing")
@@ -97,45 +181,15 @@ def patch(diff, status, owner=None, name=None):
     for key in what_to_do.keys():
         logging.info(f"{key}={what_to_do[key]}")
 
-    components_updated = False    
-
-    # components 1st
-    if "postgres" in what_to_do:
-        postgres.patch(status,what_to_do['postgres'], owner)
-        components_updated = True
-
-    if "mongodb" in what_to_do:
-        mongodb.patch(status,what_to_do['mongodb'], owner)
-        components_updated = True
-
-    if "redis" in what_to_do:
-        redis.patch(status,what_to_do['redis'], owner)
-        components_updated = True 
-
-    if "cron" in what_to_do:
-        cron.patch(status,what_to_do['cron'], owner)
-        components_updated = True 
+    logging.info(f"*** patching wsk/{name}")
+    state = dag.run(plan(what_to_do, status, owner), {})
 
-    if "minio" in what_to_do:
-        minio.patch(status,what_to_do['minio'], owner)
-        components_updated = True 
-
-    if "static" in what_to_do:
-        static.patch(status,what_to_do['static'], owner)
-        components_updated = True
-
-    # handle update action on openwhisk
-    if "openwhisk" in what_to_do and what_to_do['openwhisk'] == "update":        
-        redeploy_whisk(owner)
-        components_updated = True
-
-    # handle update action on endpoint
-    if "endpoint" in what_to_do and what_to_do['endpoint'] == "update":
-        issuer.patch(status,what_to_do['endpoint'], owner)       
-        endpoint.patch(status,what_to_do['endpoint'], owner)
-
-    if components_updated:
-        operator_util.whisk_post_create(name)
-    
-        
-    
+    if digests is None:
+        return None
+    names = [n for key in what_to_do for n in PATCHED.get(key, [key])]
+    failed = failures(what_to_do, state)
+    if state["whisk-system"] != "off":
+        names.append("whisk-system")
+        if state["whisk-system"] == "error":
+            failed.append("whisk-system")
+    return dg.patched(digests, names, failed)
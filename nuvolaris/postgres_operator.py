@@ -23,6 +23,7 @@ import nuvolaris.config as cfg
 import nuvolaris.util as util
 import nuvolaris.openwhisk as openwhisk
 import nuvolaris.template as ntp
+import nuvolaris.exec_util as exec_util
 import urllib.parse
 
 from nuvolaris.user_config import UserConfig
@@ -108,12 +109,13 @@ def update_system_cm_for_pdb(data):
             auth = f"{username}:{password}"            
             pdb_url = f"postgresql://{auth}@{pdb_service_name}.{pdb_ns}.svc.cluster.local:{pdb_port}/{database}"
 
-            openwhisk.annotate(f"postgres_host={pdb_host}")
-            openwhisk.annotate(f"postgres_port={pdb_port}")
-            openwhisk.annotate(f"postgres_database={database}")
-            openwhisk.annotate(f"postgres_username={username}")
-            openwhisk.annotate(f"postgres_password={password}")
-            openwhisk.annotate(f"postgres_url={pdb_url}")
+            with openwhisk.annotations():
+                openwhisk.annotate(f"postgres_host={pdb_host}")
+                openwhisk.annotate(f"postgres_port={pdb_port}")
+                openwhisk.annotate(f"postgres_database={database}")
+                openwhisk.annotate(f"postgres_username={username}")
+                openwhisk.annotate(f"postgres_password={password}")
+                openwhisk.annotate(f"postgres_url={pdb_url}")
 
             logging.info("*** saved annotation for postgres nuvolaris user")            
     except Exception as e:
@@ -166,23 +168,21 @@ def _add_pdb_user_metadata(ucfg, user_metadata):
         logging.error(f"failed to build postgres_host for {ucfg.get('postgres.database')}: {e}")
         return None 
 
-def render_postgres_script(namespace,template,data):
+def render_postgres_script(template,data):
     """
     uses the given template to render a sh script to execute via psql.
     """  
-    out = f"/tmp/__{namespace}_{template}"
-    file = ntp.spool_template(template, out, data)
-    return os.path.abspath(file)
-
-def exec_psql_command(pod_name,path_to_psql_script,path_to_pgpass):
-    logging.info(f"passing script {path_to_psql_script} to pod {pod_name}")
-    res = kube.kubectl("cp",path_to_psql_script,f"{pod_name}:{path_to_psql_script}")
-    res = kube.kubectl("cp",path_to_pgpass,f"{pod_name}:/tmp/.pgpass")
-    res = kube.kubectl("exec","-it",pod_name,"--","/bin/bash","-c",f"chmod 600 /tmp/.pgpass")
-    res = kube.kubectl("exec","-it",pod_name,"--","/bin/bash","-c",f"PGPASSFILE='/tmp/.pgpass' psql --username postgres --dbname postgres -f {path_to_psql_script}")
-    os.remove(path_to_psql_script)
-    os.remove(path_to_pgpass)
-    return res
+    return ntp.expand_template(template, data)
+
+def exec_psql_command(pod_name,pgpass,*psql_scripts):
+    """
+    streams the given psql scripts to the pod in a single exec session,
+    passing the password of the .pgpass content as PGPASSWORD
+    """
+    logging.info(f"passing psql script to pod {pod_name}")
+    env = {"PGPASSWORD": exec_util.pgpass_password(pgpass)}
+    command = "psql --username postgres --dbname postgres -f -"
+    return exec_util.exec_scripts(pod_name, [(command, script) for script in psql_scripts], env)
 
 def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
     database = ucfg.get('postgres.database')
@@ -195,12 +195,12 @@ def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
         data["password"]=ucfg.get('postgres.password')
         data["mode"]="create"        
 
-        path_to_pgpass = render_postgres_script(ucfg.get('namespace'),"pgpass_tpl.properties",data)
-        path_to_mdb_script = render_postgres_script(ucfg.get('namespace'),"postgres_manage_user_tpl.sql",data)
+        pgpass = render_postgres_script("pgpass_tpl.properties",data)
+        psql_script = render_postgres_script("postgres_manage_user_tpl.sql",data)
         pod_name = util.get_pod_name_by_selector("app=nuvolaris-postgres","{.items[?(@.metadata.labels.replicationRole == 'primary')].metadata.name}")
 
         if(pod_name):
-            res = exec_psql_command(pod_name,path_to_mdb_script,path_to_pgpass)
+            res = exec_psql_command(pod_name,pgpass,psql_script)
 
             if res:
                 _add_pdb_user_metadata(ucfg, user_metadata)
@@ -222,12 +222,12 @@ def delete_db_user(namespace, database):
         data["database"]=database
         data["mode"]="delete"
 
-        path_to_pgpass = render_postgres_script(namespace,"pgpass_tpl.properties",data)
-        path_to_mdb_script = render_postgres_script(namespace,"postgres_manage_user_tpl.sql",data)
+        pgpass = render_postgres_script("pgpass_tpl.properties",data)
+        psql_script = render_postgres_script("postgres_manage_user_tpl.sql",data)
         pod_name = util.get_pod_name_by_selector("app=nuvolaris-postgres","{.items[?(@.metadata.labels.replicationRole == 'primary')].metadata.name}")
 
         if(pod_name):
-            res = exec_psql_command(pod_name,path_to_mdb_script,path_to_pgpass)
+            res = exec_psql_command(pod_name,pgpass,psql_script)
             return res 
 
         return None
@@ -291,4 +291,5 @@ def patch(status, action, owner=None):
         if  action == 'create':
             status['whisk_create']['postgres']='error'
         else:            
-            status['whisk_update']['postgres']='error'                    
\ No newline at end of file
+            status['whisk_update']['postgres']='error'                    
+        raise
\ No newline at end of file
@@ -0,0 +1,148 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# this module returns futures resolved when pods become ready
+# following the events of the informers, so that several waits can run
+# concurrently, each with its own deadline; without informers it polls with kubectl wait
+import time, logging, threading
+from concurrent.futures import Future, ThreadPoolExecutor
+import nuvolaris.kube as kube
+import nuvolaris.informer as informer
+import nuvolaris.jsonpath_util as jp
+
+# polling waits are executed here when the informers are not available
+_pollers = ThreadPoolExecutor(max_workers=8, thread_name_prefix="readiness")
+
+# convert a kubectl timeout (600s, 10m, 1h or a number of seconds) in seconds
+def parse_timeout(timeout):
+    """
+    >>> parse_timeout("600s"), parse_timeout("10m"), parse_timeout(30), parse_timeout("1h")
+    (600.0, 600.0, 30.0, 3600.0)
+    """
+    if isinstance(timeout, (int, float)):
+        return float(timeout)
+    units = {"s": 1, "m": 60, "h": 3600}
+    if timeout[-1:] in units:
+        return float(timeout[:-1]) * units[timeout[-1]]
+    return float(timeout)
+
+# a pod is ready when its Ready condition is True
+def is_pod_ready(pod):
+    """
+    >>> is_pod_ready({"status": {"conditions": [{"type": "Ready", "status": "True"}]}})
+    True
+    >>> is_pod_ready({"status": {"conditions": [{"type": "Ready", "status": "False"}]}})
+    False
+    >>> is_pod_ready({"metadata": {"deletionTimestamp": "now"}, "status": {"conditions": [{"type": "Ready", "status": "True"}]}})
+    False
+    """
+    if pod.get("metadata", {}).get("deletionTimestamp"):
+        return False
+    for cond in pod.get("status", {}).get("conditions", []):
+        if cond.get("type") == "Ready":
+            return cond.get("status") == "True"
+    return False
+
+# a waiter evaluates its check at each event of the informer, resolving the future
+# with the value returned by the check, or failing it when the deadline expires
+class Waiter:
+    def __init__(self, inf, check, timeout, what):
+        self.inf = inf
+        self.check = check
+        self.what = what
+        self.future = Future()
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(timeout, self._expire)
+        self._timer.daemon = True
+
+    def start(self):
+        self.inf.add_listener(self._on_event)
+        self._timer.start()
+        self._on_event(None, None)
+        return self.future
+
+    def _done(self):
+        self._timer.cancel()
+        self.inf.remove_listener(self._on_event)
+
+    def _on_event(self, event_type, obj):
+        if self.future.done():
+            return
+        try:
+            value = self.check(self.inf)
+        except Exception as e:
+            logging.debug(f"readiness check of {self.what} failed: {e}")
+            return
+        if value:
+            with self._lock:
+                if self.future.done():
+                    return
+                self._done()
+                self.future.set_result(value)
+
+    def _expire(self):
+        with self._lock:
+            self.inf.remove_listener(self._on_event)
+            if not self.future.done():
+                self.future.set_exception(TimeoutError(f"timed out waiting for {self.what}"))
+
+def _first_ready_pod(jsonpath):
+    def check(inf):
+        names = jp.query({"kind": "List", "items": inf.list()}, jsonpath)
+        if names:
+            pod = inf.get(names[0])
+            if pod and is_pod_ready(pod):
+                return names[0]
+        return None
+    return check
+
+def _poll_pod_ready(jsonpath, deadline, namespace):
+    while time.time() < deadline:
+        names = kube.kubectl("get", "pods", namespace=namespace, jsonpath=jsonpath)
+        if names:
+            remaining = max(1, int(deadline - time.time()))
+            if kube.wait(f"pod/{names[0]}", "condition=ready", f"{remaining}s", namespace):
+                return names[0]
+            logging.info(f"waiting for {names[0]} to be ready...")
+        time.sleep(1)
+    raise TimeoutError(f"timed out waiting for a pod matching {jsonpath}")
+
+# return a future resolved with the name of the first pod selected by the jsonpath once ready
+def pod_ready(jsonpath, timeout="600s", namespace="nuvolaris"):
+    """
+    >>> inf = informer.Informer(None, "pods", "nuvolaris")
+    >>> inf.synced.set()
+    >>> informer._informers[("pods", "nuvolaris")] = inf
+    >>> f = pod_ready("{.items[?(@.metadata.labels.name == 'redis')].metadata.name}", timeout=5)
+    >>> f.done()
+    False
+    >>> inf.dispatch("ADDED", {"metadata": {"name": "redis-0", "labels": {"name": "redis"}}})
+    >>> f.done()
+    False
+    >>> inf.dispatch("MODIFIED", {"metadata": {"name": "redis-0", "labels": {"name": "redis"}},
+    ...    "status": {"conditions": [{"type": "Ready", "status": "True"}]}})
+    >>> f.result(), inf.listeners
+    ('redis-0', [])
+    >>> pod_ready("{.items[?(@.metadata.labels.name == 'couchdb')].metadata.name}", timeout=0.1).exception(1)
+    TimeoutError("timed out waiting for a pod matching {.items[?(@.metadata.labels.name == 'couchdb')].metadata.name}")
+    >>> informer._informers.clear()
+    """
+    seconds = parse_timeout(timeout)
+    inf = informer.get_informer("pods", namespace)
+    if inf is None:
+        return _pollers.submit(_poll_pod_ready, jsonpath, time.time() + seconds, namespace)
+    return Waiter(inf, _first_ready_pod(jsonpath), seconds, f"a pod matching {jsonpath}").start()
@@ -21,6 +21,7 @@ import nuvolaris.kube as kube
 import nuvolaris.config as cfg
 import nuvolaris.template as ntp
 import nuvolaris.util as util
+import nuvolaris.exec_util as exec_util
 import nuvolaris.openwhisk as openwhisk
 import urllib.parse
 import os, os.path
@@ -91,11 +92,11 @@ def create_nuvolaris_db_user(data):
     logging.info(f"authorizing redis for namespace nuvolaris")
     try:        
         data['mode']="create"
-        path_to_script = render_redis_script(data['namespace'],"redis_manage_user_tpl.txt",data)
+        script = render_redis_script("redis_manage_user_tpl.txt",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.name == 'redis')].metadata.name}")
 
         if(pod_name):
-            res = exec_redis_command(pod_name,path_to_script)
+            res = exec_redis_command(pod_name,script)
 
             if(res):
                 redis_service =  util.get_service("{.items[?(@.spec.selector.name == 'redis')]}")
@@ -106,8 +107,9 @@ def create_nuvolaris_db_user(data):
                     password = urllib.parse.quote(data['password'])
                     auth = f"{username}:{password}"
                     redis_url = f"redis://{auth}@{redis_service_name}:{redis_service_port}"
-                    openwhisk.annotate(f"redis_url={redis_url}")
-                    openwhisk.annotate(f"redis_prefix={data['prefix']}")
+                    with openwhisk.annotations():
+                        openwhisk.annotate(f"redis_url={redis_url}")
+                        openwhisk.annotate(f"redis_prefix={data['prefix']}")
                     logging.info("*** saved annotation for redis nuvolaris user")
             return res
 
@@ -136,20 +138,18 @@ def delete(owner=None):
     else:
         return delete_by_spec()    
 
-def render_redis_script(namespace,template,data):
+def render_redis_script(template,data):
     """
     uses the given template to render a redis-cli script to be executed.
     """  
-    out = f"/tmp/__{namespace}_{template}"
-    file = ntp.spool_template(template, out, data)
-    return os.path.abspath(file)
-
-def exec_redis_command(pod_name,path_to_script):
-    logging.info(f"passing script {path_to_script} to pod {pod_name}")
-    res = kube.kubectl("cp",path_to_script,f"{pod_name}:{path_to_script}")
-    res = kube.kubectl("exec","-it",pod_name,"--","/bin/bash","-c",f"cat {path_to_script} | redis-cli")
-    os.remove(path_to_script)
-    return res
+    return ntp.expand_template(template, data)
+
+def exec_redis_command(pod_name,*scripts):
+    """
+    streams the given redis-cli scripts to the pod in a single exec session
+    """
+    logging.info(f"passing redis script to pod {pod_name}")
+    return exec_util.exec_scripts(pod_name, [("redis-cli", script) for script in scripts])
 
 def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
     logging.info(f"authorizing new redis namespace {ucfg.get('namespace')}")    
@@ -166,11 +166,11 @@ def create_db_user(ucfg: UserConfig, user_metadata: UserMetadata):
         data['password']=ucfg.get('redis.password')        
         data['mode']="create"
 
-        path_to_script = render_redis_script(ucfg.get('namespace'),"redis_manage_user_tpl.txt",data)
+        script = render_redis_script("redis_manage_user_tpl.txt",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.name == 'redis')].metadata.name}")
 
         if(pod_name):
-            res = exec_redis_command(pod_name,path_to_script)
+            res = exec_redis_command(pod_name,script)
 
             if res:
                 user_metadata.add_metadata("REDIS_PREFIX",prefix)
@@ -192,11 +192,11 @@ def delete_db_user(namespace):
         data["namespace"]=namespace
         data["mode"]="delete"
 
-        path_to_script = render_redis_script(namespace,"redis_manage_user_tpl.txt",data)
+        script = render_redis_script("redis_manage_user_tpl.txt",data)
         pod_name = util.get_pod_name("{.items[?(@.metadata.labels.name == 'redis')].metadata.name}")
 
         if(pod_name):
-            res = exec_redis_command(pod_name,path_to_script)
+            res = exec_redis_command(pod_name,script)
             return res
 
         return None
@@ -225,4 +225,5 @@ def patch(status, action, owner=None):
             status['whisk_create']['redis']='error'
         else:            
             status['whisk_update']['redis']='error'               
+        raise
 
@@ -15,35 +15,16 @@
 # specific language governing permissions and limitations
 # under the License.
 #
-import os, re
+import os, re, json, hashlib, logging, threading
+from collections import OrderedDict
 
-from jinja2 import Environment, FileSystemLoader
-loader = FileSystemLoader(["./nuvolaris/templates", "./nuvolaris/files", "./nuvolaris/policies"])
-env = Environment(loader=loader)
-
-# expand template
-def expand_template(template, data):
-    """
-    >>> import json
-    >>> json.loads(expand_template("test.json", {"item": "hello"}))
-    {'_id': 'test', 'value': 'hello'}
-    """
-    tpl = env.get_template(template)
-    return tpl.render(data)
-    #doc = json.loads(tpl.render(data))
-
-
-# expond template and save in a file
-def spool_template(template, file, data):
-    """
-    >>> import nuvolaris.testutil as tu
-    >>> tu.grep(tu.fread(spool_template("test.json", "/tmp/test.json", {"item": "hi"})), r"value")
-    "value": "hi"
-    """
-    with open(file, "w") as f:
-        f.write(expand_template(template, data))
-    return file
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 
+_DIRECTIVE = re.compile(r"#(?=([~#:-]))")
+_HASH = re.compile(r"##(.*)$")
+_COLON = re.compile(r":.*#:(.*)$")
+_DASH = re.compile(r"-.*#-(.*)$")
+_ESCAPE = re.compile(r"#\\([!#-:~])")
 
 # expand a line of a .tpl.yml interpreting '#' comments as follows:
 # if there is #!, the entire line will be removed
@@ -71,14 +52,144 @@ def process_tpl_line(line):
     >>> print(process_tpl_line(line))
     #! with #~, #: and #- but not #\@
     """
-    if re.search(r"#~", line):
+    directives = _DIRECTIVE.findall(line) if "#" in line else None
+    if not directives:
+        return _ESCAPE.sub(r"#\1", line) if "#\\" in line else line
+    if "~" in directives:
         return ""
-    elif re.search(r"##", line):
-        line = re.sub(r"##(.*)$", r"\1", line, count=1)
-    elif re.search(r"#:", line):
-        line = re.sub(r":.*#:(.*)$", r":\1", line, count=1)
-    elif re.search(r"#-", line):
-        line = re.sub(r"-.*#-(.*)$", r"-\1", line, count=1)
-    line = re.sub(r"#\\([!#-:~])", r"#\1", line)
-    return line
+    elif "#" in directives:
+        line = _HASH.sub(r"\1", line, count=1)
+    elif ":" in directives:
+        line = _COLON.sub(r":\1", line, count=1)
+    elif "-" in directives:
+        line = _DASH.sub(r"-\1", line, count=1)
+    return _ESCAPE.sub(r"#\1", line)
 
+# process a whole .tpl.yml text, or a stream of lines
+def process_tpl(text):
+    """
+    >>> print(process_tpl("a: 1 #: {{a}}\\n#~ removed\\nb: 2\\n"), end="")
+    a: {{a}}
+    <BLANKLINE>
+    b: 2
+    """
+    lines = text.splitlines(keepends=True) if isinstance(text, str) else text
+    out = []
+    for line in lines:
+        body = line.rstrip("\r\n")
+        out.append(process_tpl_line(body) + line[len(body):])
+    return "".join(out)
+
+# processed .tpl.yml files by path, valid while mtime and size do not change
+_tpl_files = {}
+_tpl_lock = threading.Lock()
+
+def _stat(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+# process a .tpl.yml file, reusing the last result if the file did not change
+def process_tpl_file(path):
+    stat = _stat(path)
+    with _tpl_lock:
+        cached = _tpl_files.get(path)
+    if cached and cached[0] == stat:
+        return cached[1]
+    with open(path) as f:
+        res = process_tpl(f)
+    with _tpl_lock:
+        _tpl_files[path] = (stat, res)
+    return res
+
+# a loader processing the .tpl.yml templates before jinja compiles them
+class TplLoader(FileSystemLoader):
+    """
+    >>> import tempfile, jinja2
+    >>> dir = tempfile.mkdtemp()
+    >>> with open(f"{dir}/cm.tpl.yml", "w") as f: _ = f.write("name: x #: {{name}}\\n##{% if a %}\\na: 1\\n##{% endif %}\\n")
+    >>> print(jinja2.Environment(loader=TplLoader([dir])).get_template("cm.tpl.yml").render(name="cm"), end="")
+    name: cm
+    """
+    def get_source(self, environment, template):
+        source, filename, uptodate = super().get_source(environment, template)
+        if template.endswith(".tpl.yml"):
+            source = process_tpl_file(filename)
+        return source, filename, uptodate
+
+# .tpl.yml templates are processed with process_tpl_file and then compiled as the others
+loader = TplLoader(["./nuvolaris/templates", "./nuvolaris/files", "./nuvolaris/policies"])
+
+# templates do not change in the operator image: they are compiled once, without checking the files again,
+# and the compiled code is kept in NUVOLARIS_TEMPLATE_CACHE_DIR (default in the temp dir)
+# set NUVOLARIS_TEMPLATE_RELOAD=true when editing templates
+reload = os.environ.get("NUVOLARIS_TEMPLATE_RELOAD", "false").lower() == "true"
+env = Environment(loader=loader, auto_reload=reload, cache_size=400 if reload else -1,
+                  bytecode_cache=None if reload else FileSystemBytecodeCache(os.environ.get("NUVOLARIS_TEMPLATE_CACHE_DIR")))
+
+# rendered templates by template and data, not used when reloading
+RENDER_CACHE_SIZE = 256
+_renders = OrderedDict()
+_renders_lock = threading.Lock()
+
+# compile all the templates, returning how many
+def precompile():
+    count = 0
+    for name in env.list_templates():
+        try:
+            env.get_template(name)
+            count += 1
+        except Exception as e:
+            logging.debug(f"cannot compile template {name}: {e}")
+    logging.info(f"*** precompiled {count} templates")
+    return count
+
+# a canonical digest of the data, None if it cannot be serialized
+def data_key(data):
+    """
+    >>> data_key({"a": 1, "b": [1, 2]}) == data_key({"b": [1, 2], "a": 1})
+    True
+    >>> data_key({"a": 1}) == data_key({"a": "1"})
+    False
+    """
+    try:
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+    except Exception:
+        return None
+
+# expand template
+def expand_template(template, data):
+    """
+    >>> import json
+    >>> json.loads(expand_template("test.json", {"item": "hello"}))
+    {'_id': 'test', 'value': 'hello'}
+    >>> expand_template("test.json", {"item": "hello"}) is expand_template("test.json", {"item": "hello"})
+    True
+    """
+    key = None if reload else data_key(data)
+    if key is not None:
+        key = (template, key)
+        with _renders_lock:
+            if key in _renders:
+                _renders.move_to_end(key)
+                return _renders[key]
+    tpl = env.get_template(template)
+    res = tpl.render(data)
+    if key is not None:
+        with _renders_lock:
+            _renders[key] = res
+            while len(_renders) > RENDER_CACHE_SIZE:
+                _renders.popitem(last=False)
+    return res
+    #doc = json.loads(tpl.render(data))
+
+
+# expond template and save in a file
+def spool_template(template, file, data):
+    """
+    >>> import nuvolaris.testutil as tu
+    >>> tu.grep(tu.fread(spool_template("test.json", "/tmp/test.json", {"item": "hi"})), r"value")
+    "value": "hi"
+    """
+    with open(file, "w") as f:
+        f.write(expand_template(template, data))
+    return file
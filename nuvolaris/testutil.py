@@ -27,6 +27,8 @@ from urllib.parse import urlparse
 import uuid
 import string
 import random
+import threading
+from contextlib import contextmanager
 
 # takes a string, split in lines and search for the word (a re)
 # if field is a number, splits the line in fields separated by spaces and print the selected field
@@ -107,6 +109,190 @@ def load_yaml(file):
     return {}
 
 
+# record and replay support
+# a KubeSession holds the kube calls (and the http requests) done against a live cluster,
+# captured with KubeRecorder and replayed offline with KubeReplayer, both usable as kube backends
+
+_context = threading.local()
+
+# attribute the calls executed in the block to the given component
+@contextmanager
+def component(name):
+    previous = getattr(_context, "component", None)
+    _context.component = name
+    try:
+        yield
+    finally:
+        _context.component = previous
+
+def current_component():
+    return getattr(_context, "component", None) or "-"
+
+class KubeSession:
+    def __init__(self, calls=None, meta=None):
+        self.calls = calls or []
+        self.meta = meta or {}
+        self.phase = None
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            data = json.load(f)
+        return KubeSession(data.get("calls"), data.get("meta"))
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({"meta": self.meta, "calls": self.calls}, f, indent=1)
+
+    def add(self, entry):
+        entry.update({"phase": self.phase, "component": current_component()})
+        with self._lock:
+            entry["offset"] = round(entry.pop("started") - self.start, 4)
+            self.calls.append(entry)
+
+# key identifying a call in a session
+def _key(entry):
+    if entry["type"] == "http":
+        return ("http", entry["method"], entry["url"])
+    return ("kube", tuple(entry["args"]), entry["namespace"], entry["jsonpath"])
+
+def _text(data):
+    if isinstance(data, bytes):
+        return data.decode("utf-8", errors="replace")
+    return data
+
+# kube backend recording the calls executed by another backend
+class KubeRecorder:
+    name = "record"
+
+    def __init__(self, backend, session):
+        self.backend = backend
+        self.session = session
+
+    def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+        import nuvolaris.kube as kube
+        start = time.time()
+        res = self.backend.run(args, namespace=namespace, input=input, jsonpath=jsonpath)
+        if res is None:
+            res = kube.KubectlBackend().run(args, namespace=namespace, input=input, jsonpath=jsonpath)
+        self.session.add({"type": "kube", "args": list(args), "namespace": namespace, "jsonpath": jsonpath,
+            "input": _text(input), "returncode": res.returncode, "output": res.output, "error": res.error,
+            "data": res.data, "started": start, "elapsed": round(time.time() - start, 4)})
+        return res
+
+    # record also the http requests done with the requests library (ex. couchdb)
+    @contextmanager
+    def http(self):
+        original = req.Session.request
+        session = self.session
+        def request(this, method, url, **kwargs):
+            start = time.time()
+            r = original(this, method, url, **kwargs)
+            session.add({"type": "http", "method": method.upper(), "url": url, "input": _text(kwargs.get("data")),
+                "status": r.status_code, "headers": {"Content-Type": r.headers.get("Content-Type", "")},
+                "output": r.text, "started": start, "elapsed": round(time.time() - start, 4)})
+            return r
+        req.Session.request = request
+        try:
+            yield self
+        finally:
+            req.Session.request = original
+
+# kube backend replaying a session: calls with the same arguments get the recorded
+# responses in order, the last one is repeated when they are exhausted
+# latency can be None (no delay), "recorded" or a fixed number of seconds per call
+class KubeReplayer:
+    """
+    >>> import nuvolaris.kube as kube
+    >>> session = KubeSession([
+    ...   {"type": "kube", "args": ["get", "pods"], "namespace": "nuvolaris", "jsonpath": "{.items[*].metadata.name}",
+    ...    "input": None, "returncode": 0, "output": '["redis-0"]', "error": "", "data": None, "elapsed": 0.2, "phase": None}])
+    >>> replayer = KubeReplayer(session)
+    >>> _ = kube.set_backend(replayer)
+    >>> with component("redis"):
+    ...     kube.kubectl("get", "pods", jsonpath="{.items[*].metadata.name}")
+    ['redis-0']
+    >>> tu = __import__("nuvolaris.testutil").testutil
+    >>> tu.catch(lambda: kube.kubectl("get", "svc"))
+    <class 'Exception'> replay: no recorded response for kubectl get svc
+    >>> replayer.stats
+    {'redis': {'calls': 1, 'missed': 0, 'latency': 0.0}, '-': {'calls': 1, 'missed': 1, 'latency': 0.0}}
+    >>> _ = kube.set_backend("kubectl")
+    """
+    name = "replay"
+
+    def __init__(self, session, latency=None, strict=False):
+        self.session = session
+        self.latency = latency
+        self.strict = strict
+        self.phase = None
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._last = {}
+        for entry in session.calls:
+            for phase in [entry.get("phase"), "*"]:
+                self._queues.setdefault((phase,) + _key(entry), []).append(entry)
+
+    def _next(self, key):
+        with self._lock:
+            for k in [(self.phase,) + key, ("*",) + key]:
+                queue = self._queues.get(k)
+                if queue:
+                    entry = queue.pop(0)
+                    self._last[key] = entry
+                    return entry
+            return self._last.get(key)
+
+    def _account(self, entry):
+        delay = 0
+        if entry and self.latency == "recorded":
+            delay = entry.get("elapsed", 0)
+        elif entry and self.latency:
+            delay = float(self.latency)
+        with self._lock:
+            stat = self.stats.setdefault(current_component(), {"calls": 0, "missed": 0, "latency": 0.0})
+            stat["calls"] += 1
+            stat["missed"] += entry is None and 1 or 0
+            stat["latency"] += delay
+        if delay:
+            time.sleep(delay)
+
+    def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+        from nuvolaris.kube import KubeResult
+        entry = self._next(("kube", tuple(args), namespace, jsonpath))
+        self._account(entry)
+        if entry is None:
+            message = f"replay: no recorded response for kubectl {' '.join(args)}"
+            if self.strict:
+                raise Exception(message)
+            return KubeResult(1, "", message)
+        return KubeResult(entry["returncode"], entry["output"], entry["error"], entry.get("data"))
+
+    # replay also the recorded http requests
+    @contextmanager
+    def http(self):
+        original = req.Session.request
+        def request(this, method, url, **kwargs):
+            entry = self._next(("http", method.upper(), url))
+            self._account(entry)
+            if entry is None:
+                raise req.ConnectionError(f"replay: no recorded response for {method} {url}")
+            r = req.Response()
+            r.status_code = entry["status"]
+            r.headers.update(entry.get("headers", {}))
+            r._content = (entry.get("output") or "").encode("utf-8")
+            r.encoding = "utf-8"
+            r.url = url
+            return r
+        req.Session.request = request
+        try:
+            yield self
+        finally:
+            req.Session.request = original
+
 # mocking and spying kube support
 class MockKube:
     """
@@ -23,6 +23,9 @@ import nuvolaris.config as cfg
 import nuvolaris.couchdb as cdb
 import nuvolaris.minio as minio
 import nuvolaris.kube as kube
+import nuvolaris.metrics as metrics
+import nuvolaris.executor_util as pools
+import nuvolaris.kustomize as kus
 import nuvolaris.ferretdb as mdb
 import nuvolaris.minio_static as static
 import nuvolaris.redis as redis
@@ -40,7 +43,9 @@ def get_ucfg(spec):
     return ucfg
 
 @kopf.on.create('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_create(spec, name, patch, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_user_create(spec, name, patch, **kwargs):
     logging.info(f"*** whisk_user_create {name}")
     conditions = []
     state = {
@@ -53,44 +58,46 @@ def whisk_user_create(spec, name, patch, **kwargs):
 
     ucfg = get_ucfg(spec)
     user_metadata = UserMetadata(ucfg)
-    owner = kube.get(f"wsku/{name}")
-    
-    if(ucfg.get("namespace") and ucfg.get("auth")):
-        res = cdb.create_ow_user(ucfg,user_metadata)       
-        logging.info(f"OpenWhisk subject {ucfg.get('namespace')} added = {res}")
-        state['couchdb']= res
 
-        res = endpoint.create_ow_api_endpoint(ucfg,user_metadata)
-        logging.info(f"OpenWhisk api endpoints {ucfg.get('namespace')} added = {res}")
-        state['api']= res
+    with cfg.scope(), kus.staging():
+        owner = await pools.run("kube", kube.get, f"wsku/{name}")
 
+        if(ucfg.get("namespace") and ucfg.get("auth")):
+            res = await pools.run("couchdb", cdb.create_ow_user, ucfg, user_metadata)
+            logging.info(f"OpenWhisk subject {ucfg.get('namespace')} added = {res}")
+            state['couchdb']= res
 
-    if(cfg.get('components.minio') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
-        minio.create_ow_storage(state, ucfg, user_metadata, owner)
+            res = await pools.run("kube", endpoint.create_ow_api_endpoint, ucfg, user_metadata)
+            logging.info(f"OpenWhisk api endpoints {ucfg.get('namespace')} added = {res}")
+            state['api']= res
 
-    if(cfg.get('components.minio') and ucfg.get('object-storage.route.enabled') and cfg.get('components.static')):
-        res = static.create_ow_static_endpoint(ucfg,user_metadata, owner)
-        logging.info(f"OpenWhisk static endpoint for {ucfg.get('namespace')} added = {res}")
-        state['static']= res
 
-    if(cfg.get('components.mongodb') and ucfg.get('mongodb.enabled')):
-        res = mdb.create_db_user(ucfg,user_metadata)
-        logging.info(f"Mongodb setup for {ucfg.get('namespace')} added = {res}")
-        state['mongodb']= res
+        if(cfg.get('components.minio') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
+            await pools.run("minio", minio.create_ow_storage, state, ucfg, user_metadata, owner)
 
-    if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
-        res = redis.create_db_user(ucfg, user_metadata)
-        logging.info(f"Redis setup for {ucfg.get('namespace')} added = {res}")
-        state['redis']= res
+        if(cfg.get('components.minio') and ucfg.get('object-storage.route.enabled') and cfg.get('components.static')):
+            res = await pools.run("kube", static.create_ow_static_endpoint, ucfg, user_metadata, owner)
+            logging.info(f"OpenWhisk static endpoint for {ucfg.get('namespace')} added = {res}")
+            state['static']= res
 
-    if(cfg.get('components.postgres') and ucfg.get('postgres.enabled')):
-        res = postgres.create_db_user(ucfg, user_metadata)
-        logging.info(f"Postgres setup for {ucfg.get('namespace')} added = {res}")
-        state['postgres']= res        
+        if(cfg.get('components.mongodb') and ucfg.get('mongodb.enabled')):
+            res = await pools.run("exec", mdb.create_db_user, ucfg, user_metadata)
+            logging.info(f"Mongodb setup for {ucfg.get('namespace')} added = {res}")
+            state['mongodb']= res
+
+        if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
+            res = await pools.run("exec", redis.create_db_user, ucfg, user_metadata)
+            logging.info(f"Redis setup for {ucfg.get('namespace')} added = {res}")
+            state['redis']= res
+
+        if(cfg.get('components.postgres') and ucfg.get('postgres.enabled')):
+            res = await pools.run("exec", postgres.create_db_user, ucfg, user_metadata)
+            logging.info(f"Postgres setup for {ucfg.get('namespace')} added = {res}")
+            state['postgres']= res        
 
     # finally persists user metadata into the internal couchdb database
     user_metadata.dump()
-    res = userdb.save_user_metadata(user_metadata)
+    res = await pools.run("couchdb", userdb.save_user_metadata, user_metadata)
     state['user_metadata']= res
 
     conditions.append({        
@@ -102,47 +109,54 @@ def whisk_user_create(spec, name, patch, **kwargs):
     return state
 
 @kopf.on.delete('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_delete(spec, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_user_delete(spec, name, **kwargs):
     logging.info(f"*** whisk_user_delete {name}")
 
     ucfg = get_ucfg(spec)
 
-    if(ucfg.get("namespace")):
-        res = endpoint.delete_ow_api_endpoint(ucfg)
-        logging.info(f"OpenWhisk subject {ucfg.get('namespace')} api removed = {res}")
+    with cfg.scope(), kus.staging():
+        if(ucfg.get("namespace")):
+            res = await pools.run("kube", endpoint.delete_ow_api_endpoint, ucfg)
+            logging.info(f"OpenWhisk subject {ucfg.get('namespace')} api removed = {res}")
 
-        res = cdb.delete_ow_user(ucfg.get("namespace"))
-        logging.info(f"OpenWhisk subject {ucfg.get('namespace')} removed = {res}")
+            res = await pools.run("couchdb", cdb.delete_ow_user, ucfg.get("namespace"))
+            logging.info(f"OpenWhisk subject {ucfg.get('namespace')} removed = {res}")
 
-    if(cfg.get('components.minio') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
-        res = minio.delete_ow_storage(ucfg)
-        logging.info(f"OpenWhisk namespace {ucfg.get('namespace')} storage removed = {res}")
+        if(cfg.get('components.minio') and (ucfg.get('object-storage.data.enabled') or ucfg.get('object-storage.route.enabled'))):        
+            res = await pools.run("minio", minio.delete_ow_storage, ucfg)
+            logging.info(f"OpenWhisk namespace {ucfg.get('namespace')} storage removed = {res}")
 
-    if(cfg.get('components.minio') and ucfg.get('object-storage.route.enabled') and cfg.get('components.static')):
-        res = static.delete_ow_static_endpoint(ucfg)
-        logging.info(f"OpenWhisk static endpoint for {ucfg.get('namespace')} removed = {res}")
+        if(cfg.get('components.minio') and ucfg.get('object-storage.route.enabled') and cfg.get('components.static')):
+            res = await pools.run("kube", static.delete_ow_static_endpoint, ucfg)
+            logging.info(f"OpenWhisk static endpoint for {ucfg.get('namespace')} removed = {res}")
 
-    if(cfg.get('components.mongodb') and ucfg.get('mongodb.enabled')):
-        res = mdb.delete_db_user(ucfg.get('namespace'),ucfg.get('mongodb.database'))
-        logging.info(f"Mongodb setup for {ucfg.get('namespace')} removed = {res}")
+        if(cfg.get('components.mongodb') and ucfg.get('mongodb.enabled')):
+            res = await pools.run("exec", mdb.delete_db_user, ucfg.get('namespace'), ucfg.get('mongodb.database'))
+            logging.info(f"Mongodb setup for {ucfg.get('namespace')} removed = {res}")
 
-    if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
-        res = redis.delete_db_user(ucfg.get('namespace'))
-        logging.info(f"Redis setup for {ucfg.get('namespace')} removed = {res}")
+        if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
+            res = await pools.run("exec", redis.delete_db_user, ucfg.get('namespace'))
+            logging.info(f"Redis setup for {ucfg.get('namespace')} removed = {res}")
 
-    if(cfg.get('components.postgres') and ucfg.get('postgres.enabled')):
-        res = postgres.delete_db_user(ucfg.get('namespace'),ucfg.get('postgres.database'))
-        logging.info(f"Postgres setup for {ucfg.get('namespace')} removed = {res}")        
+        if(cfg.get('components.postgres') and ucfg.get('postgres.enabled')):
+            res = await pools.run("exec", postgres.delete_db_user, ucfg.get('namespace'), ucfg.get('postgres.database'))
+            logging.info(f"Postgres setup for {ucfg.get('namespace')} removed = {res}")        
 
-    res = userdb.delete_user_metadata(ucfg.get('namespace'))
+    res = await pools.run("couchdb", userdb.delete_user_metadata, ucfg.get('namespace'))
 
 
 @kopf.on.update('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_update(spec, status, namespace, diff, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_user_update(spec, status, namespace, diff, name, **kwargs):
     logging.info(f"*** detected an update of wsku/{name} under namespace {namespace}")
 
 @kopf.on.resume('nuvolaris.org', 'v1', 'whisksusers')
-def whisk_user_resume(spec, name, namespace, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def whisk_user_resume(spec, name, namespace, **kwargs):
     logging.info(f"*** detected an update of wsku/{name} under namespace {namespace}")
     ucfg = get_ucfg(spec)
     user_metadata = UserMetadata(ucfg)
@@ -150,7 +164,8 @@ def whisk_user_resume(spec, name, namespace, **kwargs):
     state = {}
     
     if(cfg.get('components.redis') and ucfg.get('redis.enabled')):
-        res = redis.create_db_user(ucfg,user_metadata)
+        with cfg.scope():
+            res = await pools.run("exec", redis.create_db_user, ucfg, user_metadata)
         logging.info(f"Redis setup for {ucfg.get('namespace')} resumed = {res}")
         state['redis']= res
 
@@ -19,11 +19,14 @@ import json
 import logging
 import nuvolaris.util as util
 from nuvolaris.user_config import UserConfig
+from nuvolaris.configmap_util import ConfigMapSnapshot
 
 class UserMetadata:
     _data = {}
 
-    def __init__(self, ucfg: UserConfig):
+    def __init__(self, ucfg: UserConfig, snapshot: ConfigMapSnapshot = None):
+        # cm/config is read at the first add_safely_from_cm and then reused
+        self._snapshot = snapshot
         self._data = {
             "login":ucfg.get('namespace'),
             "password":ucfg.get('password'),
@@ -66,7 +69,9 @@ class UserMetadata:
     
     def add_safely_from_cm(self,metadata_key,json_path):
             try: 
-                value = util.get_value_from_config_map("nuvolaris", json_path)
+                if self._snapshot is None:
+                    self._snapshot = ConfigMapSnapshot()
+                value = util.get_value_from_config_map("nuvolaris", json_path, snapshot=self._snapshot)
                 if value:
                     self.add_metadata(metadata_key, value)
             except Exception as e:
@@ -17,6 +17,8 @@
 #
 # this module wraps utilities functions
 import nuvolaris.kube as kube
+import nuvolaris.informer as informer
+import nuvolaris.readiness as readiness
 import logging
 import time, random, math, os
 import nuvolaris.config as cfg
@@ -168,25 +170,37 @@ def get_ingress_yaml(runtime):
     else:
         return  "cloud-nginx-ingress.yaml"
 
+# query pods, services and configmaps from the informer cache when available, otherwise with kubectl
+def cached_get(kind, jsonpath, namespace="nuvolaris", selector=None, name=None):
+    res = informer.query(kind, jsonpath, namespace=namespace, selector=selector, name=name)
+    if res is not None:
+        return res
+    args = ["get", name and f"{kind}/{name}" or kind]
+    if selector:
+        args += ["-l", selector]
+    return kube.kubectl(*args, namespace=namespace, jsonpath=jsonpath)
+
 # wait for a pod name
 @nuv_retry()
 def get_pod_name(jsonpath,namespace="nuvolaris"):
-    pod_name = kube.kubectl("get", "pods", namespace=namespace, jsonpath=jsonpath)
+    pod_name = cached_get("pods", jsonpath, namespace)
     if(pod_name):
         return pod_name[0]
 
     raise Exception(f"could not find any pod matching jsonpath={jsonpath}")
   
 # helper method waiting for a pod ready using the given jsonpath to retrieve the pod name
+# use readiness.pod_ready directly to wait for several pods concurrently
+# it keeps waiting until the pod is ready, timeout is the time of each wait
 def wait_for_pod_ready(pod_name_jsonpath, timeout="600s", namespace="nuvolaris"):
-    try:        
-        pod_name = get_pod_name(pod_name_jsonpath, namespace)
-        logging.info(f"checking pod {pod_name}")        
-        while not kube.wait(f"pod/{pod_name}", "condition=ready", timeout, namespace):
-            logging.info(f"waiting for {pod_name} to be ready...")
-            time.sleep(1)
-    except Exception as e:
-        logging.error(e)
+    logging.info(f"checking pod {pod_name_jsonpath}")
+    while True:
+        try:
+            pod_name = readiness.pod_ready(pod_name_jsonpath, timeout, namespace).result()
+            logging.info(f"pod {pod_name} is ready")
+            return pod_name
+        except TimeoutError as e:
+            logging.info(f"{e}, still waiting...")
 
 # return mongodb configuration parameter with default valued if not configured
 def get_mongodb_config_data():
@@ -335,7 +349,7 @@ def get_redis_config_data():
     return data
 
 def get_service(jsonpath,namespace="nuvolaris"):
-    services= kube.kubectl("get", "svc", namespace=namespace, jsonpath=jsonpath)
+    services= cached_get("svc", jsonpath, namespace)
     if(services):
         return services[0]
 
@@ -394,7 +408,7 @@ def get_postgres_backup_data():
 # wait for a service matching the given jsonpath name
 @nuv_retry()
 def wait_for_service(jsonpath,namespace="nuvolaris"):
-    service_names = kube.kubectl("get", "svc", namespace=namespace, jsonpath=jsonpath)
+    service_names = cached_get("svc", jsonpath, namespace)
     if(service_names):
         return service_names[0]
 
@@ -403,16 +417,29 @@ def wait_for_service(jsonpath,namespace="nuvolaris"):
 def get_controller_http_timeout():    
     return cfg.get("configs.limits.time.limit-max") or "5min"
 
-def get_apihost_from_config_map(namespace="nuvolaris"):
-    annotations= kube.kubectl("get", "cm/config", namespace=namespace, jsonpath='{.metadata.annotations.apihost}')
-    if(annotations):
+def get_apihost_from_config_map(namespace="nuvolaris", snapshot=None):
+    if snapshot:
+        annotations = [snapshot.get('{.metadata.annotations.apihost}')]
+    else:
+        annotations= cached_get("cm", '{.metadata.annotations.apihost}', namespace, name="config")
+    if(annotations and annotations[0]):
         return annotations[0]
 
     raise Exception("Could not find apihost annotation inside internal cm/config config Map")  
 
-def get_value_from_config_map(namespace="nuvolaris", path='{.metadata.annotations.apihost}'):
-    annotations= kube.kubectl("get", "cm/config", namespace=namespace, jsonpath=path)
-    if(annotations):
+# read a value from cm/config, from the given configmap_util.ConfigMapSnapshot if any
+def get_value_from_config_map(namespace="nuvolaris", path='{.metadata.annotations.apihost}', snapshot=None):
+    """
+    >>> from nuvolaris.configmap_util import ConfigMapSnapshot
+    >>> snap = ConfigMapSnapshot(obj={"metadata": {"annotations": {"redis_prefix": "nuvolaris"}}})
+    >>> get_value_from_config_map(path='{.metadata.annotations.redis_prefix}', snapshot=snap)
+    'nuvolaris'
+    """
+    if snapshot:
+        annotations = [snapshot.get(path)]
+    else:
+        annotations= cached_get("cm", path, namespace, name="config")
+    if(annotations and annotations[0]):
         return annotations[0]
 
     raise Exception(f"Could not find {path} annotation inside internal cm/config config Map")
@@ -518,7 +545,7 @@ def get_pod_name_by_selector(selector, jsonpath, namespace="nuvolaris"):
     param: jsonpath (eg "{.items[?(@.metadata.labels.replicationRole == 'primary')].metadata.name}")
     return: 1st mathing pod name
     """
-    pod_names = kube.kubectl("get", "pods","-l", selector, namespace=namespace, jsonpath=jsonpath)
+    pod_names = cached_get("pods", jsonpath, namespace, selector=selector)
     if(pod_names):
         return pod_names[0]
 
@@ -533,7 +560,7 @@ def get_service_by_selector(selector,jsonpath,namespace="nuvolaris"):
     param: jsonpath (eg "{.items[?(@.metadata.labels.replicationRole == 'primary')].metadata.name}")
     return: 1st mathing service name
     """
-    services= kube.kubectl("get", "svc","-l",selector, namespace=namespace, jsonpath=jsonpath)
+    services= cached_get("svc", jsonpath, namespace, selector=selector)
     if(services):
         return services[0]
 
@@ -182,10 +182,10 @@ def process_wsk_result(result: CompletedProcess, expected_success_msg: str):
     logging.info(f"successfully validated wsk response {result}")
 
 @nuv_retry()
-def safe_deploy(wskClient):
-    logging.info("*** deploying deploy/whisk-system project")
+def safe_deploy(wskClient, project="deploy/whisk-system"):
+    logging.info(f"*** deploying {project} project")
 
-    deployProjectResponse = wskClient.wsk("project","deploy","--project","deploy/whisk-system")
+    deployProjectResponse = wskClient.wsk("project","deploy","--project",project)
     process_wsk_result(deployProjectResponse, "Success")
 
     actionListResult = wskClient.wsk("action","list") 
@@ -200,7 +200,7 @@ def deploy_whisk_system_action():
         tplres = kust.processTemplate("whisk-system","whisk-system-manifest-tpl.yaml",data,"manifest.yaml")
 
         wskClient = WhiskSystemClient(auth)
-        return safe_deploy(wskClient)
+        return safe_deploy(wskClient, kust.folder("whisk-system"))
     except Exception as e:
         logging.error("Error detected when deploying system actions", e)
         return False
@@ -19,6 +19,8 @@ import kopf
 import logging, time, yaml, json, flatdict, os, os.path, random, string
 import nuvolaris.config as cfg
 import nuvolaris.kube as kube
+import nuvolaris.metrics as metrics
+import nuvolaris.executor_util as pools
 import nuvolaris.template as tpl
 
 def status():
@@ -75,22 +77,26 @@ def generate_job(name, spec, action):
     
 # tested by an integration test
 @kopf.on.create('nuvolaris.org', 'v1', 'workflows')
-def workflows_create(spec, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def workflows_create(spec, name, **kwargs):
     logging.info(f"*** workflows_create {name}")
-    try:
-        kube.kubectl("delete", f"job/{name}-delete")
-    except:
-        pass
-    kube.apply(generate_job(name, spec, "create"))
-    return status()
+    with cfg.scope():
+        return await pools.run("kube", start_job, name, spec, "create", "delete")
 
 @kopf.on.delete('nuvolaris.org', 'v1', 'workflows')
-def workflows_delete(spec, name, **kwargs):
+@pools.limited
+@metrics.reconcile
+async def workflows_delete(spec, name, **kwargs):
     logging.info(f"*** workflows_delete {name}")
-    job_name = f"{name}-create"
+    with cfg.scope():
+        return await pools.run("kube", start_job, name, spec, "delete", "create")
+
+# start the job of the action, removing the job of the opposite one
+def start_job(name, spec, action, opposite):
     try:
-        kube.kubectl("delete", f"job/{name}-create")
+        kube.kubectl("delete", f"job/{name}-{opposite}")
     except:
         pass
-    kube.apply(generate_job(name, spec, "delete"))
+    kube.apply(generate_job(name, spec, action))
     return status()
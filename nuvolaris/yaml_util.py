@@ -0,0 +1,49 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# yaml loading and dumping, with the libyaml bindings when PyYAML has them
+import yaml
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# load all the documents of a text or stream, skipping the empty ones
+def load_all(text):
+    """
+    >>> load_all("---\\na: 1\\n---\\n---\\nb: [x]\\n")
+    [{'a': 1}, {'b': ['x']}]
+    """
+    return [d for d in yaml.load_all(text, Loader=Loader) if d is not None]
+
+def load(text):
+    """
+    >>> load("kind: List")
+    {'kind': 'List'}
+    """
+    return yaml.load(text, Loader=Loader)
+
+def dump(obj, **kwargs):
+    """
+    >>> print(dump({"kind": "ConfigMap", "data": {"a": "b"}}), end="")
+    data:
+      a: b
+    kind: ConfigMap
+    """
+    return yaml.dump(obj, Dumper=kwargs.pop("Dumper", Dumper), default_flow_style=False, **kwargs)
+
+def dump_all(objs, **kwargs):
+    return yaml.dump_all(objs, Dumper=kwargs.pop("Dumper", Dumper), default_flow_style=False, **kwargs)
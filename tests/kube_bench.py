@@ -0,0 +1,49 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# compares the kubectl and the in-process api backend of nuvolaris.kube
+# running the same mix of operations against the current cluster
+#   poetry run python3 tests/kube_bench.py [rounds]
+import sys, time
+import nuvolaris.kube as kube
+
+def operations():
+    kube.apply(kube.configMap("kube-bench", value="hello"))
+    kube.kubectl("get", "cm/kube-bench", jsonpath="{.data.value}")
+    kube.kubectl("annotate", "cm/kube-bench", f"round={time.time()}", "--overwrite")
+    kube.patch("cm/kube-bench", {"data": {"value": "world"}})
+    kube.get("cm/kube-bench")
+    kube.kubectl("get", "pods", jsonpath="{.items[*].metadata.name}")
+    kube.kubectl("get", "svc", jsonpath="{.items[?(@.metadata.name == 'kubernetes')]}", namespace="default")
+    kube.kubectl("delete", "cm/kube-bench")
+    return 8
+
+def bench(backend, rounds):
+    kube.set_backend(backend)
+    # warm up, so that the api backend discovery is not counted
+    calls = operations()
+    start = time.time()
+    for _ in range(rounds):
+        operations()
+    elapsed = time.time() - start
+    return elapsed, rounds * calls
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for backend in ["kubectl", "api"]:
+        elapsed, calls = bench(backend, rounds)
+        print(f"{backend:8} {calls} calls in {elapsed:.2f}s, {1000*elapsed/calls:.1f}ms per call")
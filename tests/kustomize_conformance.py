@@ -0,0 +1,107 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# compares the native renderer of nuvolaris.kustomize_native with kustomize build
+# for every folder under deploy, and for a kustomization using all the supported features
+#   poetry run python3 tests/kustomize_conformance.py [folder...]
+# it needs kustomize in the path and exits with 1 if any output differs
+import os, sys, shutil, tempfile, subprocess, yaml
+import nuvolaris.kustomize as ku
+import nuvolaris.kustomize_native as native
+
+# a kustomization for deploy/test-sts exercising generators, images and every kind of patch
+def features(dir):
+    data = {"name": "test-nginx", "container": "test-nginx", "dir": "/data", "size": 1,
+            "storageClass": "standard", "hostpath": False}
+    kust = ku.secretLiteral("test-auth", "user=mike", "pass=hello")
+    kust += "configMapGenerator:\n- name: test-cm\n  namespace: nuvolaris\n  literals:\n  - index=hello\n"
+    kust += ku.image("nginx", "busybox", "1.36")
+    kust += ku.patchTemplates("test-sts", ["set-attach.yaml", "security-set-attach.yaml"], data)
+    kust += ku.patchGenericEntry("StatefulSet", "test-nginx", "/spec/replicas", "2", apiVersion="v1")
+    kust += ku.patchGenericEntry("Service", "test-nginx", "/spec/type", "ClusterIP")
+    with open(f"deploy/test-sts/__cm-attach.yaml", "w") as f:
+        f.write("apiVersion: apps/v1\nkind: StatefulSet\nmetadata:\n  name: test-nginx\n  namespace: nuvolaris\n"
+                "spec:\n  template:\n    spec:\n      volumes:\n      - name: html\n        configMap:\n          name: test-cm\n"
+                "      containers:\n      - name: test-nginx\n        envFrom:\n        - secretRef:\n            name: test-auth\n")
+    kust += "- path: __cm-attach.yaml\n"
+    for file in os.listdir("deploy/test-sts"):
+        if file.startswith("__") or file.endswith(".yaml") and not file.startswith("_"):
+            shutil.copy(f"deploy/test-sts/{file}", dir)
+    resources = "".join(f"- {f}\n" for f in sorted(os.listdir(dir)) if not f.startswith("_"))
+    with open(f"{dir}/kustomization.yaml", "w") as f:
+        f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\n" + kust + "resources:\n" + resources)
+    for file in os.listdir("deploy/test-sts"):
+        if file.startswith("__"):
+            os.remove(f"deploy/test-sts/{file}")
+
+# a kustomization listing the resources of the folder, as kustomize.kustomize does
+def folder(where, dir):
+    files = [f for f in sorted(os.listdir(f"deploy/{where}"))
+             if f.endswith((".yaml", ".yml")) and not f.startswith("_") and f != "kustomization.yaml"]
+    for file in files:
+        shutil.copy(f"deploy/{where}/{file}", dir)
+    with open(f"{dir}/kustomization.yaml", "w") as f:
+        f.write("apiVersion: kustomize.config.k8s.io/v1beta1\nkind: Kustomization\nresources:\n")
+        f.write("".join(f"- {file}\n" for file in files))
+
+def _id(obj):
+    meta = obj.get("metadata", {})
+    return f"{obj.get('kind')}/{meta.get('namespace', '')}/{meta.get('name')}"
+
+# compare the two renderings of dir, returning the differences
+def compare(dir):
+    res = subprocess.run(["kustomize", "build", dir], capture_output=True)
+    if res.returncode != 0:
+        return None
+    expected = [d for d in yaml.safe_load_all(res.stdout) if d is not None]
+    try:
+        actual = native.render(dir)
+    except Exception as e:
+        return [f"native render failed: {e}"]
+    diffs = []
+    if [_id(o) for o in expected] != [_id(o) for o in actual]:
+        diffs.append(f"order: {[_id(o) for o in expected]} != {[_id(o) for o in actual]}")
+    actual = {_id(o): o for o in actual}
+    for obj in expected:
+        if actual.get(_id(obj)) != obj:
+            diffs.append(f"{_id(obj)}:\n--- kustomize\n{yaml.safe_dump(obj)}--- native\n{yaml.safe_dump(actual.get(_id(obj)))}")
+    return diffs
+
+def main(wheres):
+    failed = 0
+    cases = [(w, folder) for w in wheres] + ([("features", None)] if not sys.argv[1:] else [])
+    for where, prepare in cases:
+        dir = tempfile.mkdtemp()
+        try:
+            prepare(where, dir) if prepare else features(dir)
+            diffs = compare(dir)
+        finally:
+            shutil.rmtree(dir)
+        if diffs is None:
+            print(f"SKIP {where}: kustomize build failed")
+        elif diffs:
+            failed += 1
+            print(f"FAIL {where}")
+            for diff in diffs:
+                print(diff)
+        else:
+            print(f"OK   {where}")
+    return failed
+
+if __name__ == "__main__":
+    wheres = sys.argv[1:] or sorted(d for d in os.listdir("deploy") if os.path.isdir(f"deploy/{d}"))
+    sys.exit(1 if main(wheres) else 0)
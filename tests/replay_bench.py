@@ -0,0 +1,141 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# offline benchmark of the operator hot paths
+# first record a session against a test cluster (it deploys tests/whisk.yaml,
+# enables redis with a patch and creates the user in tests/whisk-user.yaml):
+#   poetry run python3 tests/replay_bench.py record session.json
+# then replay it without a cluster, as many times as needed:
+#   poetry run python3 tests/replay_bench.py replay session.json [--latency recorded|<seconds>] [--rounds N] [--skip-sleep]
+# it reports the wall time of each phase and, per component, wall time and kube/http calls
+# the minio client is not recorded: record sessions with minio disabled to replay them fully
+import time, asyncio, argparse, logging
+import nuvolaris.testutil as tu
+import nuvolaris.config as cfg
+import nuvolaris.kube as kube
+import nuvolaris.util as util
+import nuvolaris.dag_util as dag
+import nuvolaris.executor_util as pools
+import nuvolaris.main as main
+import nuvolaris.patcher as patcher
+import nuvolaris.user_handlers as user_handlers
+
+# the component modules imported by these modules are measured
+ENTRY_MODULES = [main, patcher, user_handlers]
+HELPER_MODULES = [kube, util, cfg, tu, dag, pools]
+
+class Timed:
+    def __init__(self, module, name, times):
+        self._module = module
+        self._name = name
+        self._times = times
+
+    def __getattr__(self, attr):
+        value = getattr(self._module, attr)
+        if not callable(value) or isinstance(value, type):
+            return value
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                with tu.component(self._name):
+                    return value(*args, **kwargs)
+            finally:
+                self._times[self._name] = self._times.get(self._name, 0) + time.time() - start
+        return timed
+
+# wrap the component modules used by the entry points to measure them
+def instrument(times):
+    originals = []
+    for entry in ENTRY_MODULES:
+        for attr, value in list(vars(entry).items()):
+            if type(value).__name__ == "module" and value.__name__.startswith("nuvolaris.") \
+               and value not in HELPER_MODULES:
+                originals.append((entry, attr, value))
+                setattr(entry, attr, Timed(value, value.__name__.split(".")[-1], times))
+    return originals
+
+def restore(originals):
+    for entry, attr, value in originals:
+        setattr(entry, attr, value)
+
+class Patch:
+    def __init__(self):
+        self.status = {}
+
+def phases(meta):
+    diff = (("change", ("spec", "components", "redis"), False, True),)
+    return [
+        ("whisk_create", lambda: asyncio.run(main.whisk_create(meta["whisk"]["spec"], meta["whisk"]["metadata"]["name"], Patch()))),
+        ("patch", lambda: patcher.patch(diff, {}, kube.get(f"wsk/{meta['whisk']['metadata']['name']}"), meta["whisk"]["metadata"]["name"])),
+        ("whisk_user_create", lambda: asyncio.run(user_handlers.whisk_user_create(meta["user"]["spec"], meta["user"]["metadata"]["name"], Patch())))
+    ]
+
+def record(path):
+    meta = {"whisk": tu.load_yaml("tests/whisk.yaml"), "user": tu.load_yaml("tests/whisk-user.yaml")}
+    session = tu.KubeSession(meta=meta)
+    recorder = tu.KubeRecorder(kube.get_backend(), session)
+    kube.set_backend(recorder)
+    with recorder.http():
+        for name, run in phases(meta):
+            session.phase = name
+            start = time.time()
+            run()
+            print(f"recorded {name} in {time.time() - start:.2f}s")
+    session.save(path)
+    print(f"saved {len(session.calls)} calls in {path}")
+
+def replay(path, latency, rounds, skip_sleep):
+    session = tu.KubeSession.load(path)
+    sleep = time.sleep
+    if skip_sleep:
+        time.sleep = lambda seconds: None
+    try:
+        for n in range(rounds):
+            replayer = tu.KubeReplayer(session, latency)
+            kube.set_backend(replayer)
+            times = {}
+            originals = instrument(times)
+            try:
+                with replayer.http():
+                    for name, run in phases(session.meta):
+                        cfg.clean()
+                        replayer.phase = name
+                        start = time.time()
+                        run()
+                        print(f"round {n+1} {name}: {time.time() - start:.3f}s")
+            finally:
+                restore(originals)
+            print(f"{'component':<20}{'wall':>10}{'calls':>8}{'missed':>8}{'latency':>10}")
+            for comp in sorted(set(times) | set(replayer.stats)):
+                stat = replayer.stats.get(comp, {"calls": 0, "missed": 0, "latency": 0})
+                print(f"{comp:<20}{times.get(comp, 0):>10.3f}{stat['calls']:>8}{stat['missed']:>8}{stat['latency']:>10.3f}")
+    finally:
+        time.sleep = sleep
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("session")
+    parser.add_argument("--latency", default=None, help="recorded or a fixed number of seconds per call")
+    parser.add_argument("--rounds", type=int, default=1)
+    parser.add_argument("--skip-sleep", action="store_true", help="do not wait in time.sleep while replaying")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.mode == "record":
+        record(args.session)
+    else:
+        replay(args.session, args.latency, args.rounds, args.skip_sleep)
@@ -0,0 +1,100 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# load test of the async handlers: resumes N synthetic whisksusers with redis enabled,
+# as after an operator restart, against a mock kube backend answering after a fixed latency
+#   poetry run python3 tests/resume_load.py [--users N] [--latency SECONDS]
+# the pools and the handler concurrency are sized with the NUVOLARIS_POOL_* and
+# NUVOLARIS_HANDLER_CONCURRENCY variables; it reports the wall time, the peak of the
+# concurrent kube calls and the worst delay of the event loop, that must stay low
+import time, copy, asyncio, argparse, logging, threading
+import nuvolaris.config as cfg
+import nuvolaris.kube as kube
+import nuvolaris.testutil as tu
+import nuvolaris.executor_util as pools
+import nuvolaris.user_handlers as user_handlers
+
+# answers every call after the latency: the redis pod for the names, the redis service otherwise
+class MockBackend:
+    name = "mock"
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.running = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def run(self, args, namespace="nuvolaris", input=None, jsonpath=None):
+        with self._lock:
+            self.calls += 1
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            time.sleep(self.latency)
+        finally:
+            with self._lock:
+                self.running -= 1
+        if jsonpath and "metadata.name" in jsonpath:
+            return kube.KubeResult(0, '["redis-0"]', "", ["redis-0"])
+        if jsonpath:
+            service = {"metadata": {"name": "redis"}, "spec": {"ports": [{"port": 6379}]}}
+            return kube.KubeResult(0, "", "", [service])
+        return kube.KubeResult(0, "OK", "")
+
+def users(n):
+    spec = tu.load_yaml("tests/whisk-user.yaml")["spec"]
+    for i in range(n):
+        user = copy.deepcopy(spec)
+        user["namespace"] = f"user{i}"
+        user["redis"]["enabled"] = True
+        yield f"user{i}", user
+
+# the worst delay of the event loop, checked every 10ms until done is set
+async def heartbeat(done):
+    worst = 0
+    while not done.is_set():
+        start = time.time()
+        await asyncio.sleep(0.01)
+        worst = max(worst, time.time() - start - 0.01)
+    return worst
+
+async def resume(n):
+    done = asyncio.Event()
+    beat = asyncio.ensure_future(heartbeat(done))
+    handlers = [user_handlers.whisk_user_resume(spec, name, "nuvolaris") for name, spec in users(n)]
+    start = time.time()
+    await asyncio.gather(*handlers)
+    elapsed = time.time() - start
+    done.set()
+    return elapsed, await beat
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per kube call")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    cfg.clean()
+    cfg.put("components.redis", True)
+    backend = MockBackend(args.latency)
+    kube.set_backend(backend)
+    elapsed, lag = asyncio.run(resume(args.users))
+    pools.shutdown()
+    print(f"resumed {args.users} users in {elapsed:.2f}s ({args.users / elapsed:.1f}/s), "
+          f"{backend.calls} kube calls, {backend.peak} at the same time, worst loop delay {1000 * lag:.1f}ms "
+          f"(concurrency {pools.CONCURRENCY}, pools {pools.SIZES})")
@@ -0,0 +1,59 @@
+# Licensed to the Apache Software Foundation (ASF) under one
+# or more contributor license agreements.  See the NOTICE file
+# distributed with this work for additional information
+# regarding copyright ownership.  The ASF licenses this file
+# to you under the Apache License, Version 2.0 (the
+# "License"); you may not use this file except in compliance
+# with the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+#
+# renders per second of nuvolaris.template, reloading the templates from disk
+# without caches (as before) and with the precompiled environment and the render cache
+#   poetry run python3 tests/template_bench.py [seconds]
+import sys, time
+from jinja2 import Environment
+import nuvolaris.template as ntp
+
+WORKLOAD = [
+    ("set-attach.yaml", {"name": "couchdb", "container": "couchdb", "dir": "/opt/couchdb/data",
+                         "size": 10, "storageClass": "standard", "hostpath": False}),
+    ("affinity-tolerance-sts-core-attach.yaml", {"name": "couchdb", "affinity": True, "tolerations": True,
+        "affinity_invoker_node_label": "invoker", "affinity_core_node_label": "core",
+        "pod_anti_affinity_name": "couchdb", "toleration_role": "core"}),
+    ("generic-ingress-tpl.yaml", {"namespace": "nuvolaris", "ingress_name": "apihost", "hostname": "localhost",
+        "ingress_class": "nginx", "service_name": "controller", "service_port": 3233, "context_path": "/api",
+        "tls": False, "needs_rewrite": False, "needs_prefix": False}),
+    ("traefik-middleware-tpl.yaml", {"namespace": "user1", "middleware_name": "user1-prefix", "prefix_path": "/user1"}),
+]
+
+def run(expand, seconds):
+    count, start = 0, time.time()
+    while time.time() - start < seconds:
+        for template, data in WORKLOAD:
+            expand(template, dict(data))
+            count += 1
+    return count / (time.time() - start)
+
+# the environment used before, checking the template files at each render
+before_env = Environment(loader=ntp.loader, auto_reload=True)
+
+def before(template, data):
+    return before_env.get_template(template).render(data)
+
+def precompiled(template, data):
+    return ntp.env.get_template(template).render(data)
+
+if __name__ == "__main__":
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    ntp.precompile()
+    for name, expand in [("before (auto reload)", before), ("precompiled", precompiled),
+                         ("precompiled and memoized", ntp.expand_template)]:
+        print(f"{name:<30}{run(expand, seconds):>12.0f} renders/s")